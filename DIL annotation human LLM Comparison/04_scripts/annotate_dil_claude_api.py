@@ -31,7 +31,7 @@ garantendo risposte parsable e consistenti con decisione + ragionamento.
 
 Requisiti
 ---------
-  pip install anthropic pandas scikit-learn
+  pip install anthropic pandas scipy
 
 Configurazione
 --------------
@@ -47,16 +47,26 @@ Utilizzo
     --config PERCORSO    Percorso al file JSON di configurazione (default: api_config.json)
     --mode batch         Usa Batches API [default, consigliato]
     --mode sequential    Usa chiamate sequenziali (più lento ma con controllo in tempo reale)
-    --resume BATCH_ID    Riprende il polling di un batch già inviato in precedenza
+    --mode concurrent    Usa chiamate in tempo reale con un pool di worker concorrenti,
+                         ritentativi in coda e checkpoint per riga
+    --resume BATCH_ID [BATCH_ID ...]
+                         Riprende il polling di uno o più shard già inviati in precedenza
+    --ricomincia         Ignora il manifest di un run batch interrotto e ne avvia uno nuovo
+    --due-passaggi       Thinking adattivo solo sulle righe ambigue di un primo passaggio veloce
+    --sweep GRIGLIA      Esegue in parallelo una griglia di modelli, prompt e thinking/effort
+                         (un batch per configurazione) e ne confronta le metriche
+    --benchmark-richieste CSV
+                         Confronta la costruzione delle richieste iterrows vs vettoriale
 
 Flusso di esecuzione
 ---------------------
   1. Caricamento configurazione da api_config.json
   2. Caricamento e validazione del dataset CSV
   3. Costruzione delle richieste batch (una per trigramma)
-  4. Invio del batch all'API Anthropic
-  5. Polling ciclico finché il batch non è completato
-  6. Raccolta e parsing dei risultati
+  4. Suddivisione in shard e invio parallelo all'API Anthropic
+  5. Polling asincrono degli shard con pausa adattiva
+  6. Raccolta e parsing dei risultati di ogni shard appena completato
+     (le righe fallite vengono reinviate in un nuovo round, tracciate dal manifest)
   7. Salvataggio del CSV annotato con nuova colonna
   8. Calcolo e stampa delle metriche (accuracy, F1, ecc.)
   9. Confronto con annotazione precedente (inter-annotator agreement)
@@ -70,11 +80,17 @@ import os          # Operazioni sul filesystem (verifica esistenza file)
 import sys         # Accesso ad argv e uscita con codice di errore
 import json        # Lettura/scrittura file JSON (configurazione, log)
 import time        # Pausa tra polling successivi
+import random      # Jitter delle pause di polling
+import asyncio     # Polling e raccolta asincroni degli shard
 import logging     # Logging strutturato su file e console
 import argparse    # Parsing degli argomenti da riga di comando
+import itertools   # Prodotto cartesiano della griglia di sweep
+import threading   # Nome del thread di ogni configurazione dello sweep
+from concurrent.futures import ThreadPoolExecutor, as_completed  # Invio parallelo degli shard
 from datetime import datetime          # Timestamp nei log
 from pathlib import Path               # Gestione percorsi cross-platform
-from typing import Optional            # Type hints
+from contextlib import nullcontext    # Log opzionale in modalità sequenziale
+from typing import Callable, Optional  # Type hints
 
 # ---------------------------------------------------------------------------
 # IMPORTAZIONI TERZE PARTI
@@ -90,17 +106,32 @@ except ImportError:
     print("Eseguire: pip install anthropic")
     sys.exit(1)
 
-try:
-    from sklearn.metrics import (
-        accuracy_score,
-        precision_recall_fscore_support,
-        confusion_matrix,
-        cohen_kappa_score,
-    )
-except ImportError:
-    print("ERRORE: la libreria 'scikit-learn' non è installata.")
-    print("Eseguire: pip install scikit-learn")
-    sys.exit(1)
+# ---------------------------------------------------------------------------
+# MODULI CONDIVISI CON LA PIPELINE DI ANNOTAZIONE
+# ---------------------------------------------------------------------------
+# Il trasporto HTTP (pool keep-alive, metriche di connessione) vive nella
+# cartella "LLM annotation code", due livelli sopra questo script.
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "LLM annotation code"))
+from dil_transport import (  # noqa: E402
+    RateLimiter,
+    TransportMetrics,
+    create_async_httpx_client,
+    create_httpx_client,
+    json_dumps,
+    json_loads,
+)
+from dil_decoder import SchemaDecoder  # noqa: E402
+from dil_reasoning_log import ReasoningLogWriter, iter_log_frames  # noqa: E402
+from dil_agreement import Ratings, duplicate_raters, pairwise_kappa, panel_agreement  # noqa: E402
+from dil_metrics import (  # noqa: E402
+    COUNT_KEYS,
+    annotator_columns,
+    encode_columns,
+    metrics_from_counts,
+    pair_metrics,
+    pairwise_confusion,
+)
+from dil_streaming import StreamingMetrics  # noqa: E402
 
 # ---------------------------------------------------------------------------
 # CONFIGURAZIONE DEL LOGGER
@@ -324,6 +355,60 @@ Determina se questo trigramma contiene Discorso Indiretto Libero (DIL) secondo i
     return prompt
 
 
+def costruisci_prompt_vettoriale(df: pd.DataFrame) -> pd.Series:
+    """
+    Costruisce i prompt utente di tutte le righe in forma vettoriale.
+
+    Produce lo stesso testo di costruisci_prompt_utente, ma lavora per
+    colonne: i valori mancanti vengono sostituiti una volta sola per
+    colonna e il template viene composto con concatenazioni tra Series,
+    senza iterare sulle righe con df.iterrows().
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame con author, work, year, text (le colonne assenti sono
+        trattate come valori mancanti)
+
+    Returns
+    -------
+    pd.Series
+        Prompt utente, con lo stesso indice di df
+    """
+    def colonna(nome: str, default: str) -> pd.Series:
+        if nome not in df.columns:
+            return pd.Series(default, index=df.index, dtype=object)
+        valori = df[nome]
+        return valori.astype(str).where(valori.notna(), default)
+
+    autore = colonna("author", "Autore sconosciuto")
+    opera = colonna("work", "Opera sconosciuta")
+    testo = colonna("text", "")
+
+    # L'anno è numerico nel CSV (float per via dei NaN): si tronca a intero
+    if "year" in df.columns:
+        anni = pd.to_numeric(df["year"], errors="coerce")
+        anno = anni.fillna(0).astype("int64").astype(str).where(anni.notna(), "anno ignoto")
+    else:
+        anno = pd.Series("anno ignoto", index=df.index, dtype=object)
+
+    return (
+        "Analizza il seguente trigramma estratto da un'opera narrativa italiana.\n"
+        "\n"
+        "CONTESTO BIBLIOGRAFICO:\n"
+        "- Autore: " + autore + "\n"
+        "- Opera: " + opera + "\n"
+        "- Anno: " + anno + "\n"
+        "\n"
+        "TESTO DA ANALIZZARE:\n"
+        "---\n" + testo + "\n"
+        "---\n"
+        "\n"
+        "Determina se questo trigramma contiene Discorso Indiretto Libero (DIL) secondo i criteri "
+        "teorici forniti. Rispondi con il JSON richiesto."
+    )
+
+
 def costruisci_schema_output() -> dict:
     """
     Restituisce lo schema JSON che vincola il formato della risposta del modello.
@@ -376,6 +461,73 @@ def costruisci_schema_output() -> dict:
     }
 
 
+# Decoder compilato una sola volta dallo schema 'annotazione_dil'
+DECODIFICATORE = SchemaDecoder.from_schema(costruisci_schema_output())
+
+
+def carica_prompt_sistema(config: dict) -> str:
+    """
+    System prompt della configurazione: quello di SEZIONE 1, oppure il
+    contenuto del file percorso_prompt_sistema (varianti di prompt, es. v1/v2).
+    """
+    percorso = config.get("percorso_prompt_sistema")
+    if not percorso:
+        return SYSTEM_PROMPT
+    if not Path(percorso).exists():
+        raise FileNotFoundError(f"File del system prompt non trovato: {percorso}")
+    return Path(percorso).read_text(encoding="utf-8")
+
+
+def costruisci_parametri_base(config: dict) -> dict:
+    """
+    Parametri della chiamata API comuni a tutte le richieste.
+
+    System prompt e schema di output sono identici per ogni trigramma:
+    vengono costruiti una sola volta e condivisi (per riferimento) da tutte
+    le richieste, che differiscono solo per il messaggio utente.
+
+    Parameters
+    ----------
+    config : dict
+        Configurazione con modello, max_tokens, usa_thinking_adattivo,
+        effort e percorso_prompt_sistema (opzionali)
+
+    Returns
+    -------
+    dict
+        Parametri senza 'messages'
+    """
+    modello = config.get("modello", "claude-opus-4-6")
+    max_tokens = config.get("max_tokens", 512)
+    usa_thinking = config.get("usa_thinking_adattivo", False)
+
+    params = {
+        "model": modello,
+        "max_tokens": max_tokens,
+        "system": carica_prompt_sistema(config),
+        # Structured outputs per risposta JSON garantita
+        "output_config": {
+            "format": costruisci_schema_output()
+        }
+    }
+
+    # Livello di effort ('low', 'medium', 'high'), se indicato: regola
+    # quanti token il modello spende per risposta
+    if config.get("effort"):
+        params["output_config"]["effort"] = config["effort"]
+
+    # Aggiunge thinking adattivo se richiesto nella configurazione.
+    # Nota: thinking adattivo è disponibile solo su claude-opus-4-6 e
+    # aumenta significativamente costi e latenza. Per classificazione
+    # binaria si sconsiglia, ma può migliorare casi ambigui.
+    if usa_thinking and "opus-4-6" in modello:
+        params["thinking"] = {"type": "adaptive"}
+        # Con thinking attivo i max_tokens devono essere più alti
+        params["max_tokens"] = max(max_tokens, 4096)
+
+    return params
+
+
 def prepara_richieste_batch(df: pd.DataFrame, config: dict) -> list:
     """
     Prepara la lista di richieste da inviare al Batches API.
@@ -383,6 +535,8 @@ def prepara_richieste_batch(df: pd.DataFrame, config: dict) -> list:
     Ogni richiesta corrisponde a un trigramma e viene identificata da un
     custom_id univoco (indice della riga nel DataFrame) per poter ricongiunger
     i risultati con i dati originali dopo il completamento del batch.
+    I prompt sono costruiti in forma vettoriale (costruisci_prompt_vettoriale)
+    e i parametri comuni una sola volta (costruisci_parametri_base).
 
     Parameters
     ----------
@@ -396,58 +550,124 @@ def prepara_richieste_batch(df: pd.DataFrame, config: dict) -> list:
     list
         Lista di oggetti Request pronti per il Batches API
     """
-    modello = config.get("modello", "claude-opus-4-6")
-    max_tokens = config.get("max_tokens", 512)
-    usa_thinking = config.get("usa_thinking_adattivo", False)
+    params_base = costruisci_parametri_base(config)
+    prompts = costruisci_prompt_vettoriale(df)
 
-    richieste = []
-
-    for idx, riga in df.iterrows():
-        # Costruisce il prompt specifico per questo trigramma
-        prompt_utente = costruisci_prompt_utente(riga)
-
-        # Parametri base della chiamata API
-        params = {
-            "model": modello,
-            "max_tokens": max_tokens,
-            "system": SYSTEM_PROMPT,
-            "messages": [
-                {"role": "user", "content": prompt_utente}
-            ],
-            # Structured outputs per risposta JSON garantita
-            "output_config": {
-                "format": costruisci_schema_output()
-            }
-        }
-
-        # Aggiunge thinking adattivo se richiesto nella configurazione.
-        # Nota: thinking adattivo è disponibile solo su claude-opus-4-6 e
-        # aumenta significativamente costi e latenza. Per classificazione
-        # binaria si sconsiglia, ma può migliorare casi ambigui.
-        if usa_thinking and "opus-4-6" in modello:
-            params["thinking"] = {"type": "adaptive"}
-            # Con thinking attivo i max_tokens devono essere più alti
-            params["max_tokens"] = max(max_tokens, 4096)
-
-        # Il custom_id permette di associare il risultato alla riga originale.
-        # Usiamo str(idx) per garantire unicità anche se l'indice non è sequenziale.
-        richiesta = Request(
+    # Il custom_id permette di associare il risultato alla riga originale.
+    # Usiamo str(idx) per garantire unicità anche se l'indice non è sequenziale.
+    richieste = [
+        Request(
             custom_id=str(idx),
-            params=MessageCreateParamsNonStreaming(**params)
+            params=MessageCreateParamsNonStreaming(
+                **params_base,
+                messages=[{"role": "user", "content": prompt_utente}]
+            )
         )
-        richieste.append(richiesta)
+        for idx, prompt_utente in zip(df.index, prompts)
+    ]
 
     logger.info(f"Preparate {len(richieste)} richieste per il batch")
     return richieste
 
 
-def invia_batch(client: anthropic.Anthropic, richieste: list, config: dict) -> str:
+def serializza_richieste_jsonl(richieste: list, percorso_jsonl: str) -> list:
     """
-    Invia il batch all'API Anthropic e registra l'ID del batch.
+    Scrive le richieste in un file JSONL (una richiesta per riga).
 
-    L'ID del batch viene salvato su file per permettere il ripristino
-    in caso di interruzione dello script: con --resume BATCH_ID si può
-    riprendere il polling senza re-inviare il batch.
+    Il file documenta esattamente cosa è stato inviato e permette di
+    ricostruire il batch senza rigenerare i prompt. Le dimensioni in byte
+    di ogni riga vengono restituite per la suddivisione in shard, così ogni
+    richiesta viene serializzata una sola volta.
+
+    Parameters
+    ----------
+    richieste : list
+        Lista di oggetti Request
+    percorso_jsonl : str
+        Percorso del file .jsonl di output
+
+    Returns
+    -------
+    list
+        Dimensione in byte della serializzazione di ogni richiesta
+    """
+    dimensioni = []
+    with open(percorso_jsonl, "wb") as f:
+        for richiesta in richieste:
+            riga = json_dumps(richiesta)
+            f.write(riga + b"\n")
+            dimensioni.append(len(riga))
+
+    logger.info(f"Richieste serializzate in '{percorso_jsonl}' ({sum(dimensioni) / 1024 / 1024:.1f} MB)")
+    return dimensioni
+
+
+def suddividi_in_shard(richieste: list, config: dict, dimensioni: Optional[list] = None) -> list:
+    """
+    Suddivide le richieste in shard che rispettano i limiti del Batches API.
+
+    Ogni batch Anthropic accetta al massimo 100.000 richieste e 256 MB di
+    payload: su corpora più grandi dei 500 trigrammi un unico batch verrebbe
+    rifiutato. Gli shard vengono riempiti in ordine finché non si raggiunge
+    uno dei due limiti (numero di richieste o dimensione JSON stimata).
+
+    Parameters
+    ----------
+    richieste : list
+        Lista di oggetti Request prodotta da prepara_richieste_batch
+    config : dict
+        Configurazione con max_richieste_per_batch e max_mb_per_batch
+    dimensioni : list, opzionale
+        Dimensione in byte di ogni richiesta (da serializza_richieste_jsonl);
+        se assente viene stimata serializzando le richieste
+
+    Returns
+    -------
+    list
+        Lista di shard (ciascuno una lista di Request)
+    """
+    max_richieste = config.get("max_richieste_per_batch", 100_000)
+    # Margine sotto il limite dichiarato per l'overhead dell'involucro HTTP
+    max_byte = int(config.get("max_mb_per_batch", 256) * 1024 * 1024 * 0.95)
+
+    shard = []
+    corrente, byte_correnti = [], 0
+    if dimensioni is None:
+        # Request è un TypedDict: la dimensione si stima dalla sua serializzazione
+        dimensioni = [len(json_dumps(richiesta)) for richiesta in richieste]
+
+    for richiesta, dimensione in zip(richieste, dimensioni):
+        if corrente and (len(corrente) >= max_richieste or byte_correnti + dimensione > max_byte):
+            shard.append(corrente)
+            corrente, byte_correnti = [], 0
+        corrente.append(richiesta)
+        byte_correnti += dimensione
+    if corrente:
+        shard.append(corrente)
+
+    logger.info(
+        f"{len(richieste)} richieste suddivise in {len(shard)} shard "
+        f"(max {max_richieste} richieste / {max_byte / 1024 / 1024:.0f} MB per shard)"
+    )
+    return shard
+
+
+def invia_batch(
+    client: anthropic.Anthropic,
+    richieste: list,
+    config: dict,
+    al_creazione_shard: Optional[Callable[[str, list], None]] = None
+) -> list:
+    """
+    Invia le richieste all'API Anthropic, suddivise in shard, e registra
+    l'ID di ogni batch creato.
+
+    Gli shard vengono inviati in parallelo (max_invii_paralleli thread): il
+    client Anthropic è thread-safe e l'upload di shard da centinaia di MB è
+    dominato dalla rete. Gli ID vengono salvati su file con un identificativo
+    di gruppo comune per permettere il ripristino in caso di interruzione:
+    con --resume BATCH_ID [BATCH_ID ...] si può riprendere il polling di
+    tutti gli shard senza re-inviarli.
 
     Parameters
     ----------
@@ -456,37 +676,58 @@ def invia_batch(client: anthropic.Anthropic, richieste: list, config: dict) -> s
     richieste : list
         Lista di oggetti Request pronti per il Batches API
     config : dict
-        Configurazione con percorso_log_batch
+        Configurazione con percorso_log_batch e parametri di sharding
+    al_creazione_shard : callable, optional
+        Chiamata come al_creazione_shard(batch_id, richieste_shard) appena
+        ogni shard è stato creato, nel thread chiamante: permette di
+        registrare il batch (es. nel manifest) prima che gli altri shard
+        siano inviati, così un'interruzione non lascia batch pagati ma
+        sconosciuti alla ripresa
 
     Returns
     -------
-    str
-        ID del batch creato
+    list
+        ID dei batch creati (uno per shard, nell'ordine degli shard)
 
     Raises
     ------
     anthropic.APIError
         In caso di errore nella comunicazione con le API
     """
-    logger.info(f"Invio del batch con {len(richieste)} richieste...")
+    percorso_jsonl = config.get("percorso_richieste_batch", "DIL_API_batch_requests.jsonl")
+    dimensioni = serializza_richieste_jsonl(richieste, percorso_jsonl)
+    shard = suddividi_in_shard(richieste, config, dimensioni)
+    max_paralleli = config.get("max_invii_paralleli", 4)
+    gruppo = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    logger.info(f"Invio di {len(shard)} shard ({len(richieste)} richieste, {max_paralleli} invii paralleli)...")
 
-    batch = client.messages.batches.create(requests=richieste)
+    def invia_shard(numero: int) -> object:
+        batch = client.messages.batches.create(requests=shard[numero])
+        logger.info(
+            f"Shard {numero + 1}/{len(shard)} creato. ID: {batch.id} "
+            f"({len(shard[numero])} richieste, stato: {batch.processing_status})"
+        )
+        return batch
 
-    batch_id = batch.id
-    logger.info(f"Batch creato con successo. ID: {batch_id}")
-    logger.info(f"Stato iniziale: {batch.processing_status}")
+    with ThreadPoolExecutor(max_workers=max_paralleli) as executor:
+        futures = {executor.submit(invia_shard, n): n for n in range(len(shard))}
+        batch_creati = [None] * len(shard)
+        errori = []
+        for future in as_completed(futures):
+            try:
+                batch_creati[futures[future]] = future.result()
+            except anthropic.APIError as e:
+                errori.append(e)
+                logger.error(f"Errore nell'invio dello shard {futures[future] + 1}: {e}")
+                continue
+            if al_creazione_shard is not None:
+                al_creazione_shard(batch_creati[futures[future]].id, shard[futures[future]])
 
-    # Salva l'ID del batch su file per permettere ripristino
+    # Salva gli ID dei batch su file per permettere ripristino
     percorso_log = config.get("percorso_log_batch", "batch_ids_log.json")
-    entry_log = {
-        "batch_id": batch_id,
-        "timestamp_creazione": datetime.now().isoformat(),
-        "n_richieste": len(richieste),
-        "modello": config.get("modello"),
-        "stato": batch.processing_status
-    }
 
-    # Carica il log esistente (se presente) e aggiunge la nuova entry
+    # Carica il log esistente (se presente) e aggiunge le nuove entry
     log_esistente = []
     if Path(percorso_log).exists():
         with open(percorso_log, "r", encoding="utf-8") as f:
@@ -495,233 +736,662 @@ def invia_batch(client: anthropic.Anthropic, richieste: list, config: dict) -> s
             except json.JSONDecodeError:
                 log_esistente = []
 
-    log_esistente.append(entry_log)
+    for numero, batch in enumerate(batch_creati):
+        if batch is None:
+            continue
+        log_esistente.append({
+            "batch_id": batch.id,
+            "gruppo": gruppo,
+            "shard": numero + 1,
+            "n_shard": len(shard),
+            "timestamp_creazione": datetime.now().isoformat(),
+            "n_richieste": len(shard[numero]),
+            "modello": config.get("modello"),
+            "stato": batch.processing_status
+        })
 
     with open(percorso_log, "w", encoding="utf-8") as f:
         json.dump(log_esistente, f, ensure_ascii=False, indent=2)
 
-    logger.info(f"ID batch salvato in '{percorso_log}' per eventuale ripristino.")
-    return batch_id
+    batch_ids = [batch.id for batch in batch_creati if batch is not None]
+    logger.info(f"ID batch (gruppo {gruppo}) salvati in '{percorso_log}' per eventuale ripristino.")
+
+    # Se anche un solo shard non è stato inviato l'annotazione sarebbe
+    # incompleta: si interrompe dopo aver registrato gli shard già creati
+    if errori:
+        logger.error(
+            f"{len(errori)} shard non inviati. Shard già creati: {' '.join(batch_ids) or 'nessuno'}"
+        )
+        raise errori[0]
+
+    return batch_ids
+
 
+def calcola_pausa_polling(tentativo: int, config: dict) -> float:
+    """
+    Pausa adattiva tra due controlli dello stesso shard.
+
+    I batch piccoli terminano spesso in pochi minuti: si interroga l'API
+    frequentemente all'inizio e si allunga la pausa in modo esponenziale
+    man mano che lo shard invecchia, fino a pausa_polling_secondi. Un
+    jitter del ±10% evita che shard inviati insieme vengano interrogati
+    sempre nello stesso istante.
+
+    Parameters
+    ----------
+    tentativo : int
+        Numero di controlli già eseguiti sullo shard (da 0)
+    config : dict
+        Configurazione con pausa_polling_minima, pausa_polling_secondi
+        e fattore_backoff_polling
 
-def polling_batch(client: anthropic.Anthropic, batch_id: str, config: dict) -> object:
+    Returns
+    -------
+    float
+        Secondi di attesa prima del prossimo controllo
     """
-    Esegue il polling del batch finché non è completato.
+    minima = config.get("pausa_polling_minima", 5)
+    massima = config.get("pausa_polling_secondi", 60)
+    fattore = config.get("fattore_backoff_polling", 1.5)
+    pausa = min(massima, minima * fattore ** tentativo)
+    return pausa * random.uniform(0.9, 1.1)
+
+
+async def polling_batch(
+    client: anthropic.AsyncAnthropic,
+    batch_ids: list,
+    config: dict,
+    al_completamento=None
+) -> list:
+    """
+    Esegue il polling asincrono di tutti gli shard finché non sono completati.
 
     Il Batches API elabora le richieste in modo asincrono: lo stato passa da
-    'in_progress' a 'ended' quando tutte le richieste sono state processate.
-    Lo script esegue un controllo periodico (ogni N secondi configurabili)
-    fino al completamento o al timeout.
+    'in_progress' a 'ended' quando tutte le richieste di uno shard sono state
+    processate, e solo allora i suoi risultati diventano scaricabili (l'API
+    non espone i risultati delle singole richieste prima della fine del
+    batch). Ogni shard viene quindi monitorato in modo indipendente, con
+    pausa adattiva (vedi calcola_pausa_polling), e appena termina viene
+    passato ad `al_completamento`: i risultati degli shard già conclusi
+    vengono raccolti senza attendere quelli più lenti.
 
     Parameters
     ----------
-    client : anthropic.Anthropic
-        Client Anthropic autenticato
-    batch_id : str
-        ID del batch da monitorare
+    client : anthropic.AsyncAnthropic
+        Client Anthropic asincrono autenticato
+    batch_ids : list
+        ID dei batch (shard) da monitorare
     config : dict
-        Configurazione con pausa_polling_secondi e max_tentativi_polling
+        Configurazione con parametri di polling e timeout_polling_secondi
+    al_completamento : callable, opzionale
+        Coroutine chiamata con l'oggetto batch di ogni shard terminato
 
     Returns
     -------
-    object
-        Oggetto batch finale restituito dall'API
+    list
+        Oggetti batch finali restituiti dall'API, nell'ordine di batch_ids
 
     Raises
     ------
     TimeoutError
-        Se il batch non si completa entro il numero massimo di tentativi
+        Se uno shard non si completa entro timeout_polling_secondi
+    """
+    # Timeout complessivo; il default riproduce il vecchio limite di
+    # max_tentativi_polling controlli a intervallo fisso
+    timeout = config.get(
+        "timeout_polling_secondi",
+        config.get("pausa_polling_secondi", 60) * config.get("max_tentativi_polling", 60)
+    )
+
+    logger.info(f"Inizio polling di {len(batch_ids)} shard (timeout {timeout / 60:.0f} minuti)...")
+
+    async def attendi_shard(batch_id: str):
+        inizio = time.monotonic()
+        tentativo = 0
+        while True:
+            # Recupera lo stato aggiornato dello shard
+            batch = await client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                return batch
+
+            if time.monotonic() - inizio > timeout:
+                raise TimeoutError(f"Lo shard '{batch_id}' non si è completato entro {timeout} secondi.")
+
+            # Estrae i conteggi di richieste nei diversi stati
+            conteggi = batch.request_counts
+            pausa = calcola_pausa_polling(tentativo, config)
+            logger.info(
+                f"Shard '{batch_id}' — Stato: {batch.processing_status} | "
+                f"In elaborazione: {conteggi.processing} | "
+                f"Completate: {conteggi.succeeded} | "
+                f"Errori: {conteggi.errored} | "
+                f"Prossimo controllo tra {pausa:.0f}s"
+            )
+            await asyncio.sleep(pausa)
+            tentativo += 1
+
+    tasks = [asyncio.create_task(attendi_shard(batch_id)) for batch_id in batch_ids]
+    terminati = {}
+    try:
+        for future in asyncio.as_completed(tasks):
+            batch = await future
+            terminati[batch.id] = batch
+            conteggi = batch.request_counts
+            logger.info(
+                f"Shard '{batch.id}' completato ({len(terminati)}/{len(batch_ids)}). "
+                f"Richieste riuscite: {conteggi.succeeded}/"
+                f"{conteggi.processing + conteggi.succeeded + conteggi.errored + conteggi.canceled + conteggi.expired}"
+            )
+            if al_completamento is not None:
+                await al_completamento(batch)
+    except TimeoutError as e:
+        # Se si supera il timeout, si interrompe il polling degli altri shard
+        raise TimeoutError(
+            f"{e}\nRiprendere con: python annotate_dil_claude_api.py --resume {' '.join(batch_ids)}"
+        ) from e
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    logger.info(f"Tutti gli shard completati ({len(batch_ids)}).")
+    return [terminati[batch_id] for batch_id in batch_ids]
+
+
+def contesto_righe(df: pd.DataFrame) -> tuple:
     """
-    pausa = config.get("pausa_polling_secondi", 60)
-    max_tentativi = config.get("max_tentativi_polling", 60)
+    Contesto di ogni riga per il log, calcolato una sola volta in forma
+    vettoriale: anteprima del testo, gold standard e annotazione precedente.
 
-    logger.info(f"Inizio polling del batch '{batch_id}'...")
-    logger.info(f"Controllo ogni {pausa}s per max {max_tentativi} tentativi ({max_tentativi * pausa / 60:.0f} minuti)")
+    Returns
+    -------
+    tuple
+        Tre array allineati per posizione con le righe di df
+    """
+    testi = df["text"].astype(str)
+    anteprime = testi.where(testi.str.len() <= 150, testi.str[:150] + "...").to_numpy()
+    return anteprime, df["DIL"].to_numpy(), df["DIL_Sonnet"].to_numpy()
 
-    for tentativo in range(1, max_tentativi + 1):
-        # Recupera lo stato aggiornato del batch
-        batch = client.messages.batches.retrieve(batch_id)
 
-        # Estrae i conteggi di richieste nei diversi stati
-        conteggi = batch.request_counts
-        logger.info(
-            f"[{tentativo}/{max_tentativi}] Stato: {batch.processing_status} | "
-            f"In elaborazione: {conteggi.processing} | "
-            f"Completate: {conteggi.succeeded} | "
-            f"Errori: {conteggi.errored}"
-        )
+def voce_da_messaggio(idx: int, messaggio, anteprima: str, gold, precedente) -> dict:
+    """
+    Costruisce l'entry di log da un messaggio riuscito del modello.
 
-        # Il batch è terminato quando lo stato è 'ended'
-        if batch.processing_status == "ended":
-            logger.info(f"Batch completato. Richieste riuscite: {conteggi.succeeded}/{conteggi.processing + conteggi.succeeded + conteggi.errored + conteggi.canceled + conteggi.expired}")
-            return batch
+    Parameters
+    ----------
+    idx : int
+        Indice della riga nel DataFrame
+    messaggio : anthropic.types.Message
+        Messaggio restituito dall'API
+    anteprima, gold, precedente
+        Contesto della riga (vedi contesto_righe)
 
-        # Attende prima del prossimo controllo
-        time.sleep(pausa)
+    Returns
+    -------
+    dict
+        Entry di log; decisione = 'parse_error' se la risposta non è un JSON
+        valido né riparabile, 'riparata' = True se è stata riparata
+    """
+    # Estrae il testo della risposta dal primo blocco di contenuto
+    testo_risposta = ""
+    for blocco in messaggio.content:
+        if blocco.type == "text":
+            testo_risposta = blocco.text
+            break
+
+    # Decodifica validata sullo schema: enum controllati e riparazione
+    # economica delle risposte troncate (es. max_tokens esaurito)
+    esito = DECODIFICATORE.decode(testo_risposta)
+
+    if not esito.valid:
+        # Il modello ha restituito una risposta non parsable o fuori schema.
+        # Questo non dovrebbe accadere con structured outputs,
+        # ma viene gestito per robustezza.
+        logger.warning(
+            f"Errore parsing risposta per riga {idx}: {esito.error}\n"
+            f"Risposta grezza: {testo_risposta[:200]}"
+        )
+        return {
+            "index": idx,
+            "timestamp": datetime.now().isoformat(),
+            "decisione": "parse_error",
+            "errore": esito.error,
+            "risposta_grezza": testo_risposta[:500]
+        }
 
-    # Se si supera il numero massimo di tentativi, solleva un errore
-    raise TimeoutError(
-        f"Il batch '{batch_id}' non si è completato entro {max_tentativi * pausa} secondi.\n"
-        f"Riprendere con: python annotate_dil_claude_api.py --resume {batch_id}"
-    )
+    risposta = esito.data
+    entry = {
+        "index": idx,
+        "timestamp": datetime.now().isoformat(),
+        "testo_anteprima": anteprima,
+        "decisione": risposta["dil"],
+        "confidenza": risposta["confidenza"],
+        "gold_standard": gold,
+        "annotazione_precedente": precedente,
+        "ragionamento": risposta["ragionamento"],
+        "marcatori": risposta["marcatori"],
+        "tokens_input": messaggio.usage.input_tokens,
+        "tokens_output": messaggio.usage.output_tokens
+    }
+    if esito.status == "repaired":
+        entry["riparata"] = True
+    return entry
 
 
-def raccogli_risultati(
-    client: anthropic.Anthropic,
-    batch_id: str,
-    df: pd.DataFrame,
-    config: dict
-) -> tuple[pd.DataFrame, list]:
+def unisci_risultati(df: pd.DataFrame, percorso_risultati: str, colonna_nuova: str) -> pd.DataFrame:
     """
-    Raccoglie e parser i risultati del batch completato.
+    Unisce al DataFrame le decisioni registrate nel file JSONL dei risultati.
 
-    Per ogni richiesta riuscita, estrae la risposta JSON del modello,
-    la valida, e assegna la decisione DIL alla riga corrispondente del DataFrame.
-    Le risposte fallite vengono segnalate e marchiate come 'error'.
+    Il join avviene in forma vettoriale sull'indice della riga (custom_id).
+    Il file viene letto a blocchi (iter_log_frames) e di ogni blocco si
+    tengono solo le colonne 'index' e 'decisione', ma ogni entry viene
+    comunque decodificata per intero, ragionamenti e marcatori compresi:
+    il costo cresce con il log, quindi la funzione va chiamata una volta
+    per run (alla ripresa o a fine annotazione), non dopo ogni shard.
+    In caso di voci duplicate per la stessa riga vale l'ultima scritta.
 
     Parameters
     ----------
-    client : anthropic.Anthropic
-        Client Anthropic autenticato
-    batch_id : str
-        ID del batch completato
     df : pd.DataFrame
         DataFrame originale (verrà modificato in-place)
-    config : dict
-        Configurazione con colonna_annotazione_nuova, ecc.
+    percorso_risultati : str
+        Log JSONL scritto da raccogli_risultati (tutti i segmenti, anche compressi)
+    colonna_nuova : str
+        Nome della colonna con le nuove annotazioni
 
     Returns
     -------
-    tuple[pd.DataFrame, list]
-        - DataFrame aggiornato con la nuova colonna di annotazioni
-        - Lista di entry di log con i ragionamenti
+    pd.DataFrame
+        DataFrame con la colonna delle decisioni aggiornata
     """
-    colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
-
-    # Inizializza la nuova colonna con un valore placeholder
     df[colonna_nuova] = "non_annotato"
+    blocchi = [blocco[["index", "decisione"]] for blocco in iter_log_frames(percorso_risultati)]
+    if not blocchi:
+        return df
 
-    log_ragionamenti = []    # Lista delle entry di log per tutti i trigrammi
-    n_riuscite = 0           # Contatore richieste riuscite
-    n_errori = 0             # Contatore richieste fallite
-    n_parse_error = 0        # Contatore errori di parsing del JSON
+    decisioni = pd.concat(blocchi, ignore_index=True)
+    decisioni = decisioni.drop_duplicates("index", keep="last").set_index("index")["decisione"]
 
-    logger.info(f"Raccolta risultati dal batch '{batch_id}'...")
+    df[colonna_nuova] = decisioni.reindex(df.index).fillna("non_annotato").to_numpy()
+    return df
 
-    # Itera sui risultati del batch. Ogni 'result' corrisponde a una richiesta.
-    for result in client.messages.batches.results(batch_id):
 
-        # Il custom_id è l'indice della riga nel DataFrame originale
-        idx = int(result.custom_id)
+async def raccogli_risultati(
+    client: anthropic.AsyncAnthropic,
+    batch_ids: list,
+    df: pd.DataFrame,
+    config: dict,
+    append: bool = False,
+    al_termine_shard: Optional[Callable[[str, dict], None]] = None
+) -> pd.DataFrame:
+    """
+    Attende gli shard e ne raccoglie i risultati man mano che terminano.
+
+    Per ogni richiesta riuscita, estrae la risposta JSON del modello e la
+    valida; le risposte fallite vengono segnalate e marchiate come 'error'.
+    Ogni esito viene scritto subito, in append, nel log dei ragionamenti
+    (JSONL): la memoria occupata resta costante qualunque sia la dimensione
+    del batch e il DataFrame non viene toccato riga per riga. Dopo ogni
+    shard raccolto le sue decisioni, tenute in memoria, vengono assegnate
+    al DataFrame in un'unica operazione vettoriale e il CSV di output viene
+    salvato, così uno shard lento non ritarda il resto dei risultati; il
+    log non viene riletto.
 
-        if result.result.type == "succeeded":
-            # La richiesta è stata elaborata correttamente
-            n_riuscite += 1
-            messaggio = result.result.message
+    Parameters
+    ----------
+    client : anthropic.AsyncAnthropic
+        Client Anthropic asincrono autenticato
+    batch_ids : list
+        ID dei batch (shard) da attendere e raccogliere
+    df : pd.DataFrame
+        DataFrame originale (verrà modificato in-place)
+    config : dict
+        Configurazione con colonna_annotazione_nuova, percorso_log_ragionamenti, ecc.
+    append : bool
+        Se True aggiunge al log dei risultati invece di ricrearlo (run a più
+        round); la colonna delle annotazioni di df deve già riflettere il
+        log (vedi esegui_batch_con_manifest)
+    al_termine_shard : callable, opzionale
+        Chiamata dopo ogni shard raccolto con l'ID del batch e gli esiti
+        {indice: (decisione, tipo_errore)}; usata per aggiornare il manifest
 
-            # Estrae il testo della risposta dal primo blocco di contenuto
-            testo_risposta = ""
-            for blocco in messaggio.content:
-                if blocco.type == "text":
-                    testo_risposta = blocco.text
-                    break
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame aggiornato con la nuova colonna di annotazioni
 
-            # Parsa la risposta JSON del modello
-            try:
-                risposta_json = json.loads(testo_risposta)
+    Raises
+    ------
+    TimeoutError
+        Se uno shard non si completa entro il timeout di polling
+    """
+    colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
+    percorso_output = config.get("percorso_output", "corpus_labelled-trigrams_500_Claude_API_annotated.csv")
+    percorso_risultati = config.get("percorso_log_ragionamenti", "DIL_API_reasoning_log.jsonl")
 
-                # Estrae i campi dalla risposta strutturata
-                decisione = risposta_json.get("dil", "error")
-                confidenza = risposta_json.get("confidenza", "sconosciuta")
-                ragionamento = risposta_json.get("ragionamento", "")
-                marcatori = risposta_json.get("marcatori", [])
+    anteprime, gold, precedenti = contesto_righe(df)
 
-                # Assegna la decisione al DataFrame
-                df.at[idx, colonna_nuova] = decisione
+    # Contatori: richieste riuscite, fallite, con errori di parsing del JSON
+    contatori = {"riuscite": 0, "errori": 0, "parse_error": 0}
 
-                # Prepara l'entry di log per questo trigramma
+    # Con --resume il log viene ricreato: gli shard vengono comunque
+    # raccolti di nuovo per intero. I run guidati dal manifest aggiungono.
+    sink = apri_log_ragionamenti(config, append=append)
+    if not append:
+        df[colonna_nuova] = "non_annotato"
+    elif colonna_nuova not in df.columns:
+        unisci_risultati(df, percorso_risultati, colonna_nuova)
+
+    async def raccogli_shard(batch):
+        logger.info(f"Raccolta risultati dallo shard '{batch.id}'...")
+        esiti = {}
+
+        # Itera sui risultati dello shard. Ogni 'result' corrisponde a una
+        # richiesta; i custom_id sono univoci sull'intero dataset.
+        async for result in await client.messages.batches.results(batch.id):
+
+            # Il custom_id è l'indice della riga nel DataFrame originale
+            idx = int(result.custom_id)
+            pos = df.index.get_loc(idx)
+
+            if result.result.type == "succeeded":
+                # La richiesta è stata elaborata correttamente
+                contatori["riuscite"] += 1
+                entry_log = voce_da_messaggio(
+                    idx, result.result.message, anteprime[pos], gold[pos], precedenti[pos]
+                )
+                if entry_log["decisione"] == "parse_error":
+                    contatori["parse_error"] += 1
+
+            elif result.result.type == "errored":
+                # La richiesta è fallita per un errore API
+                contatori["errori"] += 1
+                # result.error è l'ErrorResponse; il tipo è nell'errore annidato
+                tipo_errore = result.result.error.error.type
+                logger.warning(f"Richiesta fallita per riga {idx}: tipo errore = {tipo_errore}")
+
+                # Gli errori di tipo 'invalid_request' non devono essere riprovati,
+                # quelli di tipo 'server_error' sì.
                 entry_log = {
                     "index": idx,
                     "timestamp": datetime.now().isoformat(),
-                    "testo_anteprima": str(df.at[idx, "text"])[:150] + "..." if len(str(df.at[idx, "text"])) > 150 else str(df.at[idx, "text"]),
-                    "decisione": decisione,
-                    "confidenza": confidenza,
-                    "gold_standard": df.at[idx, "DIL"],
-                    "annotazione_precedente": df.at[idx, "DIL_Sonnet"],
-                    "ragionamento": ragionamento,
-                    "marcatori": marcatori,
-                    "tokens_input": messaggio.usage.input_tokens,
-                    "tokens_output": messaggio.usage.output_tokens
+                    "decisione": "api_error",
+                    "tipo_errore": tipo_errore
                 }
 
-            except (json.JSONDecodeError, KeyError, AttributeError) as e:
-                # Il modello ha restituito una risposta non parsable.
-                # Questo non dovrebbe accadere con structured outputs,
-                # ma viene gestito per robustezza.
-                logger.warning(
-                    f"Errore parsing risposta per riga {idx}: {e}\n"
-                    f"Risposta grezza: {testo_risposta[:200]}"
-                )
-                n_parse_error += 1
-                df.at[idx, colonna_nuova] = "parse_error"
+            elif result.result.type == "expired":
+                # La richiesta è scaduta (il batch ha superato le 24 ore)
+                logger.warning(f"Richiesta scaduta per riga {idx}")
                 entry_log = {
                     "index": idx,
                     "timestamp": datetime.now().isoformat(),
-                    "decisione": "parse_error",
-                    "errore": str(e),
-                    "risposta_grezza": testo_risposta[:500]
+                    "decisione": "expired"
                 }
 
-            log_ragionamenti.append(entry_log)
-
-        elif result.result.type == "errored":
-            # La richiesta è fallita per un errore API
-            n_errori += 1
-            tipo_errore = result.result.error.type
-            logger.warning(f"Richiesta fallita per riga {idx}: tipo errore = {tipo_errore}")
-
-            # Gli errori di tipo 'invalid_request' non devono essere riprovati,
-            # quelli di tipo 'server_error' sì.
-            df.at[idx, colonna_nuova] = "api_error"
-            log_ragionamenti.append({
-                "index": idx,
-                "timestamp": datetime.now().isoformat(),
-                "decisione": "api_error",
-                "tipo_errore": tipo_errore
-            })
+            else:
+                continue
+
+            sink.write(entry_log)
+            esiti[idx] = (entry_log["decisione"], entry_log.get("tipo_errore"))
 
-        elif result.result.type == "expired":
-            # La richiesta è scaduta (il batch ha superato le 24 ore)
-            logger.warning(f"Richiesta scaduta per riga {idx}")
-            df.at[idx, colonna_nuova] = "expired"
+        # Salvataggio parziale: le righe degli shard ancora in corso
+        # restano 'non_annotato'
+        sink.flush()
+        if esiti:
+            df.loc[list(esiti), colonna_nuova] = [decisione for decisione, _ in esiti.values()]
+        df.to_csv(percorso_output, index=False, encoding="utf-8")
+        logger.info(f"Risultati parziali salvati in '{percorso_output}'")
+        if al_termine_shard is not None:
+            al_termine_shard(batch.id, esiti)
+
+    try:
+        await polling_batch(client, batch_ids, config, al_completamento=raccogli_shard)
+    finally:
+        sink.close()
 
     logger.info(
-        f"Raccolta completata: {n_riuscite} riuscite, "
-        f"{n_errori} errori API, {n_parse_error} errori di parsing"
+        f"Raccolta completata: {contatori['riuscite']} riuscite, "
+        f"{contatori['errori']} errori API, {contatori['parse_error']} errori di parsing"
     )
+    logger.info(f"Log ragionamenti scritto in '{percorso_risultati}'")
 
-    return df, log_ragionamenti
+    return df
 
 
-def salva_log_ragionamenti(log_ragionamenti: list, percorso_log: str):
+def nuovo_manifest(df: pd.DataFrame, config: dict) -> dict:
+    """
+    Crea il manifest di un run batch: una voce per riga (custom_id) con
+    stato, numero di invii ed esito di ogni tentativo.
+
+    Stati di una riga:
+      - 'in_attesa'    : mai inviata
+      - 'inviata'      : in uno shard non ancora raccolto
+      - 'riuscita'     : decisione valida (yes/no)
+      - 'da_ritentare' : errore ritentabile, scaduta o risposta non parsable
+      - 'fallita'      : richiesta non valida o tentativi esauriti
     """
-    Salva il log dei ragionamenti in formato JSONL (JSON Lines).
+    return {
+        "creato": datetime.now().isoformat(),
+        "percorso_input": config.get("percorso_input"),
+        "modello": config.get("modello"),
+        "n_righe": len(df),
+        "stato": "in_corso",
+        "round": 0,
+        "batch": [],
+        "righe": {
+            str(idx): {"stato": "in_attesa", "tentativi": 0, "esiti": []}
+            for idx in df.index
+        },
+    }
+
+
+def carica_manifest(percorso_manifest: str) -> Optional[dict]:
+    """Carica il manifest se esiste, altrimenti None."""
+    if not Path(percorso_manifest).exists():
+        return None
+    with open(percorso_manifest, "rb") as f:
+        return json_loads(f.read())
+
+
+def salva_manifest(manifest: dict, percorso_manifest: str):
+    """
+    Salva il manifest in modo atomico (file temporaneo + rename): un'interruzione
+    durante la scrittura lascia intatta la versione precedente.
+    """
+    manifest["aggiornato"] = datetime.now().isoformat()
+    temporaneo = f"{percorso_manifest}.tmp"
+    with open(temporaneo, "wb") as f:
+        f.write(json_dumps(manifest))
+    os.replace(temporaneo, percorso_manifest)
+
+
+def stato_da_esito(decisione: str, tipo_errore: Optional[str]) -> str:
+    """Stato del manifest corrispondente all'esito di una richiesta."""
+    if decisione in ("yes", "no"):
+        return "riuscita"
+    # Una richiesta non valida fallirebbe identica a ogni nuovo invio
+    if decisione == "api_error" and tipo_errore == "invalid_request_error":
+        return "fallita"
+    return "da_ritentare"
+
+
+def righe_da_inviare(manifest: dict, max_tentativi: int) -> list:
+    """
+    Indici delle righe da includere nel prossimo batch: mai inviate o da
+    ritentare con tentativi residui. Le righe che hanno esaurito i
+    tentativi passano a 'fallita'.
+    """
+    da_inviare = []
+    for custom_id, voce in manifest["righe"].items():
+        if voce["stato"] == "in_attesa":
+            da_inviare.append(int(custom_id))
+        elif voce["stato"] == "da_ritentare":
+            if voce["tentativi"] < max_tentativi:
+                da_inviare.append(int(custom_id))
+            else:
+                voce["stato"] = "fallita"
+    return da_inviare
+
 
-    Il formato JSONL (una entry JSON per riga) è preferito per file di log
-    grandi perché permette lettura incrementale senza caricare tutto in memoria.
+def riepilogo_manifest(manifest: dict) -> dict:
+    """Conteggio delle righe per stato."""
+    conteggi = {}
+    for voce in manifest["righe"].values():
+        conteggi[voce["stato"]] = conteggi.get(voce["stato"], 0) + 1
+    return conteggi
+
+
+def esegui_batch_con_manifest(
+    client: anthropic.Anthropic,
+    crea_client_async,
+    df: pd.DataFrame,
+    config: dict,
+    ricomincia: bool = False
+) -> pd.DataFrame:
+    """
+    Esegue l'annotazione batch a round successivi guidata dal manifest.
+
+    Ogni round invia (in shard) solo le righe ancora da annotare, attende gli
+    shard e ne raccoglie i risultati; le righe con esito errored ritentabile,
+    expired o parse_error vengono reinviate automaticamente nel round
+    successivo, fino a convergenza o a max_round_batch invii per riga.
+
+    Il manifest viene salvato dopo la creazione di ogni shard e dopo ogni
+    shard raccolto: se lo script viene interrotto, anche durante l'invio,
+    rilanciarlo riprende il polling degli shard già creati e prosegue con
+    le righe non ancora inviate e i round mancanti, senza reinviare le
+    righe già concluse.
 
     Parameters
     ----------
-    log_ragionamenti : list
-        Lista di dizionari con i ragionamenti
-    percorso_log : str
-        Percorso del file di output .jsonl
+    client : anthropic.Anthropic
+        Client sincrono (invio degli shard)
+    crea_client_async : callable
+        Restituisce un nuovo anthropic.AsyncAnthropic (uno per round)
+    df : pd.DataFrame
+        Dataset completo
+    config : dict
+        Configurazione con percorso_manifest, max_round_batch, ecc.
+    ricomincia : bool
+        Se True ignora un manifest incompleto e avvia un nuovo run
+
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame con la colonna delle nuove annotazioni
     """
-    with open(percorso_log, "w", encoding="utf-8") as f:
-        for entry in log_ragionamenti:
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    percorso_manifest = config.get("percorso_manifest", "DIL_API_batch_manifest.json")
+    percorso_risultati = config.get("percorso_log_ragionamenti", "DIL_API_reasoning_log.jsonl")
+    colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
+    max_tentativi = config.get("max_round_batch", 3)
+
+    manifest = carica_manifest(percorso_manifest)
+    if manifest is not None and manifest["stato"] == "in_corso" and not ricomincia:
+        if manifest["n_righe"] != len(df) or manifest["percorso_input"] != config.get("percorso_input"):
+            raise ValueError(
+                f"Il manifest '{percorso_manifest}' si riferisce a un altro dataset "
+                f"({manifest['percorso_input']}, {manifest['n_righe']} righe). "
+                "Usare --ricomincia per avviare un nuovo run."
+            )
+        logger.info(f"Ripresa del run dal manifest '{percorso_manifest}': {riepilogo_manifest(manifest)}")
+    else:
+        manifest = nuovo_manifest(df, config)
+        salva_manifest(manifest, percorso_manifest)
+        # Nuovo run: il log dei risultati ricomincia da zero, poi i round
+        # successivi e le riprese vi aggiungono in append
+        apri_log_ragionamenti(config).close()
+
+    righe = manifest["righe"]
+
+    # Decisioni dei round precedenti (ripresa): unico join sul log, poi
+    # ogni shard raccolto aggiorna solo le proprie righe
+    df = unisci_risultati(df, percorso_risultati, colonna_nuova)
+
+    def al_creazione_shard(batch_id: str, richieste_shard: list):
+        # Salvato subito: un batch non registrato verrebbe reinviato alla ripresa
+        manifest["batch"].append({"id": batch_id, "round": manifest["round"], "stato": "inviato"})
+        for richiesta in richieste_shard:
+            voce = righe[richiesta["custom_id"]]
+            voce["stato"] = "inviata"
+            voce["tentativi"] += 1
+        salva_manifest(manifest, percorso_manifest)
+
+    def al_termine_shard(batch_id: str, esiti: dict):
+        for idx, (decisione, tipo_errore) in esiti.items():
+            voce = righe[str(idx)]
+            voce["stato"] = stato_da_esito(decisione, tipo_errore)
+            voce["esiti"].append(decisione if tipo_errore is None else f"{decisione}:{tipo_errore}")
+        for batch in manifest["batch"]:
+            if batch["id"] == batch_id:
+                batch["stato"] = "raccolto"
+        salva_manifest(manifest, percorso_manifest)
+
+    while True:
+        aperti = [b["id"] for b in manifest["batch"] if b["stato"] == "inviato"]
+
+        if not aperti:
+            da_inviare = righe_da_inviare(manifest, max_tentativi)
+            if not da_inviare:
+                break
+            manifest["round"] += 1
+            logger.info(f"Round {manifest['round']}: invio di {len(da_inviare)} righe")
+
+            richieste = prepara_richieste_batch(df.loc[da_inviare], config)
+            aperti = invia_batch(client, richieste, config, al_creazione_shard=al_creazione_shard)
+
+        async def attendi_e_raccogli():
+            async with crea_client_async() as client_async:
+                return await raccogli_risultati(
+                    client_async, aperti, df, config,
+                    append=True, al_termine_shard=al_termine_shard
+                )
+
+        df = asyncio.run(attendi_e_raccogli())
+
+        # Righe inviate ma assenti dai risultati degli shard raccolti
+        for voce in righe.values():
+            if voce["stato"] == "inviata":
+                voce["stato"] = "da_ritentare"
+                voce["esiti"].append("mancante")
+        salva_manifest(manifest, percorso_manifest)
+        logger.info(f"Fine round {manifest['round']}: {riepilogo_manifest(manifest)}")
+
+    manifest["stato"] = "completato"
+    salva_manifest(manifest, percorso_manifest)
+    logger.info(
+        f"Run convergente dopo {manifest['round']} round: {riepilogo_manifest(manifest)} "
+        f"(manifest: '{percorso_manifest}')"
+    )
+    return df
+
+
+def apri_log_ragionamenti(config: dict, append: bool = False) -> ReasoningLogWriter:
+    """
+    Apre il log dei ragionamenti in JSONL per la scrittura in streaming.
+
+    Ogni entry va su disco appena prodotta (nessuna lista in memoria),
+    con rotazione a dimensione e compressione opzionali e un indice per la
+    ricerca rapida di una riga (vedi dil_reasoning_log.py).
+
+    Parameters
+    ----------
+    config : dict
+        Configurazione con percorso_log_ragionamenti, compressione_log,
+        max_mb_log, righe_per_blocco_log
+    append : bool
+        Se True prosegue un log esistente invece di ricrearlo
 
-    logger.info(f"Log ragionamenti salvato in '{percorso_log}' ({len(log_ragionamenti)} entries)")
+    Returns
+    -------
+    ReasoningLogWriter
+        Scrittore da usare come context manager
+    """
+    return ReasoningLogWriter(
+        config.get("percorso_log_ragionamenti", "DIL_API_reasoning_log.jsonl"),
+        compression=config.get("compressione_log"),
+        max_bytes=int(config.get("max_mb_log", 0) * 1024 * 1024),
+        block_entries=config.get("righe_per_blocco_log", 256),
+        append=append,
+    )
 
 
 # ===========================================================================
@@ -741,6 +1411,8 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
       - Confusion matrix (TP, TN, FP, FN)
       - Tasso di accordo inter-annotatore
       - Cohen's Kappa vs annotazione precedente
+      - Kappa di Fleiss, alfa di Krippendorff e kappa a coppie tra tutte
+        le colonne DIL* presenti
 
     Parameters
     ----------
@@ -759,10 +1431,13 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
     n_valide = len(df_valido)
     n_totale = len(df)
 
-    # Vettori di labels per le metriche
-    y_gold = df_valido["DIL"].values
-    y_nuova = df_valido[colonna_nuova].values
-    y_v1 = df_valido["DIL_Sonnet"].values
+    # Una sola codifica per gold, nuova annotazione e Sonnet v1: le metriche
+    # di tutte le coppie vengono dalla stessa matrice di confusione
+    colonne = ["DIL", colonna_nuova, "DIL_Sonnet"]
+    codici = encode_columns(df_valido, colonne)
+    conteggi = pairwise_confusion(codici)
+    m = metrics_from_counts(*(conteggi[k] for k in COUNT_KEYS))
+    GOLD, NUOVA, V1 = range(len(colonne))
 
     print("\n" + "=" * 70)
     print(f"METRICHE DI VALUTAZIONE — {colonna_nuova}")
@@ -775,11 +1450,8 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
     print("\n[1] PERFORMANCE VS GOLD STANDARD (Annotatori Umani)")
     print("─" * 70)
 
-    acc = accuracy_score(y_gold, y_nuova)
-    prec, rec, f1, _ = precision_recall_fscore_support(
-        y_gold, y_nuova, pos_label="yes", average="binary", zero_division=0
-    )
-    cm = confusion_matrix(y_gold, y_nuova, labels=["no", "yes"])
+    acc, prec, rec, f1 = (m[k][GOLD, NUOVA] for k in ("accuracy", "precision", "recall", "f1_score"))
+    cm = [[m["tn"][GOLD, NUOVA], m["fp"][GOLD, NUOVA]], [m["fn"][GOLD, NUOVA], m["tp"][GOLD, NUOVA]]]
 
     print(f"\n  Accuracy:  {acc:.2%}")
     print(f"  Precision: {prec:.2%}")
@@ -788,14 +1460,11 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
 
     print(f"\n  Confusion Matrix:")
     print(f"              Pred NO   Pred YES")
-    print(f"  Gold NO   {cm[0,0]:>8}  {cm[0,1]:>8}   (TN={cm[0,0]}, FP={cm[0,1]})")
-    print(f"  Gold YES  {cm[1,0]:>8}  {cm[1,1]:>8}   (FN={cm[1,0]}, TP={cm[1,1]})")
+    print(f"  Gold NO   {cm[0][0]:>8}  {cm[0][1]:>8}   (TN={cm[0][0]}, FP={cm[0][1]})")
+    print(f"  Gold YES  {cm[1][0]:>8}  {cm[1][1]:>8}   (FN={cm[1][0]}, TP={cm[1][1]})")
 
     # Confronto con Sonnet v1
-    acc_v1 = accuracy_score(y_gold, y_v1)
-    prec_v1, rec_v1, f1_v1, _ = precision_recall_fscore_support(
-        y_gold, y_v1, pos_label="yes", average="binary", zero_division=0
-    )
+    acc_v1, prec_v1, rec_v1, f1_v1 = (m[k][GOLD, V1] for k in ("accuracy", "precision", "recall", "f1_score"))
 
     print(f"\n  Confronto con Sonnet v1:")
     print(f"  {'Metrica':<12} {'API (nuova)':<15} {'v1 (prec.)':<15} {'Δ':<10}")
@@ -811,9 +1480,9 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
     print(f"\n[2] INTER-ANNOTATOR AGREEMENT ({colonna_nuova} vs DIL_Sonnet)")
     print("─" * 70)
 
-    accordo = (df_valido[colonna_nuova] == df_valido["DIL_Sonnet"]).sum()
+    accordo = m["tp"][V1, NUOVA] + m["tn"][V1, NUOVA]
     tasso_accordo = accordo / n_valide
-    kappa = cohen_kappa_score(y_v1, y_nuova)
+    kappa = m["kappa"][V1, NUOVA]
 
     print(f"\n  Tasso di accordo: {accordo}/{n_valide} ({tasso_accordo:.2%})")
     print(f"  Cohen's Kappa:    {kappa:.3f}")
@@ -831,9 +1500,7 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
     print(f"\n[3] DISTRIBUZIONE DELLE ANNOTAZIONI")
     print("─" * 70)
 
-    gold_yes = (y_gold == "yes").sum()
-    nuova_yes = (y_nuova == "yes").sum()
-    v1_yes = (y_v1 == "yes").sum()
+    gold_yes, nuova_yes, v1_yes = (codici == 1).sum(axis=0)
 
     print(f"\n  {'Annotatore':<25} {'DIL=yes':<15} {'DIL=no':<15} {'Bias vs Gold'}")
     print(f"  {'─'*65}")
@@ -841,6 +1508,28 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
     print(f"  {colonna_nuova:<25} {nuova_yes:<15} {n_valide-nuova_yes:<15} {(nuova_yes-gold_yes)/n_valide*100:+.1f}%")
     print(f"  {'DIL_Sonnet (prec.)':<25} {v1_yes:<15} {n_valide-v1_yes:<15} {(v1_yes-gold_yes)/n_valide*100:+.1f}%")
 
+    # -----------------------------------------------------------------------
+    # 4. ACCORDO DEL PANNELLO
+    # -----------------------------------------------------------------------
+    pannello = annotator_columns(df_valido)
+    valutazioni = Ratings.from_columns(df_valido, pannello)
+    # Una colonna che ripete un altro annotatore gonfierebbe Fleiss e Krippendorff
+    duplicati = duplicate_raters(valutazioni)
+    if duplicati:
+        pannello = [c for c in pannello if c not in duplicati]
+        valutazioni = Ratings.from_columns(df_valido, pannello)
+    print(f"\n[4] ACCORDO DEL PANNELLO ({len(pannello)} annotatori)")
+    print("─" * 70)
+    for duplicato, tenuto in duplicati.items():
+        print(f"  {duplicato} identica a {tenuto}: esclusa dal pannello")
+    accordo_pannello = panel_agreement(valutazioni)
+    print(f"\n  Kappa di Fleiss:      {accordo_pannello['fleiss_kappa']:.3f}")
+    print(f"  Alfa di Krippendorff: {accordo_pannello['krippendorff_alpha']:.3f}")
+    print(f"\n  Kappa di Cohen a coppie:")
+    with pd.option_context("display.width", 200, "display.float_format", "{:.3f}".format):
+        for riga in pairwise_kappa(valutazioni)["kappa"].to_string().splitlines():
+            print(f"  {riga}")
+
     print("\n" + "=" * 70 + "\n")
 
 
@@ -848,11 +1537,26 @@ def calcola_metriche(df: pd.DataFrame, colonna_nuova: str):
 # SEZIONE 4: MODALITÀ SEQUENZIALE (ALTERNATIVA AL BATCH)
 # ===========================================================================
 
+def metriche_progressive(gold: pd.Series, decisioni: pd.Series) -> StreamingMetrics:
+    """
+    Accumulatore delle metriche vs gold, inizializzato con le righe già
+    annotate (yes/no) di un run ripreso.
+
+    Durante l'annotazione viene aggiornato a ogni riga completata: accuracy,
+    F1 e kappa con intervalli al 95% compaiono nei messaggi di avanzamento e
+    alimentano l'arresto anticipato (arresto_anticipato_kappa).
+    """
+    metriche = StreamingMetrics()
+    fatte = decisioni.isin(["yes", "no"])
+    metriche.update_many(gold[fatte], decisioni[fatte])
+    return metriche
+
+
 def annota_sequenziale(
     client: anthropic.Anthropic,
     df: pd.DataFrame,
     config: dict
-) -> tuple[pd.DataFrame, list]:
+) -> pd.DataFrame:
     """
     Annota i trigrammi con chiamate API sequenziali (alternativa al Batches API).
 
@@ -863,7 +1567,10 @@ def annota_sequenziale(
       - Debuggare problemi su singole richieste
 
     Il salvataggio avviene ogni 50 trigrammi per prevenire perdita di dati
-    in caso di interruzione.
+    in caso di interruzione. Ogni checkpoint_csv_ogni righe vengono
+    registrate le metriche progressive vs gold; con arresto_anticipato_kappa
+    l'annotazione si interrompe appena l'intervallo della kappa è tutto
+    sotto la soglia.
 
     Parameters
     ----------
@@ -876,116 +1583,916 @@ def annota_sequenziale(
 
     Returns
     -------
-    tuple[pd.DataFrame, list]
-        - DataFrame aggiornato
-        - Lista dei log dei ragionamenti
+    pd.DataFrame
+        DataFrame aggiornato (il log dei ragionamenti è scritto in streaming)
     """
     colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
-    modello = config.get("modello", "claude-opus-4-6")
-    max_tokens = config.get("max_tokens", 512)
     percorso_output = config.get("percorso_output", "output_annotato.csv")
-    usa_thinking = config.get("usa_thinking_adattivo", False)
 
     if colonna_nuova not in df.columns:
         df[colonna_nuova] = "non_annotato"
 
-    log_ragionamenti = []
+    # Parametri comuni e prompt di tutte le righe costruiti una sola volta
+    params_base = costruisci_parametri_base(config)
+    prompts = costruisci_prompt_vettoriale(df)
+
+    # Metriche progressive vs gold e regola di arresto anticipato
+    metriche = metriche_progressive(df["DIL"], df[colonna_nuova])
+    soglia_kappa = config.get("arresto_anticipato_kappa")
+    min_righe = config.get("arresto_anticipato_min_righe", 100)
+    ogni_n_metriche = config.get("checkpoint_csv_ogni", 50)
+    completate = 0
 
     logger.info(f"Avvio annotazione sequenziale di {len(df)} trigrammi...")
 
-    for idx, riga in df.iterrows():
-        # Salta le righe già annotate (utile per riprendere da un'interruzione)
-        if df.at[idx, colonna_nuova] not in ["non_annotato", "", None]:
-            continue
+    # Il log dei ragionamenti è scritto in streaming, entry per entry
+    salva = config.get("salva_ragionamento", True)
+    with (apri_log_ragionamenti(config) if salva else nullcontext()) as log:
+        for idx, prompt_utente, riga in zip(df.index, prompts, df.to_dict("records")):
+            # Salta le righe già annotate (utile per riprendere da un'interruzione)
+            if df.at[idx, colonna_nuova] not in ["non_annotato", "", None]:
+                continue
 
-        prompt_utente = costruisci_prompt_utente(riga)
+            # Costruisce i parametri della richiesta
+            params = {**params_base, "messages": [{"role": "user", "content": prompt_utente}]}
 
-        # Costruisce i parametri della richiesta
-        params = {
-            "model": modello,
-            "max_tokens": max_tokens,
-            "system": SYSTEM_PROMPT,
-            "messages": [{"role": "user", "content": prompt_utente}],
-            "output_config": {
-                "format": costruisci_schema_output()
-            }
-        }
+            try:
+                # Usa lo streaming per prevenire timeout su risposte lunghe
+                # e ottiene il messaggio completo con get_final_message()
+                with client.messages.stream(**params) as stream:
+                    messaggio = stream.get_final_message()
+
+                # Decodifica e valida la risposta (con riparazione se troncata)
+                entry = voce_da_messaggio(
+                    idx, messaggio, str(riga["text"])[:150], riga["DIL"], riga["DIL_Sonnet"]
+                )
+                decisione = entry["decisione"]
+                df.at[idx, colonna_nuova] = decisione
+
+                if log is not None:
+                    log.write(entry)
+
+                # Feedback progressivo su console
+                simbolo = "✓" if decisione == riga["DIL"] else "✗"
+                logger.info(f"[{idx+1}/{len(df)}] {simbolo} DIL={decisione} (gold={riga['DIL']}) — {str(riga['author'])[:25]}")
+
+                metriche.update(riga["DIL"], decisione)
+                completate += 1
+                if completate % ogni_n_metriche == 0:
+                    logger.info(f"Metriche progressive: {metriche.summary()}")
+                if metriche.should_stop(soglia_kappa, min_righe):
+                    logger.warning(
+                        f"Arresto anticipato: kappa vs gold sotto {soglia_kappa} (intervallo al 95%) — "
+                        f"{metriche.summary()}. Le righe mancanti restano 'non_annotato'."
+                    )
+                    break
+
+            except anthropic.RateLimitError:
+                # Rate limit raggiunto: attende 60 secondi prima di riprovare
+                logger.warning(f"Rate limit raggiunto alla riga {idx}. Attesa 60 secondi...")
+                time.sleep(60)
+                # Ridecrementa per riprovare questa riga al prossimo ciclo
+                # (pandas itera una volta sola, quindi gestiamo con una seconda iterazione)
+                df.at[idx, colonna_nuova] = "non_annotato"
+
+            except anthropic.APIStatusError as e:
+                if e.status_code >= 500:
+                    # Errore server: riprova dopo una breve pausa
+                    logger.warning(f"Errore server alla riga {idx} (HTTP {e.status_code}). Pausa 30s...")
+                    time.sleep(30)
+                else:
+                    # Errore client (4xx): non riprovare
+                    logger.error(f"Errore client alla riga {idx}: {e.message}")
+                    df.at[idx, colonna_nuova] = "api_error"
+
+            # Salva il CSV ogni 50 trigrammi per prevenire perdita di dati
+            if (idx + 1) % 50 == 0:
+                df.to_csv(percorso_output, index=False, encoding="utf-8")
+                logger.info(f"Checkpoint: salvate {idx+1} annotazioni in '{percorso_output}'")
+
+    # Salvataggio finale
+    df.to_csv(percorso_output, index=False, encoding="utf-8")
+    logger.info(f"Annotazione sequenziale completata. File salvato: '{percorso_output}'")
+    logger.info(f"Metriche progressive: {metriche.summary()}")
+
+    return df
+
+
+# ===========================================================================
+# SEZIONE 5: MODALITÀ CONCORRENTE IN TEMPO REALE
+# ===========================================================================
+
+# Esiti ritentabili: rate limit (429), sovraccarico (529), errori server (5xx)
+# ed errori di connessione/timeout. Gli altri 4xx sono definitivi.
+ERRORI_RITENTABILI = (anthropic.RateLimitError, anthropic.APIConnectionError)
 
-        if usa_thinking and "opus-4-6" in modello:
-            params["thinking"] = {"type": "adaptive"}
-            params["max_tokens"] = max(max_tokens, 4096)
 
+def righe_gia_annotate(percorso_log: str) -> set:
+    """
+    Indici delle righe con decisione valida ('yes'/'no') nel log JSONL.
+
+    In modalità concorrente il log dei ragionamenti funge da checkpoint:
+    ogni riga viene aggiunta appena annotata, quindi un'esecuzione
+    interrotta riprende dalle sole righe mancanti.
+    """
+    fatte = set()
+    for blocco in iter_log_frames(percorso_log):
+        if "decisione" in blocco.columns:
+            valide = blocco[blocco["decisione"].isin(["yes", "no"])]
+            fatte.update(valide["index"].astype(int).tolist())
+    return fatte
+
+
+def attesa_ritentativo(errore: Exception, tentativo: int, config: dict) -> float:
+    """
+    Secondi di attesa prima di ritentare una riga.
+
+    Usa l'header retry-after se il server lo indica, altrimenti un backoff
+    esponenziale con jitter (stessi parametri del polling batch).
+    """
+    risposta = getattr(errore, "response", None)
+    if risposta is not None:
         try:
-            # Usa lo streaming per prevenire timeout su risposte lunghe
-            # e ottiene il messaggio completo con get_final_message()
-            with client.messages.stream(**params) as stream:
-                messaggio = stream.get_final_message()
-
-            # Estrae e parsa il testo della risposta
-            testo_risposta = messaggio.content[0].text
-            risposta_json = json.loads(testo_risposta)
-
-            decisione = risposta_json.get("dil", "error")
-            confidenza = risposta_json.get("confidenza", "sconosciuta")
-            ragionamento = risposta_json.get("ragionamento", "")
-            marcatori = risposta_json.get("marcatori", [])
-
-            df.at[idx, colonna_nuova] = decisione
-
-            log_ragionamenti.append({
-                "index": idx,
-                "timestamp": datetime.now().isoformat(),
-                "testo_anteprima": str(riga["text"])[:150],
-                "decisione": decisione,
-                "confidenza": confidenza,
-                "gold_standard": riga["DIL"],
-                "annotazione_precedente": riga["DIL_Sonnet"],
-                "ragionamento": ragionamento,
-                "marcatori": marcatori,
-                "tokens_input": messaggio.usage.input_tokens,
-                "tokens_output": messaggio.usage.output_tokens
-            })
+            return float(risposta.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    base = config.get("pausa_ritentativo_minima", 2)
+    massimo = config.get("pausa_ritentativo_massima", 60)
+    return min(massimo, base * 2 ** tentativo) * random.uniform(0.9, 1.1)
 
-            # Feedback progressivo su console
-            simbolo = "✓" if decisione == riga["DIL"] else "✗"
-            logger.info(f"[{idx+1}/{len(df)}] {simbolo} DIL={decisione} (gold={riga['DIL']}) — {str(riga['author'])[:25]}")
-
-        except anthropic.RateLimitError:
-            # Rate limit raggiunto: attende 60 secondi prima di riprovare
-            logger.warning(f"Rate limit raggiunto alla riga {idx}. Attesa 60 secondi...")
-            time.sleep(60)
-            # Ridecrementa per riprovare questa riga al prossimo ciclo
-            # (pandas itera una volta sola, quindi gestiamo con una seconda iterazione)
-            df.at[idx, colonna_nuova] = "non_annotato"
-
-        except anthropic.APIStatusError as e:
-            if e.status_code >= 500:
-                # Errore server: riprova dopo una breve pausa
-                logger.warning(f"Errore server alla riga {idx} (HTTP {e.status_code}). Pausa 30s...")
-                time.sleep(30)
-            else:
-                # Errore client (4xx): non riprovare
-                logger.error(f"Errore client alla riga {idx}: {e.message}")
-                df.at[idx, colonna_nuova] = "api_error"
 
-        except json.JSONDecodeError as e:
-            logger.warning(f"Errore parsing JSON alla riga {idx}: {e}")
-            df.at[idx, colonna_nuova] = "parse_error"
+async def annota_concorrente(
+    client: anthropic.AsyncAnthropic,
+    df: pd.DataFrame,
+    config: dict
+) -> pd.DataFrame:
+    """
+    Annota il dataset con chiamate in tempo reale eseguite da un pool
+    limitato di worker asincroni.
+
+    Le righe da annotare sono in una coda condivisa. Una riga che riceve
+    un rate limit, un errore server (5xx) o un errore di connessione viene
+    rimessa in coda dopo un'attesa (retry-after o backoff esponenziale),
+    fino a max_tentativi_riga tentativi; un rate limit sospende anche gli
+    altri worker fino allo scadere dell'attesa, per non consumare
+    tentativi inutilmente.
+
+    Ogni riga annotata viene aggiunta subito al log JSONL dei ragionamenti
+    (checkpoint per riga); rilanciando lo script le righe già annotate
+    vengono saltate.
+
+    A ogni riga completata si aggiornano le metriche progressive vs gold,
+    riportate nei messaggi di avanzamento. Con arresto_anticipato_kappa il
+    run si interrompe quando, dopo arresto_anticipato_min_righe righe,
+    l'intervallo al 95% della kappa è tutto sotto la soglia: non partono
+    altre richieste, quelle già in volo vengono attese e registrate nel log
+    (sono già pagate) e le righe mancanti restano da riprendere.
 
-        # Salva il CSV ogni 50 trigrammi per prevenire perdita di dati
-        if (idx + 1) % 50 == 0:
-            df.to_csv(percorso_output, index=False, encoding="utf-8")
-            logger.info(f"Checkpoint: salvate {idx+1} annotazioni in '{percorso_output}'")
+    Parameters
+    ----------
+    client : anthropic.AsyncAnthropic
+        Client asincrono; i ritentativi interni dell'SDK vengono disattivati
+        perché gestiti dalla coda
+    df : pd.DataFrame
+        Dataset con i trigrammi da annotare
+    config : dict
+        Configurazione (max_richieste_concorrenti, max_tentativi_riga, ...)
 
-    # Salvataggio finale
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame con la colonna delle nuove annotazioni
+    """
+    colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
+    percorso_log = config.get("percorso_log_ragionamenti", "DIL_API_reasoning_log.jsonl")
+    percorso_output = config.get("percorso_output", "corpus_labelled-trigrams_500_Claude_API_annotated.csv")
+    n_worker = config.get("max_richieste_concorrenti", 8)
+    max_tentativi = config.get("max_tentativi_riga", 5)
+    ogni_n_checkpoint = config.get("checkpoint_csv_ogni", 50)
+    soglia_kappa = config.get("arresto_anticipato_kappa")
+    min_righe = config.get("arresto_anticipato_min_righe", 100)
+
+    client = client.with_options(max_retries=0)
+    params_base = costruisci_parametri_base(config)
+    prompts = costruisci_prompt_vettoriale(df).to_numpy()
+    anteprime, gold, precedenti = contesto_righe(df)
+    posizioni = {idx: pos for pos, idx in enumerate(df.index)}
+
+    fatte = righe_gia_annotate(percorso_log)
+    da_fare = [idx for idx in df.index if idx not in fatte]
+    logger.info(
+        f"Righe da annotare: {len(da_fare)} "
+        f"(già presenti nel checkpoint '{percorso_log}': {len(df) - len(da_fare)})"
+    )
+    if not da_fare:
+        return unisci_risultati(df, percorso_log, colonna_nuova)
+
+    # Le metriche progressive partono dalle decisioni già nel checkpoint
+    decisioni_precedenti = unisci_risultati(df[["DIL"]].copy(), percorso_log, colonna_nuova)[colonna_nuova]
+    metriche = metriche_progressive(df["DIL"], decisioni_precedenti)
+
+    coda: asyncio.Queue = asyncio.Queue()
+    for idx in da_fare:
+        coda.put_nowait((idx, 0))
+
+    loop = asyncio.get_running_loop()
+    stato = {"rimanenti": len(da_fare), "completate": 0, "ritentativi": 0, "riprendi_alle": 0.0,
+             "arrestata": False, "completate_all_arresto": 0, "in_volo": 0}
+    contatori = {"riuscite": 0, "errori": 0, "parse_error": 0, "esaurite": 0}
+    finito = asyncio.Event()
+    inizio = time.perf_counter()
+
+    with apri_log_ragionamenti(config, append=True) as sink:
+
+        def registra(entry: dict):
+            # Checkpoint per riga: senza compressione la riga è al sicuro
+            # appena scritta; con compressione a ogni blocco completato
+            sink.write(entry)
+            stato["rimanenti"] -= 1
+            stato["completate"] += 1
+            metriche.update(gold[posizioni[entry["index"]]], entry["decisione"])
+            if stato["completate"] % ogni_n_checkpoint == 0:
+                trascorsi = time.perf_counter() - inizio
+                logger.info(
+                    f"Avanzamento: {stato['completate']}/{len(da_fare)} righe "
+                    f"({stato['completate'] / trascorsi:.1f} righe/s, "
+                    f"ritentativi: {stato['ritentativi']}) — {metriche.summary()}"
+                )
+            if not stato["arrestata"] and metriche.should_stop(soglia_kappa, min_righe):
+                # Nessuna nuova richiesta; il run termina quando quelle in
+                # volo sono state registrate (vedi worker)
+                stato["arrestata"] = True
+                stato["completate_all_arresto"] = stato["completate"]
+            if stato["rimanenti"] == 0:
+                finito.set()
+
+        async def rimetti_in_coda(idx: int, tentativo: int, attesa: float):
+            await asyncio.sleep(attesa)
+            coda.put_nowait((idx, tentativo))
+
+        async def worker():
+            while True:
+                idx, tentativo = await coda.get()
+
+                # Pausa condivisa dopo un rate limit
+                attesa = stato["riprendi_alle"] - loop.time()
+                if attesa > 0:
+                    await asyncio.sleep(attesa)
+
+                if stato["arrestata"]:
+                    # Arresto anticipato: la riga resta da riprendere
+                    coda.task_done()
+                    continue
+
+                pos = posizioni[idx]
+                params = {**params_base, "messages": [{"role": "user", "content": prompts[pos]}]}
+                stato["in_volo"] += 1
+                try:
+                    async with client.messages.stream(**params) as stream:
+                        messaggio = await stream.get_final_message()
+
+                except Exception as e:
+                    ritentabile = isinstance(e, ERRORI_RITENTABILI) or (
+                        isinstance(e, anthropic.APIStatusError) and e.status_code >= 500
+                    )
+                    if not ritentabile:
+                        if not isinstance(e, anthropic.APIError):
+                            raise
+                        # Errore client (4xx): non riprovare
+                        logger.error(f"Errore client alla riga {idx}: {e}")
+                        contatori["errori"] += 1
+                        registra({
+                            "index": idx,
+                            "timestamp": datetime.now().isoformat(),
+                            "decisione": "api_error",
+                            "errore": str(e),
+                        })
+                    elif tentativo + 1 >= max_tentativi:
+                        logger.error(f"Riga {idx}: tentativi esauriti ({max_tentativi}), ultimo errore: {e}")
+                        contatori["esaurite"] += 1
+                        registra({
+                            "index": idx,
+                            "timestamp": datetime.now().isoformat(),
+                            "decisione": "api_error",
+                            "tipo_errore": "tentativi_esauriti",
+                            "errore": str(e),
+                        })
+                    elif stato["arrestata"]:
+                        logger.warning(f"Riga {idx}: {type(e).__name__} dopo l'arresto anticipato, da riprendere")
+                    else:
+                        attesa = attesa_ritentativo(e, tentativo, config)
+                        if isinstance(e, anthropic.RateLimitError):
+                            stato["riprendi_alle"] = max(stato["riprendi_alle"], loop.time() + attesa)
+                        logger.warning(
+                            f"Riga {idx}: {type(e).__name__}, nuovo tentativo "
+                            f"{tentativo + 2}/{max_tentativi} tra {attesa:.1f}s"
+                        )
+                        stato["ritentativi"] += 1
+                        asyncio.create_task(rimetti_in_coda(idx, tentativo + 1, attesa))
+
+                else:
+                    contatori["riuscite"] += 1
+                    entry = voce_da_messaggio(idx, messaggio, anteprime[pos], gold[pos], precedenti[pos])
+                    if entry["decisione"] == "parse_error":
+                        contatori["parse_error"] += 1
+                    registra(entry)
+
+                finally:
+                    coda.task_done()
+                    stato["in_volo"] -= 1
+                    if stato["arrestata"] and stato["in_volo"] == 0:
+                        finito.set()
+
+        workers = [asyncio.create_task(worker()) for _ in range(max(1, n_worker))]
+        attesa_fine = asyncio.create_task(finito.wait())
+        try:
+            # Termina quando tutte le righe hanno un esito definitivo o, dopo
+            # un arresto anticipato, quando le richieste in volo sono state
+            # registrate; altrimenti propaga il primo errore inatteso di un worker
+            await asyncio.wait([attesa_fine, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for w in workers:
+                if w.done() and not w.cancelled() and w.exception() is not None:
+                    raise w.exception()
+        finally:
+            for t in [attesa_fine, *workers]:
+                t.cancel()
+            await asyncio.gather(attesa_fine, *workers, return_exceptions=True)
+
+    trascorsi = time.perf_counter() - inizio
+    if stato["arrestata"]:
+        logger.warning(
+            f"Arresto anticipato: kappa vs gold sotto {soglia_kappa} (intervallo al 95%) dopo "
+            f"{stato['completate_all_arresto']} righe; "
+            f"{stato['completate'] - stato['completate_all_arresto']} richieste già in volo sono state "
+            f"attese e registrate nel log. Rilanciando lo script si riprende dalle righe mancanti."
+        )
+    logger.info(f"Metriche progressive: {metriche.summary()}")
+    logger.info(
+        f"Annotazione concorrente completata in {trascorsi:.1f}s — "
+        f"riuscite: {contatori['riuscite']}, parse_error: {contatori['parse_error']}, "
+        f"errori client: {contatori['errori']}, tentativi esauriti: {contatori['esaurite']}, "
+        f"ritentativi: {stato['ritentativi']}"
+    )
+
+    df = unisci_risultati(df, percorso_log, colonna_nuova)
     df.to_csv(percorso_output, index=False, encoding="utf-8")
-    logger.info(f"Annotazione sequenziale completata. File salvato: '{percorso_output}'")
+    return df
+
+
+# ===========================================================================
+# SEZIONE 6: DOPPIO PASSAGGIO CON THINKING ADATTIVO
+# ===========================================================================
+
+# Prezzi di listino per milione di token (input, output), senza sconto batch
+PREZZI_PER_MTOK = {"opus": (5.0, 25.0), "sonnet": (3.0, 15.0), "haiku": (1.0, 5.0)}
+
+
+def stima_costo(tokens_input: float, tokens_output: float, modello: str, batch: bool) -> float:
+    """Costo stimato in dollari (il Batches API dimezza il prezzo)."""
+    famiglia = next((f for f in PREZZI_PER_MTOK if f in modello), "opus")
+    prezzo_in, prezzo_out = PREZZI_PER_MTOK[famiglia]
+    costo = (tokens_input * prezzo_in + tokens_output * prezzo_out) / 1_000_000
+    return costo / 2 if batch else costo
+
+
+def con_suffisso(percorso: str, suffisso: str) -> str:
+    """Inserisce un suffisso prima dell'estensione: log.jsonl -> log_passaggio1.jsonl."""
+    p = Path(percorso)
+    return str(p.with_name(f"{p.stem}{suffisso}{p.suffix}"))
+
+
+def config_con_suffisso(config: dict, suffisso: str) -> dict:
+    """
+    Copia della configurazione con file di lavoro propri (log, manifest,
+    CSV parziale, richieste, ID dei batch): run diversi non si sovrascrivono
+    e ciascuno si riprende da solo.
+    """
+    return {
+        **config,
+        "percorso_log_ragionamenti": con_suffisso(
+            config.get("percorso_log_ragionamenti", "DIL_API_reasoning_log.jsonl"), suffisso),
+        "percorso_manifest": con_suffisso(
+            config.get("percorso_manifest", "DIL_API_batch_manifest.json"), suffisso),
+        "percorso_output": con_suffisso(
+            config.get("percorso_output", "corpus_labelled-trigrams_500_Claude_API_annotated.csv"), suffisso),
+        "percorso_richieste_batch": con_suffisso(
+            config.get("percorso_richieste_batch", "DIL_API_batch_requests.jsonl"), suffisso),
+        "percorso_log_batch": con_suffisso(
+            config.get("percorso_log_batch", "batch_ids_log.json"), suffisso),
+    }
+
+
+def config_passaggio(config: dict, numero: int, thinking: bool) -> dict:
+    """Configurazione di un passaggio: thinking forzato e file propri."""
+    return {**config_con_suffisso(config, f"_passaggio{numero}"), "usa_thinking_adattivo": thinking}
+
+
+def esiti_passaggio(percorso_log: str) -> pd.DataFrame:
+    """
+    Ultimo esito di ogni riga nel log di un passaggio, indicizzato per riga,
+    con decisione, confidenza, numero di marcatori e token.
+    """
+    colonne = ["decisione", "confidenza", "n_marcatori", "tokens_input", "tokens_output"]
+    blocchi = []
+    for blocco in iter_log_frames(percorso_log):
+        blocco = blocco.reindex(columns=["index", "decisione", "confidenza", "marcatori",
+                                         "tokens_input", "tokens_output"])
+        blocco["n_marcatori"] = blocco["marcatori"].map(lambda m: len(m) if isinstance(m, list) else 0)
+        blocchi.append(blocco[["index"] + colonne])
+    if not blocchi:
+        return pd.DataFrame(columns=colonne)
+    esiti = pd.concat(blocchi, ignore_index=True).drop_duplicates("index", keep="last")
+    return esiti.set_index("index")
+
+
+def richiede_secondo_passaggio(esiti: pd.DataFrame, config: dict) -> pd.Series:
+    """
+    Righe ambigue da ripetere con thinking: decisione valida ma confidenza
+    in confidenze_secondo_passaggio (default 'bassa'/'media'), oppure
+    marcatori in conflitto con la decisione ('yes' senza alcun marcatore,
+    'no' con almeno min_marcatori_conflitto marcatori).
+    """
+    confidenze = config.get("confidenze_secondo_passaggio", ["bassa", "media"])
+    min_marcatori = config.get("min_marcatori_conflitto", 2)
+
+    valide = esiti["decisione"].isin(["yes", "no"])
+    incerte = esiti["confidenza"].isin(confidenze)
+    conflitto = (
+        ((esiti["decisione"] == "yes") & (esiti["n_marcatori"] == 0))
+        | ((esiti["decisione"] == "no") & (esiti["n_marcatori"] >= min_marcatori))
+    )
+    return valide & (incerte | conflitto)
+
+
+def passaggio_concluso(df: pd.DataFrame, config: dict) -> bool:
+    """True se il log del passaggio contiene già una decisione valida per ogni riga."""
+    manifest = carica_manifest(config["percorso_manifest"])
+    if manifest is not None and manifest["stato"] == "completato" and manifest["n_righe"] == len(df):
+        return True
+    return set(df.index) <= righe_gia_annotate(config["percorso_log_ragionamenti"])
+
+
+def annota_due_passaggi(
+    esegui_modalita: Callable,
+    df: pd.DataFrame,
+    config: dict,
+    batch: bool = False
+) -> pd.DataFrame:
+    """
+    Annotazione in due passaggi con thinking adattivo solo sulle righe ambigue.
+
+    1. Tutti i trigrammi vengono annotati senza thinking (veloce ed economico).
+    2. Solo le righe con confidenza bassa/media o marcatori in conflitto con
+       la decisione (vedi richiede_secondo_passaggio) vengono ripetute con
+       thinking adattivo; la loro decisione sostituisce quella del primo
+       passaggio.
+
+    Ogni passaggio usa la modalità scelta da riga di comando con file
+    propri (suffisso _passaggio1/_passaggio2): un run interrotto riprende
+    dal passaggio in corso. Al termine viene stampato il confronto di costo,
+    tempo e kappa con le configurazioni a passaggio singolo.
+
+    Parameters
+    ----------
+    esegui_modalita : callable
+        esegui_modalita(df, config) -> df, annota con la modalità scelta
+    df : pd.DataFrame
+        Dataset completo
+    config : dict
+        Configurazione (modello con thinking adattivo, soglie di ambiguità)
+    batch : bool
+        True se la modalità è il Batches API (prezzi scontati nel riepilogo)
+
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame con la colonna delle decisioni finali
+    """
+    modello = config.get("modello", "claude-opus-4-6")
+    if "opus-4-6" not in modello:
+        raise ValueError(
+            f"Il doppio passaggio richiede un modello con thinking adattivo (opus-4-6), non '{modello}'"
+        )
+    colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
+    tempi = {}
+
+    config_1 = config_passaggio(config, 1, thinking=False)
+    logger.info("Passaggio 1: tutti i trigrammi senza thinking")
+    inizio = time.perf_counter()
+    if passaggio_concluso(df, config_1):
+        logger.info(f"Passaggio 1 già concluso ('{config_1['percorso_log_ragionamenti']}')")
+        tempi[1] = None
+    else:
+        esegui_modalita(df.copy(), config_1)
+        tempi[1] = time.perf_counter() - inizio
+
+    esiti_1 = esiti_passaggio(config_1["percorso_log_ragionamenti"]).reindex(df.index)
+    ambigue = df.index[richiede_secondo_passaggio(esiti_1, config).to_numpy()]
+    logger.info(f"Passaggio 2: {len(ambigue)}/{len(df)} righe ambigue con thinking adattivo")
+
+    config_2 = config_passaggio(config, 2, thinking=True)
+    df_ambigue = df.loc[ambigue].copy()
+    inizio = time.perf_counter()
+    if len(ambigue) == 0 or passaggio_concluso(df_ambigue, config_2):
+        tempi[2] = None if len(ambigue) else 0.0
+    else:
+        esegui_modalita(df_ambigue, config_2)
+        tempi[2] = time.perf_counter() - inizio
+    esiti_2 = esiti_passaggio(config_2["percorso_log_ragionamenti"]).reindex(ambigue)
+
+    # Decisione finale: il secondo passaggio prevale dove ha dato una decisione valida
+    finale = esiti_1["decisione"].fillna("non_annotato").copy()
+    migliorate = esiti_2["decisione"].isin(["yes", "no"])
+    finale.loc[esiti_2.index[migliorate]] = esiti_2.loc[migliorate, "decisione"]
+    df[colonna_nuova] = finale.to_numpy()
+
+    riepilogo_due_passaggi(df, esiti_1, esiti_2, tempi, config, batch)
+    return df
+
+
+def riepilogo_due_passaggi(df: pd.DataFrame, esiti_1: pd.DataFrame, esiti_2: pd.DataFrame,
+                           tempi: dict, config: dict, batch: bool):
+    """
+    Stampa costo, tempo e kappa del doppio passaggio confrontati con i due
+    passaggi singoli: tutto senza thinking (misurato: è il passaggio 1) e
+    tutto con thinking (stimato estendendo a tutte le righe costo e tempo
+    medi per riga del passaggio 2; la sua kappa richiede un run dedicato
+    con usa_thinking_adattivo = true).
+    """
+    colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
+    modello = config.get("modello", "claude-opus-4-6")
+    n, n_2 = len(df), len(esiti_2)
+
+    def costo(esiti):
+        return stima_costo(esiti["tokens_input"].sum(), esiti["tokens_output"].sum(), modello, batch)
 
-    return df, log_ragionamenti
+    def kappa(decisioni, indici=None):
+        sotto = df if indici is None else df.loc[indici]
+        dec = pd.Series(decisioni, index=df.index).loc[sotto.index]
+        valide = dec.isin(["yes", "no"])
+        if valide.sum() < 2:
+            return float("nan")
+        return pair_metrics(pd.DataFrame({"DIL": sotto["DIL"], "dec": dec}), "DIL", "dec")["kappa"]
+
+    def fmt_tempo(t):
+        return "n/d" if t is None else f"{t:.1f}s"
+
+    costo_1, costo_2 = costo(esiti_1), costo(esiti_2)
+    costo_riga_2 = costo_2 / n_2 if n_2 else 0.0
+    tempo_tot = None if None in tempi.values() else tempi[1] + tempi[2]
+    tempo_thinking = tempi[2] / n_2 * n if n_2 and tempi[2] is not None else None
+
+    k_1 = kappa(esiti_1["decisione"].to_numpy())
+    k_2 = kappa(df[colonna_nuova].to_numpy())
+
+    print("\n" + "=" * 70)
+    print(f"DOPPIO PASSAGGIO — {n_2}/{n} righe ({n_2 / n:.1%}) ripetute con thinking")
+    print("=" * 70)
+    print(f"{'Configurazione':<32} {'Costo ($)':>10} {'Tempo':>9} {'Kappa vs gold':>14}")
+    print("-" * 70)
+    print(f"{'Singolo, senza thinking':<32} {costo_1:>10.2f} {fmt_tempo(tempi[1]):>9} {k_1:>14.3f}")
+    print(f"{'Singolo, thinking (stima)':<32} {costo_riga_2 * n:>10.2f} {fmt_tempo(tempo_thinking):>9} {'n/d':>14}")
+    print(f"{'Doppio passaggio':<32} {costo_1 + costo_2:>10.2f} {fmt_tempo(tempo_tot):>9} {k_2:>14.3f}")
+    print("-" * 70)
+    print(f"Guadagno di kappa del doppio passaggio: {k_2 - k_1:+.3f}")
+    if n_2:
+        cambiate = (esiti_1.loc[esiti_2.index, "decisione"] != esiti_2["decisione"]).sum()
+        print(f"Sulle righe ambigue: kappa {kappa(esiti_1['decisione'].to_numpy(), esiti_2.index):.3f} "
+              f"-> {kappa(df[colonna_nuova].to_numpy(), esiti_2.index):.3f}, "
+              f"decisioni cambiate: {cambiate}/{n_2}")
+    print("=" * 70 + "\n")
+
+
+# ===========================================================================
+# SEZIONE 7: SWEEP DI CONFIGURAZIONI
+# ===========================================================================
+
+def carica_griglia(percorso_griglia: str) -> dict:
+    """
+    Carica il file JSON della griglia di sweep.
+
+    Assi del prodotto cartesiano (tutti opzionali tranne 'modelli'):
+      - modelli     : lista di modelli
+      - prompt      : {nome: file del system prompt, null = prompt di SEZIONE 1}
+      - thinking    : lista di booleani (thinking adattivo)
+      - effort      : lista di livelli di effort (null = default del modello)
+    In alternativa, o in aggiunta, 'configurazioni' elenca run espliciti
+    (nome, prompt e qualunque chiave di api_config.json).
+    """
+    if not Path(percorso_griglia).exists():
+        raise FileNotFoundError(f"File della griglia di sweep non trovato: {percorso_griglia}")
+    with open(percorso_griglia, "r", encoding="utf-8") as f:
+        griglia = json.load(f)
+    if not griglia.get("modelli") and not griglia.get("configurazioni"):
+        raise ValueError(f"La griglia '{percorso_griglia}' non contiene né 'modelli' né 'configurazioni'")
+    return griglia
+
+
+def nome_configurazione(modello: str, prompt: str, thinking: bool, effort: Optional[str]) -> str:
+    """Nome leggibile di un run: sonnet-4-5_v2, opus-4-6_v1_thinking, ..."""
+    parti = [modello.removeprefix("claude-"), prompt]
+    if thinking:
+        parti.append("thinking")
+    if effort:
+        parti.append(f"effort-{effort}")
+    return "_".join(parti)
+
+
+def configurazioni_sweep(griglia: dict, config: dict) -> list:
+    """
+    Espande la griglia nelle configurazioni da eseguire.
+
+    Ogni configurazione eredita api_config.json, con file di lavoro propri
+    (suffisso _<nome>) e colonna DIL_<nome>. Le combinazioni con thinking
+    su modelli senza thinking adattivo vengono scartate: sarebbero identiche
+    alla stessa combinazione senza thinking.
+
+    Returns
+    -------
+    list
+        Tuple (nome, config_run, descrizione) nell'ordine della griglia
+    """
+    prompt = griglia.get("prompt", {"base": None})
+    voci = [
+        {"modello": modello, "prompt": nome_prompt, "usa_thinking_adattivo": thinking, "effort": effort}
+        for modello, nome_prompt, thinking, effort in itertools.product(
+            griglia.get("modelli", []), prompt,
+            griglia.get("thinking", [False]), griglia.get("effort", [None])
+        )
+    ]
+    voci += [dict(voce) for voce in griglia.get("configurazioni", [])]
+
+    configurazioni, nomi = [], set()
+    for voce in voci:
+        nome_prompt = voce.pop("prompt", next(iter(prompt)))
+        if nome_prompt not in prompt:
+            raise ValueError(f"Prompt '{nome_prompt}' non definito nella griglia ({', '.join(prompt)})")
+        modello = voce.setdefault("modello", config.get("modello", "claude-opus-4-6"))
+        thinking = voce.get("usa_thinking_adattivo", False)
+        nome = voce.pop("nome", None) or nome_configurazione(modello, nome_prompt, thinking, voce.get("effort"))
+
+        if thinking and "opus-4-6" not in modello:
+            logger.warning(f"Configurazione '{nome}' scartata: thinking adattivo non disponibile su {modello}")
+            continue
+        if nome in nomi:
+            raise ValueError(f"Configurazione '{nome}' ripetuta nella griglia")
+        nomi.add(nome)
+
+        config_run = {
+            **config_con_suffisso(config, f"_{nome}"),
+            **voce,
+            "percorso_prompt_sistema": prompt[nome_prompt],
+            "colonna_annotazione_nuova": f"DIL_{nome}",
+        }
+        descrizione = {
+            "modello": modello, "prompt": nome_prompt,
+            "thinking": thinking, "effort": voce.get("effort"),
+        }
+        configurazioni.append((nome, config_run, descrizione))
+    return configurazioni
+
+
+def metriche_vs_gold(gold: pd.Series, decisioni: pd.Series) -> dict:
+    """Accuracy, precision, recall, F1 e kappa di Cohen sulle righe con decisione valida."""
+    valide = decisioni.isin(["yes", "no"]) & gold.isin(["yes", "no"])
+    if valide.sum() < 2:
+        return {"n_valide": int(valide.sum())}
+    m = pair_metrics(pd.DataFrame({"DIL": gold, "dec": decisioni}), "DIL", "dec")
+    return {
+        "n_valide": m["total"],
+        "accuracy": round(m["accuracy"], 4),
+        "precision": round(m["precision"], 4),
+        "recall": round(m["recall"], 4),
+        "f1_score": round(m["f1_score"], 4),
+        "kappa_gold": round(m["kappa"], 4),
+    }
+
+
+def esegui_sweep(
+    client: anthropic.Anthropic,
+    crea_client_async: Callable,
+    df: pd.DataFrame,
+    config: dict,
+    griglia: dict,
+    ricomincia: bool = False
+) -> pd.DataFrame:
+    """
+    Esegue in parallelo tutte le configurazioni della griglia e ne confronta
+    i risultati in un'unica tabella.
+
+    Ogni configurazione è un run batch indipendente guidato dal proprio
+    manifest (esegui_batch_con_manifest), in un thread dedicato: gli invii
+    e i polling di tutte le configurazioni procedono insieme invece che in
+    sequenza. I client ricevuti condividono un unico budget di richieste
+    (max_richieste_api_al_minuto), quindi le configurazioni si dividono lo
+    stesso rate limit. Rilanciando lo sweep le configurazioni concluse
+    vengono saltate e quelle interrotte riprese dal loro manifest.
+
+    Parameters
+    ----------
+    client : anthropic.Anthropic
+        Client sincrono condiviso (thread-safe)
+    crea_client_async : callable
+        Restituisce un nuovo anthropic.AsyncAnthropic
+    df : pd.DataFrame
+        Dataset completo
+    config : dict
+        Configurazione di base (api_config.json)
+    griglia : dict
+        Griglia caricata da carica_griglia
+    ricomincia : bool
+        Se True riesegue da zero anche le configurazioni già concluse
+
+    Returns
+    -------
+    pd.DataFrame
+        Tabella di confronto (una riga per configurazione e per colonna di riferimento)
+    """
+    configurazioni = configurazioni_sweep(griglia, config)
+    if not configurazioni:
+        raise ValueError("Nessuna configurazione da eseguire nella griglia di sweep")
+    # I file dei prompt si verificano prima di inviare qualunque batch
+    for _, config_run, _ in configurazioni:
+        carica_prompt_sistema(config_run)
+
+    riferimenti = griglia.get(
+        "colonne_riferimento", [c for c in df.columns if c.startswith("DIL_")]
+    )
+    max_paralleli = griglia.get("max_configurazioni_parallele", len(configurazioni))
+    logger.info(
+        f"Sweep di {len(configurazioni)} configurazioni ({max_paralleli} in parallelo): "
+        f"{', '.join(nome for nome, _, _ in configurazioni)}"
+    )
+
+    def esegui_configurazione(nome: str, config_run: dict) -> Optional[float]:
+        threading.current_thread().name = nome
+        if not ricomincia and passaggio_concluso(df, config_run):
+            logger.info(f"Già conclusa ('{config_run['percorso_log_ragionamenti']}')")
+            return None
+        inizio = time.perf_counter()
+        esegui_batch_con_manifest(client, crea_client_async, df.copy(), config_run, ricomincia=ricomincia)
+        return time.perf_counter() - inizio
+
+    # Con più run in parallelo ogni riga di log riporta la configurazione;
+    # i formatter originali vengono ripristinati a fine sweep
+    formato = logging.Formatter("%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s")
+    formatter_precedenti = [(h, h.formatter) for h in logging.getLogger().handlers]
+    for handler, _ in formatter_precedenti:
+        handler.setFormatter(formato)
+
+    tempi, stati = {}, {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_paralleli, thread_name_prefix="sweep") as executor:
+            futures = {
+                executor.submit(esegui_configurazione, nome, config_run): nome
+                for nome, config_run, _ in configurazioni
+            }
+            for future in as_completed(futures):
+                nome = futures[future]
+                # Qualunque errore interrompe solo la propria configurazione:
+                # le altre proseguono, la tabella di confronto viene comunque
+                # scritta e il run si riprende rilanciando lo sweep
+                try:
+                    tempi[nome] = future.result()
+                    stati[nome] = "completata"
+                except Exception:
+                    tempi[nome] = None
+                    stati[nome] = "interrotta"
+                    logger.exception(f"Configurazione '{nome}' interrotta")
+    finally:
+        threading.current_thread().name = "MainThread"
+        for handler, formatter in formatter_precedenti:
+            handler.setFormatter(formatter)
+
+    # Tabella di confronto e CSV con una colonna per configurazione
+    righe_tabella = []
+    for nome, config_run, descrizione in configurazioni:
+        colonna = config_run["colonna_annotazione_nuova"]
+        unisci_risultati(df, config_run["percorso_log_ragionamenti"], colonna)
+        esiti = esiti_passaggio(config_run["percorso_log_ragionamenti"])
+        righe_tabella.append({
+            "configurazione": nome,
+            **descrizione,
+            "stato": stati[nome],
+            **metriche_vs_gold(df["DIL"], df[colonna]),
+            "costo_usd": round(stima_costo(
+                esiti["tokens_input"].sum(), esiti["tokens_output"].sum(), descrizione["modello"], batch=True
+            ), 2),
+            "tempo_s": None if tempi[nome] is None else round(tempi[nome], 1),
+        })
+    for colonna in riferimenti:
+        if colonna in df.columns:
+            righe_tabella.append({
+                "configurazione": colonna, "stato": "riferimento",
+                **metriche_vs_gold(df["DIL"], df[colonna]),
+            })
+    tabella = pd.DataFrame(righe_tabella)
+
+    percorso_output = griglia.get("percorso_output", "corpus_labelled-trigrams_500_sweep_annotated.csv")
+    percorso_confronto = griglia.get("percorso_confronto", "sweep_confronto.csv")
+    df.to_csv(percorso_output, index=False, encoding="utf-8")
+    tabella.to_csv(percorso_confronto, index=False, encoding="utf-8")
+    logger.info(f"Annotazioni dello sweep salvate in '{percorso_output}', confronto in '{percorso_confronto}'")
+
+    def fmt(valore, formato):
+        return "n/d" if pd.isna(valore) else format(valore, formato)
+
+    print("\n" + "=" * 96)
+    print(f"SWEEP — {len(configurazioni)} configurazioni vs gold standard ({len(df)} trigrammi)")
+    print("=" * 96)
+    print(f"{'Configurazione':<34} {'Valide':>7} {'Accuracy':>9} {'F1':>7} {'Kappa':>7} "
+          f"{'Costo ($)':>10} {'Tempo':>9}  Stato")
+    print("-" * 96)
+    for riga in tabella.to_dict("records"):
+        print(
+            f"{riga['configurazione'][:34]:<34} {riga['n_valide']:>7} "
+            f"{fmt(riga.get('accuracy'), '.2%'):>9} {fmt(riga.get('f1_score'), '.2%'):>7} "
+            f"{fmt(riga.get('kappa_gold'), '.3f'):>7} {fmt(riga.get('costo_usd'), '.2f'):>10} "
+            f"{fmt(riga.get('tempo_s'), '.1f'):>9}  {riga['stato']}"
+        )
+    print("=" * 96 + "\n")
+    return tabella
 
 
 # ===========================================================================
-# SEZIONE 5: MAIN
+# SEZIONE 8: BENCHMARK COSTRUZIONE RICHIESTE
+# ===========================================================================
+
+def benchmark_costruzione_richieste(percorso_csv: str, ripetizioni: int = 100) -> dict:
+    """
+    Confronta la costruzione delle richieste riga per riga (df.iterrows)
+    con il percorso vettoriale, senza chiamate API.
+
+    Il dataset viene replicato `ripetizioni` volte per simulare un corpus
+    di dimensioni realistiche (500 trigrammi × 100 = 50.000 richieste).
+    Verifica inoltre che i prompt prodotti dai due percorsi coincidano.
+
+    Parameters
+    ----------
+    percorso_csv : str
+        CSV con i trigrammi (colonne author, work, year, text)
+    ripetizioni : int
+        Fattore di replicazione del dataset
+
+    Returns
+    -------
+    dict
+        Tempi (secondi) dei due percorsi e della serializzazione JSONL
+    """
+    import tempfile
+
+    df = pd.read_csv(percorso_csv, encoding="utf-8")
+    df = pd.concat([df] * ripetizioni, ignore_index=True)
+    config = {}
+    logger.info(f"Benchmark costruzione richieste su {len(df)} righe...")
+
+    # Percorso originale: iterrows, prompt e schema ricostruiti per ogni riga
+    inizio = time.perf_counter()
+    richieste_iterrows = []
+    for idx, riga in df.iterrows():
+        params = {
+            "model": config.get("modello", "claude-opus-4-6"),
+            "max_tokens": config.get("max_tokens", 512),
+            "system": SYSTEM_PROMPT,
+            "messages": [{"role": "user", "content": costruisci_prompt_utente(riga)}],
+            "output_config": {"format": costruisci_schema_output()}
+        }
+        richieste_iterrows.append(
+            Request(custom_id=str(idx), params=MessageCreateParamsNonStreaming(**params))
+        )
+    t_iterrows = time.perf_counter() - inizio
+
+    # Percorso vettoriale
+    inizio = time.perf_counter()
+    richieste = prepara_richieste_batch(df, config)
+    t_vettoriale = time.perf_counter() - inizio
+
+    diverse = sum(
+        a["params"]["messages"][0]["content"] != b["params"]["messages"][0]["content"]
+        for a, b in zip(richieste_iterrows, richieste)
+    )
+
+    # Serializzazione JSONL (include il calcolo delle dimensioni per lo sharding)
+    with tempfile.TemporaryDirectory() as cartella:
+        inizio = time.perf_counter()
+        serializza_richieste_jsonl(richieste, str(Path(cartella) / "richieste.jsonl"))
+        t_jsonl = time.perf_counter() - inizio
+
+    print("\n" + "=" * 70)
+    print(f"BENCHMARK COSTRUZIONE RICHIESTE — {len(df)} righe")
+    print("=" * 70)
+    print(f"  iterrows (riga per riga):  {t_iterrows:8.2f} s  ({len(df) / t_iterrows:,.0f} richieste/s)")
+    print(f"  vettoriale:                {t_vettoriale:8.2f} s  ({len(df) / t_vettoriale:,.0f} richieste/s)")
+    print(f"  speedup:                   {t_iterrows / t_vettoriale:8.1f}x")
+    print(f"  serializzazione JSONL:     {t_jsonl:8.2f} s")
+    print(f"  prompt diversi tra i due percorsi: {diverse}")
+    print("=" * 70 + "\n")
+
+    return {"iterrows": t_iterrows, "vettoriale": t_vettoriale, "jsonl": t_jsonl}
+
+
+# ===========================================================================
+# SEZIONE 9: MAIN
 # ===========================================================================
 
 def parse_argomenti() -> argparse.Namespace:
@@ -1004,7 +2511,13 @@ def parse_argomenti() -> argparse.Namespace:
 Esempi di utilizzo:
   python annotate_dil_claude_api.py
   python annotate_dil_claude_api.py --config mia_config.json --mode sequential
+  python annotate_dil_claude_api.py --mode concurrent
   python annotate_dil_claude_api.py --resume msgbatch_01abc123xyz
+  python annotate_dil_claude_api.py --resume msgbatch_01abc msgbatch_01def
+  python annotate_dil_claude_api.py --ricomincia
+  python annotate_dil_claude_api.py --mode concurrent --due-passaggi
+  python annotate_dil_claude_api.py --sweep griglia_sweep.json
+  python annotate_dil_claude_api.py --benchmark-richieste corpus.csv --ripetizioni 100
         """
     )
 
@@ -1017,18 +2530,54 @@ Esempi di utilizzo:
     parser.add_argument(
         "--mode",
         type=str,
-        choices=["batch", "sequential"],
+        choices=["batch", "sequential", "concurrent"],
         default="batch",
-        help="Modalità di annotazione: 'batch' (consigliato) o 'sequential' (default: batch)"
+        help="Modalità di annotazione: 'batch' (consigliato), 'sequential' o 'concurrent' (default: batch)"
     )
     parser.add_argument(
         "--resume",
         type=str,
+        nargs="+",
         default=None,
-        help="ID di un batch già inviato da riprendere (es: msgbatch_01abc123)"
+        help="ID dei batch (shard) già inviati da riprendere (es: msgbatch_01abc123)"
+    )
+    parser.add_argument(
+        "--due-passaggi",
+        action="store_true",
+        help="Primo passaggio senza thinking, secondo con thinking adattivo solo sulle righe ambigue"
+    )
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        default=None,
+        metavar="GRIGLIA",
+        help="File JSON con la griglia di configurazioni da eseguire in parallelo (Batches API)"
+    )
+    parser.add_argument(
+        "--ricomincia",
+        action="store_true",
+        help="Ignora il manifest di un run batch incompleto (con --sweep: riesegue tutte le configurazioni)"
+    )
+    parser.add_argument(
+        "--benchmark-richieste",
+        type=str,
+        default=None,
+        metavar="CSV",
+        help="Misura il tempo di costruzione delle richieste sul CSV indicato ed esce (nessuna chiamata API)"
+    )
+    parser.add_argument(
+        "--ripetizioni",
+        type=int,
+        default=100,
+        help="Fattore di replicazione del dataset per --benchmark-richieste (default: 100)"
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.due_passaggi and args.resume:
+        parser.error("--due-passaggi non è compatibile con --resume: i passaggi si riprendono dai propri manifest")
+    if args.sweep and (args.resume or args.due_passaggi or args.mode != "batch"):
+        parser.error("--sweep usa il Batches API e non si combina con --mode, --resume o --due-passaggi")
+    return args
 
 
 def main():
@@ -1040,12 +2589,16 @@ def main():
     2. Caricamento configurazione da JSON
     3. Inizializzazione client Anthropic (con chiave API dal config)
     4. Caricamento dataset CSV
-    5. Annotazione (batch o sequenziale)
+    5. Annotazione (batch, sequenziale o concorrente)
     6. Salvataggio risultati
     7. Calcolo e stampa metriche
     """
     args = parse_argomenti()
 
+    if args.benchmark_richieste:
+        benchmark_costruzione_richieste(args.benchmark_richieste, args.ripetizioni)
+        return
+
     logger.info("=" * 70)
     logger.info("AVVIO SCRIPT ANNOTAZIONE DIL — API CLAUDE ANTHROPIC")
     logger.info(f"Data/ora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -1063,7 +2616,13 @@ def main():
     # In alternativa, si può usare la variabile d'ambiente ANTHROPIC_API_KEY
     # e lasciare che l'SDK la rilevi automaticamente con anthropic.Anthropic().
     api_key = config["api_key"]
-    client = anthropic.Anthropic(api_key=api_key)
+    metriche_trasporto = TransportMetrics()
+    # Budget di richieste al minuto condiviso da tutti i client (0 = nessun limite)
+    limite_richieste = RateLimiter(config.get("max_richieste_api_al_minuto", 0))
+    client = anthropic.Anthropic(
+        api_key=api_key,
+        http_client=create_httpx_client(metrics=metriche_trasporto, rate_limiter=limite_richieste),
+    )
     logger.info("Client Anthropic inizializzato.")
 
     # --- Passo 3: Caricamento dataset ---
@@ -1077,77 +2636,106 @@ def main():
     # --- Passo 4: Annotazione ---
     colonna_nuova = config.get("colonna_annotazione_nuova", "DIL_Claude_API")
 
-    if args.mode == "sequential":
-        # Modalità sequenziale: una richiesta API alla volta
-        logger.info("Modalità: chiamate sequenziali")
-        df, log_ragionamenti = annota_sequenziale(client, df, config)
+    n_worker = config.get("max_richieste_concorrenti", 8)
 
-    else:
-        # Modalità batch: tutte le richieste in un unico batch (consigliata)
-        logger.info("Modalità: Batches API")
+    def crea_client_async(max_connessioni: int = 10):
+        return anthropic.AsyncAnthropic(
+            api_key=api_key,
+            http_client=create_async_httpx_client(
+                max_connections=max_connessioni, metrics=metriche_trasporto, rate_limiter=limite_richieste
+            ),
+        )
+
+    def esegui_modalita(df_da_annotare: pd.DataFrame, config_run: dict) -> pd.DataFrame:
+        """Annota df_da_annotare con la modalità scelta da riga di comando."""
+        if args.mode == "sequential":
+            # Modalità sequenziale: una richiesta API alla volta
+            return annota_sequenziale(client, df_da_annotare, config_run)
+
+        if args.mode == "concurrent":
+            # Modalità concorrente: pool di worker in tempo reale con checkpoint per riga
+            async def annota_in_tempo_reale():
+                async with crea_client_async(n_worker) as client_async:
+                    return await annota_concorrente(client_async, df_da_annotare, config_run)
+
+            return asyncio.run(annota_in_tempo_reale())
 
+        # Modalità batch: richieste suddivise in shard (consigliata)
         if args.resume:
-            # Riprende un batch già inviato in precedenza
-            batch_id = args.resume
-            logger.info(f"Riprendendo il polling del batch esistente: {batch_id}")
-        else:
-            # Nuovo batch: prepara e invia le richieste
-            richieste = prepara_richieste_batch(df, config)
+            # Riprende manualmente gli shard indicati (senza manifest)
+            batch_ids = args.resume
+            logger.info(f"Riprendendo il polling degli shard esistenti: {' '.join(batch_ids)}")
 
-            try:
-                batch_id = invia_batch(client, richieste, config)
-            except anthropic.APIError as e:
-                logger.error(f"Errore nell'invio del batch: {e}")
-                sys.exit(1)
+            # Attende gli shard e raccoglie i risultati di ciascuno appena termina
+            async def attendi_e_raccogli():
+                async with crea_client_async() as client_async:
+                    return await raccogli_risultati(client_async, batch_ids, df_da_annotare, config_run)
 
-        # Attende il completamento del batch
-        try:
-            polling_batch(client, batch_id, config)
-        except TimeoutError as e:
-            logger.error(str(e))
-            sys.exit(1)
+            return asyncio.run(attendi_e_raccogli())
 
-        # Raccoglie i risultati
-        df, log_ragionamenti = raccogli_risultati(client, batch_id, df, config)
+        # Run guidato dal manifest: invio, raccolta e reinvio automatico
+        # delle righe fallite; riprende da solo un run interrotto
+        return esegui_batch_con_manifest(
+            client, crea_client_async, df_da_annotare, config_run, ricomincia=args.ricomincia
+        )
+
+    descrizioni = {
+        "sequential": "chiamate sequenziali",
+        "concurrent": f"chiamate concorrenti in tempo reale ({n_worker} worker)",
+        "batch": "Batches API",
+    }
+    logger.info(f"Modalità: {descrizioni[args.mode]}")
+
+    try:
+        if args.sweep:
+            # Griglia di configurazioni in parallelo: CSV e tabella di
+            # confronto vengono salvati dallo sweep stesso
+            esegui_sweep(
+                client, crea_client_async, df, config, carica_griglia(args.sweep), ricomincia=args.ricomincia
+            )
+            logger.info(f"Trasporto: {metriche_trasporto.summary()} | {limite_richieste.summary()}")
+            logger.info(f"Decodifica: {DECODIFICATORE.stats.summary()}")
+            return
+        if args.due_passaggi:
+            # Thinking adattivo solo sulle righe ambigue del primo passaggio
+            df = annota_due_passaggi(esegui_modalita, df, config, batch=args.mode == "batch")
+        else:
+            df = esegui_modalita(df, config)
+    except anthropic.APIError as e:
+        logger.error(f"Errore nella comunicazione con le API: {e}")
+        sys.exit(1)
+    except (FileNotFoundError, TimeoutError, ValueError) as e:
+        logger.error(str(e))
+        sys.exit(1)
 
     # --- Passo 5: Salvataggio CSV annotato ---
     percorso_output = config.get("percorso_output", "corpus_labelled-trigrams_500_Claude_API_annotated.csv")
     df.to_csv(percorso_output, index=False, encoding="utf-8")
     logger.info(f"CSV annotato salvato in '{percorso_output}'")
 
-    # --- Passo 6: Salvataggio log ragionamenti ---
-    if config.get("salva_ragionamento", True):
-        percorso_log = config.get("percorso_log_ragionamenti", "DIL_API_reasoning_log.jsonl")
-        salva_log_ragionamenti(log_ragionamenti, percorso_log)
-
-    # --- Passo 7: Calcolo metriche ---
+    # --- Passo 6: Calcolo metriche ---
     calcola_metriche(df, colonna_nuova)
 
-    # --- Passo 8: Salvataggio metriche in CSV ---
+    # --- Passo 7: Salvataggio metriche in CSV ---
     percorso_metriche = config.get("percorso_metriche", "metrics_API_vs_gold.csv")
     try:
-        from sklearn.metrics import accuracy_score, precision_recall_fscore_support
-
-        df_valido = df[df[colonna_nuova].isin(["yes", "no"])]
-        if len(df_valido) > 0:
-            acc = accuracy_score(df_valido["DIL"], df_valido[colonna_nuova])
-            prec, rec, f1, _ = precision_recall_fscore_support(
-                df_valido["DIL"], df_valido[colonna_nuova],
-                pos_label="yes", average="binary", zero_division=0
-            )
+        m = pair_metrics(df, "DIL", colonna_nuova)
+        if m["total"] > 0:
             metriche_df = pd.DataFrame([{
                 "annotatore": colonna_nuova,
-                "n_valide": len(df_valido),
-                "accuracy": round(acc, 4),
-                "precision": round(prec, 4),
-                "recall": round(rec, 4),
-                "f1_score": round(f1, 4),
+                "n_valide": m["total"],
+                "accuracy": round(m["accuracy"], 4),
+                "precision": round(m["precision"], 4),
+                "recall": round(m["recall"], 4),
+                "f1_score": round(m["f1_score"], 4),
             }])
             metriche_df.to_csv(percorso_metriche, index=False)
             logger.info(f"Metriche salvate in '{percorso_metriche}'")
     except Exception as e:
         logger.warning(f"Impossibile salvare le metriche: {e}")
 
+    logger.info(f"Trasporto: {metriche_trasporto.summary()} | {limite_richieste.summary()}")
+    logger.info(f"Decodifica: {DECODIFICATORE.stats.summary()}")
     logger.info("=" * 70)
     logger.info("SCRIPT COMPLETATO CON SUCCESSO")
     logger.info("=" * 70)
@@ -11,6 +11,7 @@ Costo stimato: ~$0.85 per 500 trigrammi con GPT-4o
 
 import pandas as pd
 import openai
+import sys
 import time
 import json
 from pathlib import Path
@@ -18,6 +19,15 @@ from typing import Dict
 import argparse
 from tqdm import tqdm
 
+# Moduli condivisi con la pipeline di annotazione: motore (concorrenza),
+# sidecar dei risultati, metriche e, da dil_transport, solo rate limiting,
+# backoff e sessione HTTP keep-alive dell'SDK (il corpo JSON lo serializza l'SDK)
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "LLM annotation code"))
+from dil_results import ResultsSidecar, results_path  # noqa: E402
+from dil_engine import AnnotationEngine, FunctionBackend  # noqa: E402
+from dil_metrics import pair_metrics  # noqa: E402
+from dil_transport import RateLimiter, create_requests_session, jittered_backoff  # noqa: E402
+
 # ============================================================================
 # CONFIGURAZIONE
 # ============================================================================
@@ -62,7 +72,9 @@ class DILAnnotator:
         model: str = "gpt-4",
         batch_size: int = 50,
         temperature: float = 0.0,
-        max_retries: int = 3
+        max_retries: int = 3,
+        concurrency: int = 8,
+        requests_per_minute: float = 0
     ):
         """
         Inizializza l'annotatore.
@@ -70,13 +82,22 @@ class DILAnnotator:
         Args:
             api_key: Chiave API OpenAI
             model: Modello GPT da usare (gpt-4, gpt-4-turbo, gpt-3.5-turbo)
-            batch_size: Numero di righe da processare prima di salvare
+            batch_size: Righe tra due sincronizzazioni su disco del sidecar
+                dei risultati (fsync)
             temperature: Temperatura per generazione (0 = deterministico)
             max_retries: Numero massimo di retry per errori API
+            concurrency: Richieste in parallelo (thread)
+            requests_per_minute: Budget di richieste al minuto condiviso
+                tra i thread (0 = nessun limite)
         """
         openai.api_key = api_key
+        # Sessione HTTP keep-alive riusata da tutti i thread; il budget di
+        # richieste e le pause sui 429 valgono per tutti i thread insieme
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        openai.requestssession = create_requests_session(max(10, concurrency), self.rate_limiter)
         self.model = model
         self.batch_size = batch_size
+        self.concurrency = concurrency
         self.temperature = temperature
         self.max_retries = max_retries
 
@@ -116,14 +137,14 @@ class DILAnnotator:
                     return 'no'
 
             except openai.error.RateLimitError:
-                wait_time = 2 ** attempt
-                print(f"Rate limit raggiunto, attendo {wait_time}s...")
+                wait_time = jittered_backoff(attempt)
+                print(f"Rate limit raggiunto, attendo {wait_time:.1f}s...")
                 time.sleep(wait_time)
 
             except openai.error.APIError as e:
                 print(f"Errore API (tentativo {attempt+1}/{self.max_retries}): {e}")
                 if attempt < self.max_retries - 1:
-                    time.sleep(2)
+                    time.sleep(jittered_backoff(attempt, base=2))
                 else:
                     raise
 
@@ -160,46 +181,48 @@ class DILAnnotator:
         # Crea colonna per annotazioni GPT
         gpt_column = f'DIL_{self.model.replace("-", "_")}'
 
-        # Resume: carica progresso precedente
-        if resume and Path(output_file).exists():
-            df_existing = pd.read_csv(output_file, encoding='utf-8')
-            if gpt_column in df_existing.columns:
-                df[gpt_column] = df_existing[gpt_column]
-                already_done = df[gpt_column].notna().sum()
-                print(f"Ripresa da file esistente: {already_done:,} righe già annotate")
-        else:
-            df[gpt_column] = ''
+        # Resume: le etichette già prodotte sono nel sidecar append-only
+        # (alla prima ripresa di un vecchio run vengono lette dal CSV)
+        sidecar = ResultsSidecar(results_path(output_file, gpt_column), sync_every=self.batch_size)
+        results = sidecar.resume(output_file, gpt_column) if resume else sidecar.reset()
+        df[gpt_column] = pd.Series(results, index=df.index, dtype=object)
+        if results:
+            print(f"Ripresa da '{sidecar.path}': {len(results):,} righe già annotate")
 
         # Identifica righe da processare
-        mask_todo = (df[gpt_column] == '') | df[gpt_column].isna()
-        indices_todo = df[mask_todo].index.tolist()
+        indices_todo = [idx for idx in df.index if idx not in results]
 
         if not indices_todo:
             print("Tutte le righe sono già annotate!")
+            df.to_csv(output_file, index=False, encoding='utf-8')
             return df
 
         print(f"Righe da processare: {len(indices_todo):,}")
         print(f"Colonna output: {gpt_column}")
 
-        # Processa in batch con progress bar
-        for i in tqdm(range(0, len(indices_todo), self.batch_size),
-                      desc="Batch"):
-            batch_indices = indices_todo[i:i + self.batch_size]
-
-            for idx in tqdm(batch_indices, desc=f"Batch {i//self.batch_size + 1}",
-                           leave=False):
-                text = str(df.at[idx, text_column])
-                annotation = self.analyze_text(text)
-                df.at[idx, gpt_column] = annotation
-
-                # Piccolo delay per evitare rate limiting
-                time.sleep(0.1)
-
-            # Salva dopo ogni batch
+        # Richieste in parallelo su `concurrency` thread; i testi vengono
+        # estratti prima di avviarli, così i worker non leggono il DataFrame
+        # mentre il thread principale lo aggiorna
+        texts = df.loc[indices_todo, text_column].astype(str).to_dict()
+        # Motore condiviso: ogni etichetta va subito in coda al sidecar (fsync
+        # ogni batch_size righe), i testi duplicati sono annotati una sola
+        # volta; il CSV completo si scrive una volta sola
+        engine = AnnotationEngine(
+            FunctionBackend(self.analyze_text, self.model), concurrency=self.concurrency, sink=sidecar,
+            cache=False,  # una richiesta per riga anche per i testi ripetuti, come nel confronto originale
+        )
+        try:
+            with sidecar, tqdm(total=len(indices_todo), desc="Righe") as progress:
+                for idx, result in engine.run(texts):
+                    df.at[idx, gpt_column] = result.label
+                    progress.update()
+        finally:
+            # Anche su errore o interruzione il CSV riflette le righe completate
             df.to_csv(output_file, index=False, encoding='utf-8')
-            print(f"✓ Salvato batch (completate {min(i + len(batch_indices), len(indices_todo)):,}/{len(indices_todo):,} righe)")
 
         print(f"\n✓ Annotazione completata!")
+        print(f"Motore: {engine.summary()}")
+        print(f"Rate limiting: {self.rate_limiter.summary()}")
         return df
 
     def compute_metrics(
@@ -222,32 +245,19 @@ class DILAnnotator:
         if pred_column is None:
             pred_column = f'DIL_{self.model.replace("-", "_")}'
 
-        # Rimuovi righe senza predizione
-        df_eval = df.dropna(subset=[pred_column, gold_column])
-
-        # Calcola metriche
-        tp = len(df_eval[(df_eval[gold_column] == 'yes') & (df_eval[pred_column] == 'yes')])
-        tn = len(df_eval[(df_eval[gold_column] == 'no') & (df_eval[pred_column] == 'no')])
-        fp = len(df_eval[(df_eval[gold_column] == 'no') & (df_eval[pred_column] == 'yes')])
-        fn = len(df_eval[(df_eval[gold_column] == 'yes') & (df_eval[pred_column] == 'no')])
-
-        accuracy = (tp + tn) / len(df_eval) if len(df_eval) > 0 else 0
-        precision = tp / (tp + fp) if (tp + fp) > 0 else 0
-        recall = tp / (tp + fn) if (tp + fn) > 0 else 0
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        specificity = tn / (tn + fp) if (tn + fp) > 0 else 0
-
+        counts = pair_metrics(df, gold_column, pred_column)
         return {
-            'total': len(df_eval),
-            'accuracy': accuracy,
-            'precision': precision,
-            'recall': recall,
-            'specificity': specificity,
-            'f1_score': f1,
-            'true_positives': tp,
-            'true_negatives': tn,
-            'false_positives': fp,
-            'false_negatives': fn
+            'total': counts['total'],
+            'accuracy': counts['accuracy'],
+            'precision': counts['precision'],
+            'recall': counts['recall'],
+            'specificity': counts['specificity'],
+            'f1_score': counts['f1_score'],
+            'kappa': counts['kappa'],
+            'true_positives': counts['tp'],
+            'true_negatives': counts['tn'],
+            'false_positives': counts['fp'],
+            'false_negatives': counts['fn']
         }
 
     def compare_annotators(
@@ -270,32 +280,16 @@ class DILAnnotator:
         if annotator2_col is None:
             annotator2_col = f'DIL_{self.model.replace("-", "_")}'
 
-        # Rimuovi righe con dati mancanti
-        df_compare = df.dropna(subset=[annotator1_col, annotator2_col])
-
-        # Accordo totale
-        agreement = len(df_compare[df_compare[annotator1_col] == df_compare[annotator2_col]])
-        agreement_rate = agreement / len(df_compare) if len(df_compare) > 0 else 0
-
-        # Accordo per classe
-        both_yes = len(df_compare[(df_compare[annotator1_col] == 'yes') &
-                                   (df_compare[annotator2_col] == 'yes')])
-        both_no = len(df_compare[(df_compare[annotator1_col] == 'no') &
-                                  (df_compare[annotator2_col] == 'no')])
-
-        sonnet_yes_gpt_no = len(df_compare[(df_compare[annotator1_col] == 'yes') &
-                                            (df_compare[annotator2_col] == 'no')])
-        sonnet_no_gpt_yes = len(df_compare[(df_compare[annotator1_col] == 'no') &
-                                            (df_compare[annotator2_col] == 'yes')])
-
+        counts = pair_metrics(df, annotator1_col, annotator2_col)
         return {
-            'total_compared': len(df_compare),
-            'agreement': agreement,
-            'agreement_rate': agreement_rate,
-            'both_yes': both_yes,
-            'both_no': both_no,
-            'sonnet_yes_gpt_no': sonnet_yes_gpt_no,
-            'sonnet_no_gpt_yes': sonnet_no_gpt_yes
+            'total_compared': counts['total'],
+            'agreement': counts['tp'] + counts['tn'],
+            'agreement_rate': counts['accuracy'],
+            'kappa': counts['kappa'],
+            'both_yes': counts['tp'],
+            'both_no': counts['tn'],
+            'sonnet_yes_gpt_no': counts['fn'],
+            'sonnet_no_gpt_yes': counts['fp']
         }
 
 
@@ -332,7 +326,19 @@ def main():
         '--batch-size',
         type=int,
         default=50,
-        help='Numero righe per batch (salvataggio intermedio)'
+        help='Righe tra due sincronizzazioni su disco dei risultati'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Richieste in parallelo (thread)'
+    )
+    parser.add_argument(
+        '--requests-per-minute',
+        type=float,
+        default=0,
+        help='Budget di richieste al minuto condiviso tra i thread (0 = nessun limite)'
     )
     parser.add_argument(
         '--text-column',
@@ -361,7 +367,9 @@ def main():
     annotator = DILAnnotator(
         api_key=args.api_key,
         model=args.model,
-        batch_size=args.batch_size
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute
     )
 
     print("="*70)
@@ -372,6 +380,7 @@ def main():
     print(f"Input: {args.input_file}")
     print(f"Output: {args.output_file}")
     print(f"Batch size: {args.batch_size}")
+    print(f"Concorrenza: {args.concurrency}")
     print("="*70)
 
     # Annota corpus
@@ -396,6 +405,7 @@ def main():
         print(f"Recall:      {metrics['recall']:.2%}")
         print(f"Specificity: {metrics['specificity']:.2%}")
         print(f"F1-Score:    {metrics['f1_score']:.2%}")
+        print(f"Kappa:       {metrics['kappa']:.4f}")
 
         print(f"\nMatrice di confusione:")
         print(f"{'':12s} | Pred NO | Pred YES")
@@ -419,6 +429,7 @@ def main():
 
         print(f"\nRighe confrontate: {comparison['total_compared']:,}")
         print(f"Accordo totale: {comparison['agreement']:,} ({comparison['agreement_rate']:.2%})")
+        print(f"Kappa di Cohen: {comparison['kappa']:.4f}")
         print(f"\nDettaglio accordo:")
         print(f"  Entrambi YES:      {comparison['both_yes']:7d}")
         print(f"  Entrambi NO:       {comparison['both_no']:7d}")
@@ -7,6 +7,13 @@ Caratteristiche principali
   - Legge un CSV con trigrammi/brani (colonna `text` di default)
   - Aggiunge una colonna di output con le predizioni del modello OpenAI
   - Supporta ripresa (resume) da un output CSV già parzialmente annotato
+  - Esegue le richieste in parallelo su un pool di thread (--concurrency),
+    con budget di richieste al minuto condiviso e ritentativi con jitter
+  - Modalità batch (--mode batch): le richieste vengono scritte in JSONL,
+    caricate sulla Batch API OpenAI (tariffa scontata, completamento entro
+    24h) e i risultati riassegnati per indice di riga; un manifest JSON
+    permette di riprendere il polling dopo un'interruzione e reinvia le
+    righe fallite
   - Opzionalmente calcola metriche vs gold standard (colonna `DIL`) e
     confronto di accordo vs annotatore LLM (colonna `DIL_Sonnet`)
 
@@ -19,14 +26,36 @@ from __future__ import annotations
 
 import argparse
 import json
+import os
+import sys
 import time
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 from openai import OpenAI
 from tqdm import tqdm
 
+# Moduli condivisi con la pipeline di annotazione: motore (concorrenza),
+# sidecar dei risultati, metriche progressive e, da dil_transport, rate
+# limiting, backoff, client httpx keep-alive dell'SDK e codec JSON per
+# manifest e file JSONL del batch (il corpo delle chiamate lo serializza l'SDK)
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "LLM annotation code"))
+from dil_providers import OPENAI_PRICES  # noqa: E402
+from dil_results import ResultsSidecar, results_path  # noqa: E402
+from dil_engine import AnnotationEngine, FunctionBackend  # noqa: E402
+from dil_metrics import pair_metrics  # noqa: E402
+from dil_streaming import StreamingMetrics  # noqa: E402
+from dil_transport import (  # noqa: E402
+    RateLimiter,
+    TransportMetrics,
+    create_httpx_client,
+    jittered_backoff,
+    json_dumps,
+    json_loads,
+)
+
 
 # ============================================================================
 # CONFIGURAZIONE
@@ -83,7 +112,12 @@ REASONING_MODELS = {
 }
 
 
-VALID_LABELS = {"yes", "no"}
+# Batch API: limiti per file di input e sconto rispetto alle chiamate sincrone
+BATCH_ENDPOINT = "/v1/responses"
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+BATCH_DISCOUNT = 0.5
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
 
 # ============================================================================
@@ -202,6 +236,117 @@ def extract_output_text(response) -> str:
     return result
 
 
+# ============================================================================
+# BATCH API
+# ============================================================================
+
+
+def batch_custom_id(idx) -> str:
+    """custom_id della richiesta batch per la riga `idx` del corpus."""
+    return f"row-{idx}"
+
+
+def batch_row_index(custom_id: str) -> int:
+    """Indice di riga da un custom_id generato da batch_custom_id()."""
+    return int(custom_id.rsplit("-", 1)[1])
+
+
+def extract_batch_output_text(body: Dict) -> str:
+    """Estrae il testo da una risposta Responses API serializzata (dict).
+
+    Nei risultati batch la risposta arriva come JSON grezzo, senza la
+    scorciatoia `output_text` dell'SDK: si concatenano i blocchi
+    `output_text` dei messaggi, ignorando i blocchi di reasoning.
+    """
+    texts = []
+    for item in body.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content") or []:
+            if content.get("type") == "output_text" and content.get("text"):
+                texts.append(content["text"])
+    return "".join(texts).strip()
+
+
+def new_batch_manifest(input_file: str, model: str, n_rows: int, indices: List) -> Dict:
+    """Crea il manifest di un run batch: una voce per riga da annotare.
+
+    Stati di una riga:
+      - 'pending'   : mai inviata
+      - 'submitted' : in un batch non ancora raccolto
+      - 'done'      : risposta YES/NO valida
+      - 'retry'     : errore ritentabile, batch scaduto o risposta vuota
+      - 'failed'    : richiesta non valida (400) o round esauriti
+    """
+    return {
+        "created": datetime.now().isoformat(),
+        "input_file": input_file,
+        "model": model,
+        "n_rows": n_rows,
+        "status": "in_progress",
+        "round": 0,
+        "batches": [],
+        "usage": {"input_tokens": 0, "output_tokens": 0},
+        "rows": {str(idx): {"status": "pending", "attempts": 0, "outcomes": []} for idx in indices},
+    }
+
+
+def load_batch_manifest(path: str) -> Optional[Dict]:
+    """Carica il manifest se esiste, altrimenti None."""
+    if not Path(path).exists():
+        return None
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
+
+def save_batch_manifest(manifest: Dict, path: str) -> None:
+    """Salva il manifest in modo atomico (file temporaneo + rename)."""
+    manifest["updated"] = datetime.now().isoformat()
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(json_dumps(manifest))
+    os.replace(tmp, path)
+
+
+def batch_manifest_summary(manifest: Dict) -> Dict:
+    """Conteggio delle righe per stato."""
+    counts: Dict[str, int] = {}
+    for row in manifest["rows"].values():
+        counts[row["status"]] = counts.get(row["status"], 0) + 1
+    return counts
+
+
+def rows_to_submit(manifest: Dict, max_rounds: int) -> List[int]:
+    """Righe da includere nel prossimo round: mai inviate o da ritentare.
+
+    Le righe che hanno già avuto `max_rounds` invii passano a 'failed'.
+    """
+    todo = []
+    for key, row in manifest["rows"].items():
+        if row["status"] == "pending":
+            todo.append(int(key))
+        elif row["status"] == "retry":
+            if row["attempts"] < max_rounds:
+                todo.append(int(key))
+            else:
+                row["status"] = "failed"
+    return todo
+
+
+def split_batch_lines(lines: List[bytes]) -> List[List[bytes]]:
+    """Suddivide le righe JSONL in file entro i limiti della Batch API."""
+    shards, current, current_bytes = [], [], 0
+    for line in lines:
+        if current and (len(current) >= BATCH_MAX_REQUESTS or current_bytes + len(line) > BATCH_MAX_BYTES):
+            shards.append(current)
+            current, current_bytes = [], 0
+        current.append(line)
+        current_bytes += len(line)
+    if current:
+        shards.append(current)
+    return shards
+
+
 # ============================================================================
 # CLASSE PRINCIPALE
 # ============================================================================
@@ -218,11 +363,26 @@ class DILAnnotator:
         max_retries: int = 3,
         reasoning_effort: str = "medium",
         request_timeout_s: float = 120.0,
+        http2: bool = False,
         debug: bool = False,
+        concurrency: int = 8,
+        requests_per_minute: float = 0,
     ):
-        self.client = OpenAI(api_key=api_key, timeout=request_timeout_s)
+        # Client HTTP con pool keep-alive condiviso tra tutti i thread; il
+        # budget di richieste (0 = nessun limite) e le pause sui 429 valgono
+        # per tutti i thread insieme
+        self.transport_metrics = TransportMetrics()
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.client = OpenAI(
+            api_key=api_key,
+            http_client=create_httpx_client(
+                timeout=request_timeout_s, max_connections=max(10, concurrency), http2=http2,
+                metrics=self.transport_metrics, rate_limiter=self.rate_limiter,
+            ),
+        )
         self.model = model
         self.batch_size = batch_size
+        self.concurrency = concurrency
         self.max_retries = max_retries
         self.reasoning_effort = reasoning_effort
         self.is_reasoning_model = model in REASONING_MODELS
@@ -240,7 +400,7 @@ class DILAnnotator:
                 if not answer_text or answer_text.strip() == "":
                     print(f"WARNING: risposta vuota al tentativo {attempt+1}/{self.max_retries}")
                     if attempt < self.max_retries - 1:
-                        time.sleep(2)
+                        time.sleep(jittered_backoff(attempt, base=2))
                         continue
                     # Se anche l'ultimo tentativo fallisce, ritorna default
                     print("ERROR: Tutti i tentativi hanno prodotto risposte vuote, assumo 'no'")
@@ -253,14 +413,14 @@ class DILAnnotator:
                 # aggiuntivo (utile se stai facendo molte chiamate ravvicinate).
                 error_name = type(e).__name__
                 if "RateLimit" in error_name or "429" in str(e):
-                    wait_time = 2 ** attempt
-                    print(f"Rate limit, attendo {wait_time}s...")
+                    wait_time = jittered_backoff(attempt)
+                    print(f"Rate limit, attendo {wait_time:.1f}s...")
                     time.sleep(wait_time)
                     continue
 
                 print(f"Errore API (tentativo {attempt+1}/{self.max_retries}): {e}")
                 if attempt < self.max_retries - 1:
-                    time.sleep(2)
+                    time.sleep(jittered_backoff(attempt, base=2))
                     continue
                 raise
 
@@ -268,8 +428,8 @@ class DILAnnotator:
         print("ERROR: Esauriti tutti i tentativi, assumo 'no'")
         return "no"
 
-    def _call_responses_api(self, user_prompt: str) -> str:
-        """Chiama la Responses API e ritorna testo."""
+    def _request_params(self, user_prompt: str) -> Dict:
+        """Parametri della Responses API, comuni a chiamate sincrone e batch."""
         params = {
             "model": self.model,
             "instructions": SYSTEM_PROMPT,
@@ -281,6 +441,11 @@ class DILAnnotator:
         # (Per gpt-5.2 sono supportati: none (default), low, medium, high, xhigh.)
         #if self.is_reasoning_model and self.reasoning_effort:
         #    params["reasoning"] = {"effort": self.reasoning_effort}
+        return params
+
+    def _call_responses_api(self, user_prompt: str) -> str:
+        """Chiama la Responses API e ritorna testo."""
+        params = self._request_params(user_prompt)
 
         if self.debug:
             print(f"DEBUG: chiamata API con model={self.model}, effort={self.reasoning_effort}")
@@ -303,17 +468,15 @@ class DILAnnotator:
             print(f"ERROR nella chiamata API: {type(e).__name__}: {e}")
             raise
 
-    def annotate_corpus(
-        self,
-        input_file: str,
-        output_file: str,
-        text_column: str = "text",
-        resume: bool = True,
-        save_every_batch: bool = True,
-        inter_request_sleep_s: float = 0.1,
-    ) -> pd.DataFrame:
-        """Annota un CSV e salva incrementalmente in output_file."""
+    def _load_corpus(
+        self, input_file: str, output_file: str, text_column: str, resume: bool
+    ) -> Tuple[pd.DataFrame, str, List, ResultsSidecar]:
+        """Carica il corpus e le annotazioni già prodotte.
 
+        Ritorna (df, colonna di output, indici delle righe ancora vuote,
+        sidecar dei risultati): la ripresa è la stessa in modalità sincrona
+        e batch.
+        """
         df = pd.read_csv(input_file, encoding="utf-8")
         print(f"Corpus caricato: {len(df):,} righe")
         print(f"Colonne presenti: {', '.join(df.columns)}")
@@ -329,59 +492,326 @@ class DILAnnotator:
         safe_model = sanitize_model_name(self.model)
         gpt_column = f"DIL_{safe_model}"
 
-        # Resume: carica progresso precedente
-        if resume and Path(output_file).exists():
-            df_existing = pd.read_csv(output_file, encoding="utf-8")
-            if gpt_column in df_existing.columns:
-                # FIX: assicura dtype object per evitare errori con stringhe vuote
-                df[gpt_column] = df_existing[gpt_column].astype(object)
-                already_done = (
-                    df[gpt_column].notna() & (df[gpt_column].astype(str).str.strip() != "")
-                ).sum()
-                print(f"Ripresa da file esistente: {already_done:,} righe già annotate")
-            else:
-                # FIX: inizializza con dtype object
-                df[gpt_column] = pd.Series(dtype=object)
-        else:
-            # FIX: inizializza con dtype object
-            df[gpt_column] = pd.Series(dtype=object)
+        # Resume: le etichette già prodotte sono nel sidecar append-only
+        # (alla prima ripresa di un vecchio run vengono lette dal CSV)
+        sidecar = ResultsSidecar(results_path(output_file, gpt_column), sync_every=self.batch_size)
+        results = sidecar.resume(output_file, gpt_column) if resume else sidecar.reset()
+        df[gpt_column] = pd.Series(results, index=df.index, dtype=object)
+        if results:
+            print(f"Ripresa da '{sidecar.path}': {len(results):,} righe già annotate")
 
         # Righe da processare
-        mask_todo = df[gpt_column].isna() | (df[gpt_column].astype(str).str.strip() == "")
-        indices_todo = df[mask_todo].index.tolist()
+        indices_todo = [idx for idx in df.index if idx not in results]
 
         if not indices_todo:
             print("Tutte le righe sono già annotate!")
-            return df
+            return df, gpt_column, indices_todo, sidecar
 
         print(f"Righe da processare: {len(indices_todo):,}")
         print(f"Colonna output: {gpt_column}")
         print(f"Modello: {self.model} {'(reasoning)' if self.is_reasoning_model else ''}")
+        return df, gpt_column, indices_todo, sidecar
 
-        for i in tqdm(range(0, len(indices_todo), self.batch_size), desc="Batch"):
-            batch_indices = indices_todo[i : i + self.batch_size]
+    def annotate_corpus(
+        self,
+        input_file: str,
+        output_file: str,
+        text_column: str = "text",
+        resume: bool = True,
+        gold_column: str = "DIL",
+        early_stop_kappa: Optional[float] = None,
+        early_stop_min_rows: int = 100,
+    ) -> pd.DataFrame:
+        """Annota un CSV e salva il risultato in output_file.
+
+        Le righe vengono annotate da `concurrency` thread in parallelo; ogni
+        etichetta è aggiunta subito al sidecar dei risultati, quindi la
+        ripresa riparte dalle sole righe mancanti. Il CSV completo viene
+        scritto una volta, a fine run o in caso di interruzione.
+
+        Se il CSV ha la colonna gold, accuracy, F1 e kappa con intervalli
+        al 95% sono aggiornate a ogni riga e mostrate nella barra di
+        avanzamento; con early_stop_kappa il run si interrompe quando,
+        dopo early_stop_min_rows righe, l'intervallo della kappa è tutto
+        sotto la soglia: non partono altre richieste, quelle già in volo
+        vengono attese e salvate nel sidecar (sono già pagate) e le righe
+        mancanti restano da riprendere.
+        """
+        df, gpt_column, indices_todo, sidecar = self._load_corpus(input_file, output_file, text_column, resume)
+        if not indices_todo:
+            df.to_csv(output_file, index=False, encoding="utf-8")
+            return df
 
-            for idx in tqdm(batch_indices, desc=f"Batch {i // self.batch_size + 1}", leave=False):
-                text = str(df.at[idx, text_column])
-                result = self.analyze_text(text)
-                df.at[idx, gpt_column] = result
-                
-                if self.debug:
-                    print(f"DEBUG: idx={idx}, result='{result}'")
-                
-                time.sleep(inter_request_sleep_s)
+        print(f"Concorrenza: {self.concurrency} thread")
+
+        # Metriche progressive vs gold, a partire dalle righe già annotate
+        stream = None
+        if gold_column in df.columns:
+            stream = StreamingMetrics()
+            done = df.index.difference(indices_todo)
+            stream.update_many(df.loc[done, gold_column], df.loc[done, gpt_column])
+        elif early_stop_kappa is not None:
+            print(f"WARNING: colonna gold '{gold_column}' non trovata, arresto anticipato disattivato")
+        stopped = False
+
+        # I testi vengono estratti prima di avviare i thread: i worker non
+        # leggono il DataFrame mentre il thread principale lo aggiorna
+        texts = df.loc[indices_todo, text_column].astype(str).to_dict()
+        # Motore condiviso: ogni etichetta va subito nel sidecar (fsync ogni
+        # batch_size righe)
+        engine = AnnotationEngine(
+            FunctionBackend(self.analyze_text, self.model), concurrency=self.concurrency, sink=sidecar,
+            cache=False,  # una richiesta per riga anche per i testi ripetuti, come nel confronto originale
+        )
+        try:
+            with sidecar, tqdm(total=len(indices_todo), desc="Righe") as progress:
+                # L'arresto passa per `stop` e non per un break: le richieste
+                # già in volo arrivano comunque qui e nel sidecar
+                for idx, result in engine.run(texts, stop=lambda: stopped):
+                    df.at[idx, gpt_column] = result.label
+                    progress.update()
+
+                    if self.debug:
+                        print(f"DEBUG: idx={idx}, result='{result.label}'")
+
+                    if stream is not None:
+                        stream.update(df.at[idx, gold_column], result.label)
+                        progress.set_postfix_str(stream.summary(), refresh=False)
+                        if not stopped and stream.should_stop(early_stop_kappa, early_stop_min_rows):
+                            stopped = True
+        finally:
+            # Anche su errore o interruzione il CSV riflette le righe completate
+            df.to_csv(output_file, index=False, encoding="utf-8")
+
+        if stopped:
+            print(
+                f"\n⚠ Arresto anticipato: kappa vs {gold_column} sotto {early_stop_kappa} "
+                f"(intervallo al 95%). Le righe mancanti restano da annotare."
+            )
+        else:
+            print("\n✓ Annotazione completata!")
+        if stream is not None:
+            print(f"Metriche progressive vs {gold_column}: {stream.summary()}")
+        print(f"Motore: {engine.summary()}")
+        print(f"Trasporto: {self.transport_metrics.summary()} | {self.rate_limiter.summary()}")
+        return df
+
+    def annotate_corpus_batch(
+        self,
+        input_file: str,
+        output_file: str,
+        text_column: str = "text",
+        resume: bool = True,
+        manifest_file: Optional[str] = None,
+        poll_interval_s: float = 60.0,
+        max_rounds: int = 3,
+    ) -> pd.DataFrame:
+        """Annota un CSV tramite la Batch API OpenAI.
+
+        Ogni round scrive in JSONL le richieste delle righe ancora vuote
+        (custom_id = indice di riga), le carica come uno o più batch sulla
+        Responses API, attende il completamento e riassegna i risultati per
+        indice. Le righe con errore ritentabile, batch scaduto o risposta
+        vuota vengono reinviate nel round successivo, fino a `max_rounds`
+        invii per riga.
+
+        Le etichette vanno nel sidecar dei risultati man mano che i batch
+        vengono raccolti e il manifest è salvato dopo ogni invio e ogni
+        raccolta: rilanciando lo script si riprende il polling dei batch
+        ancora aperti senza reinviarli. Il CSV viene scritto a fine run.
+        """
+        df, gpt_column, indices_todo, sidecar = self._load_corpus(input_file, output_file, text_column, resume)
+        if manifest_file is None:
+            manifest_file = output_file.replace(".csv", f"_batch_manifest_{sanitize_model_name(self.model)}.json")
+
+        manifest = load_batch_manifest(manifest_file) if resume else None
+        if manifest is not None and manifest["status"] == "in_progress":
+            if (manifest["input_file"], manifest["model"], manifest["n_rows"]) != (input_file, self.model, len(df)):
+                raise ValueError(
+                    f"Il manifest '{manifest_file}' si riferisce a un altro run "
+                    f"({manifest['input_file']}, {manifest['model']}, {manifest['n_rows']} righe). "
+                    "Usa --no-resume per avviarne uno nuovo."
+                )
+            print(f"Ripresa dal manifest '{manifest_file}': {batch_manifest_summary(manifest)}")
+        elif not indices_todo:
+            df.to_csv(output_file, index=False, encoding="utf-8")
+            return df
+        else:
+            manifest = new_batch_manifest(input_file, self.model, len(df), indices_todo)
+            save_batch_manifest(manifest, manifest_file)
 
-            if save_every_batch:
-                df.to_csv(output_file, index=False, encoding="utf-8")
-                done = min(i + len(batch_indices), len(indices_todo))
-                print(f"✓ Salvato batch (completate {done:,}/{len(indices_todo):,} righe)")
+        rows = manifest["rows"]
+        texts = df[text_column].astype(str)
 
-        if not save_every_batch:
+        try:
+            with sidecar:
+                while True:
+                    open_batches = [b for b in manifest["batches"] if b["status"] == "submitted"]
+
+                    if not open_batches:
+                        # Righe annotate nel frattempo (es. da un run sincrono) non
+                        # vanno reinviate
+                        empty = set(df.index[df[gpt_column].isna()])
+                        for key, row in rows.items():
+                            if row["status"] in ("pending", "retry") and int(key) not in empty:
+                                row["status"] = "done"
+
+                        todo = rows_to_submit(manifest, max_rounds)
+                        if not todo:
+                            break
+                        manifest["round"] += 1
+                        print(f"\nRound {manifest['round']}: invio di {len(todo):,} righe")
+                        open_batches = self._submit_batches(todo, texts, manifest, manifest_file)
+
+                    for batch in self._iter_finished_batches([b["id"] for b in open_batches], poll_interval_s):
+                        self._collect_batch(batch, df, gpt_column, manifest, sidecar)
+                        # Le etichette raccolte sono su disco prima che il
+                        # manifest segni il batch come raccolto
+                        sidecar.sync()
+                        for entry in manifest["batches"]:
+                            if entry["id"] == batch.id:
+                                entry["status"] = "collected"
+                                entry["final_status"] = batch.status
+                        save_batch_manifest(manifest, manifest_file)
+
+                    # Righe inviate ma assenti sia dall'output sia dal file di errori
+                    for row in rows.values():
+                        if row["status"] == "submitted":
+                            row["status"] = "retry"
+                            row["outcomes"].append("missing")
+                    save_batch_manifest(manifest, manifest_file)
+                    print(f"Fine round {manifest['round']}: {batch_manifest_summary(manifest)}")
+        finally:
+            # Anche su errore o interruzione il CSV riflette le righe raccolte
             df.to_csv(output_file, index=False, encoding="utf-8")
 
-        print("\n✓ Annotazione completata!")
+        manifest["status"] = "completed"
+        save_batch_manifest(manifest, manifest_file)
+
+        usage = manifest["usage"]
+        cost = (usage["input_tokens"] * OPENAI_PRICES[0] + usage["output_tokens"] * OPENAI_PRICES[1]) / 1e6
+        print("\n✓ Annotazione batch completata!")
+        print(f"Round: {manifest['round']} | Righe: {batch_manifest_summary(manifest)}")
+        print(
+            f"Token: {usage['input_tokens']:,} input, {usage['output_tokens']:,} output | "
+            f"costo stimato ${cost * BATCH_DISCOUNT:.2f} (sincrono: ${cost:.2f})"
+        )
+        failed = sum(1 for row in rows.values() if row["status"] == "failed")
+        if failed:
+            print(f"WARNING: {failed:,} righe senza annotazione (dettaglio in '{manifest_file}')")
         return df
 
+    def _submit_batches(self, todo: List[int], texts: pd.Series, manifest: Dict, manifest_file: str) -> List[Dict]:
+        """Scrive le richieste in JSONL, le carica e crea un batch per file."""
+        lines = [
+            json_dumps({
+                "custom_id": batch_custom_id(idx),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": self._request_params(USER_PROMPT_TEMPLATE.format(testo_blocco=texts[idx])),
+            }) + b"\n"
+            for idx in todo
+        ]
+        shards = split_batch_lines(lines)
+        prefix = str(Path(manifest_file).with_suffix("")).replace("_manifest", "_requests")
+
+        created, offset = [], 0
+        for number, shard in enumerate(shards, 1):
+            requests_file = f"{prefix}_round{manifest['round']}_{number}.jsonl"
+            with open(requests_file, "wb") as f:
+                f.writelines(shard)
+            with open(requests_file, "rb") as f:
+                uploaded = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window="24h",
+                metadata={"description": f"DIL {self.model} round {manifest['round']}"},
+            )
+
+            # Il manifest va salvato subito dopo ogni creazione: un batch
+            # non registrato verrebbe reinviato alla ripresa
+            entry = {"id": batch.id, "input_file_id": uploaded.id, "round": manifest["round"],
+                     "n_requests": len(shard), "status": "submitted"}
+            manifest["batches"].append(entry)
+            for idx in todo[offset:offset + len(shard)]:
+                row = manifest["rows"][str(idx)]
+                row["status"] = "submitted"
+                row["attempts"] += 1
+            offset += len(shard)
+            save_batch_manifest(manifest, manifest_file)
+            created.append(entry)
+            print(f"Batch {number}/{len(shards)} creato. ID: {batch.id} ({len(shard):,} richieste)")
+        return created
+
+    def _iter_finished_batches(self, batch_ids: List[str], poll_interval_s: float):
+        """Restituisce i batch man mano che raggiungono uno stato finale."""
+        pending = list(batch_ids)
+        while pending:
+            for batch_id in list(pending):
+                batch = self.client.batches.retrieve(batch_id)
+                counts = batch.request_counts
+                if batch.status in BATCH_TERMINAL_STATUSES:
+                    pending.remove(batch_id)
+                    print(
+                        f"Batch {batch_id}: {batch.status} "
+                        f"({counts.completed:,} completate, {counts.failed:,} errori su {counts.total:,})"
+                        if counts else f"Batch {batch_id}: {batch.status}"
+                    )
+                    if batch.status == "failed" and batch.errors:
+                        for error in batch.errors.data or []:
+                            print(f"  ERROR: {error.code}: {error.message}")
+                    yield batch
+                elif self.debug:
+                    print(f"DEBUG: batch {batch_id} {batch.status} ({counts.completed if counts else 0:,} completate)")
+            if pending:
+                time.sleep(poll_interval_s)
+
+    def _collect_batch(
+        self, batch, df: pd.DataFrame, gpt_column: str, manifest: Dict, sidecar: ResultsSidecar
+    ) -> None:
+        """Scarica output ed errori di un batch e li assegna alle righe."""
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            with self.client.files.with_streaming_response.content(file_id) as response:
+                for line in response.iter_lines():
+                    if line.strip():
+                        self._apply_batch_result(json_loads(line), df, gpt_column, manifest, sidecar)
+
+    def _apply_batch_result(
+        self, result: Dict, df: pd.DataFrame, gpt_column: str, manifest: Dict, sidecar: ResultsSidecar
+    ) -> None:
+        """Aggiorna DataFrame e manifest con il risultato di una richiesta."""
+        idx = batch_row_index(result["custom_id"])
+        row = manifest["rows"].get(str(idx))
+        if row is None or row["status"] != "submitted":
+            return
+
+        response = result.get("response") or {}
+        status_code = response.get("status_code")
+        body = response.get("body") or {}
+        if status_code == 200:
+            usage = body.get("usage") or {}
+            manifest["usage"]["input_tokens"] += usage.get("input_tokens", 0)
+            manifest["usage"]["output_tokens"] += usage.get("output_tokens", 0)
+            text = extract_batch_output_text(body)
+            if text:
+                label = normalize_binary_answer(text)
+                sidecar.write(idx, label)
+                df.at[idx, gpt_column] = label
+                row["status"] = "done"
+                row["outcomes"].append(label)
+                return
+            outcome = "empty"
+        else:
+            error = body.get("error") or result.get("error") or {}
+            outcome = f"{status_code}:{error.get('code') or error.get('type') or 'error'}"
+
+        # Una richiesta non valida fallirebbe identica a ogni nuovo invio
+        row["status"] = "failed" if status_code == 400 else "retry"
+        row["outcomes"].append(outcome)
+
     def compute_metrics(
         self,
         df: pd.DataFrame,
@@ -398,31 +828,19 @@ class DILAnnotator:
         if pred_column not in df.columns:
             raise ValueError(f"Colonna pred '{pred_column}' non trovata")
 
-        df_eval = df[df[pred_column].isin(VALID_LABELS) & df[gold_column].isin(VALID_LABELS)]
-
-        tp = len(df_eval[(df_eval[gold_column] == "yes") & (df_eval[pred_column] == "yes")])
-        tn = len(df_eval[(df_eval[gold_column] == "no") & (df_eval[pred_column] == "no")])
-        fp = len(df_eval[(df_eval[gold_column] == "no") & (df_eval[pred_column] == "yes")])
-        fn = len(df_eval[(df_eval[gold_column] == "yes") & (df_eval[pred_column] == "no")])
-
-        total = len(df_eval)
-        accuracy = (tp + tn) / total if total else 0.0
-        precision = tp / (tp + fp) if (tp + fp) else 0.0
-        recall = tp / (tp + fn) if (tp + fn) else 0.0
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) else 0.0
-        specificity = tn / (tn + fp) if (tn + fp) else 0.0
-
+        counts = pair_metrics(df, gold_column, pred_column)
         return {
-            "total": total,
-            "accuracy": accuracy,
-            "precision": precision,
-            "recall": recall,
-            "specificity": specificity,
-            "f1_score": f1,
-            "true_positives": tp,
-            "true_negatives": tn,
-            "false_positives": fp,
-            "false_negatives": fn,
+            "total": counts["total"],
+            "accuracy": counts["accuracy"],
+            "precision": counts["precision"],
+            "recall": counts["recall"],
+            "specificity": counts["specificity"],
+            "f1_score": counts["f1_score"],
+            "kappa": counts["kappa"],
+            "true_positives": counts["tp"],
+            "true_negatives": counts["tn"],
+            "false_positives": counts["fp"],
+            "false_negatives": counts["fn"],
         }
 
     def compare_annotators(
@@ -441,29 +859,16 @@ class DILAnnotator:
         if annotator2_col not in df.columns:
             raise ValueError(f"Colonna annotatore2 '{annotator2_col}' non trovata")
 
-        df_compare = df[df[annotator1_col].isin(VALID_LABELS) & df[annotator2_col].isin(VALID_LABELS)]
-
-        agreement = len(df_compare[df_compare[annotator1_col] == df_compare[annotator2_col]])
-        total = len(df_compare)
-        agreement_rate = agreement / total if total else 0.0
-
-        both_yes = len(df_compare[(df_compare[annotator1_col] == "yes") & (df_compare[annotator2_col] == "yes")])
-        both_no = len(df_compare[(df_compare[annotator1_col] == "no") & (df_compare[annotator2_col] == "no")])
-        sonnet_yes_gpt_no = len(
-            df_compare[(df_compare[annotator1_col] == "yes") & (df_compare[annotator2_col] == "no")]
-        )
-        sonnet_no_gpt_yes = len(
-            df_compare[(df_compare[annotator1_col] == "no") & (df_compare[annotator2_col] == "yes")]
-        )
-
+        counts = pair_metrics(df, annotator1_col, annotator2_col)
         return {
-            "total_compared": total,
-            "agreement": agreement,
-            "agreement_rate": agreement_rate,
-            "both_yes": both_yes,
-            "both_no": both_no,
-            "sonnet_yes_gpt_no": sonnet_yes_gpt_no,
-            "sonnet_no_gpt_yes": sonnet_no_gpt_yes,
+            "total_compared": counts["total"],
+            "agreement": counts["tp"] + counts["tn"],
+            "agreement_rate": counts["accuracy"],
+            "kappa": counts["kappa"],
+            "both_yes": counts["tp"],
+            "both_no": counts["tn"],
+            "sonnet_yes_gpt_no": counts["fn"],
+            "sonnet_no_gpt_yes": counts["fp"],
         }
 
 
@@ -486,12 +891,45 @@ def main() -> None:
         choices=["none", "low", "medium", "high", "xhigh"],
         help="Sforzo reasoning (per modelli che lo supportano).",
     )
-    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=5, help="Righe tra due sincronizzazioni su disco dei risultati")
+    parser.add_argument("--concurrency", type=int, default=8, help="Richieste in parallelo (thread)")
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=0,
+        help="Budget di richieste al minuto condiviso tra i thread (0 = nessun limite)",
+    )
+    parser.add_argument(
+        "--mode",
+        default="live",
+        choices=["live", "batch"],
+        help="live: chiamate sincrone in parallelo; batch: Batch API (scontata, entro 24h)",
+    )
+    parser.add_argument(
+        "--manifest-file",
+        default=None,
+        help="Manifest del run batch (default: <output>_batch_manifest_<modello>.json)",
+    )
+    parser.add_argument("--poll-interval", type=float, default=60, help="Secondi tra due controlli dei batch")
+    parser.add_argument("--max-batch-rounds", type=int, default=3, help="Invii massimi per riga in modalità batch")
     parser.add_argument("--text-column", default="text")
     parser.add_argument("--no-resume", action="store_true")
     parser.add_argument("--eval", action="store_true", help="Calcola metriche vs gold (colonna DIL)")
+    parser.add_argument(
+        "--early-stop-kappa",
+        type=float,
+        default=None,
+        help="Interrompe il run live se l'intervallo al 95%% della kappa vs DIL è tutto sotto questa soglia",
+    )
+    parser.add_argument(
+        "--early-stop-min-rows",
+        type=int,
+        default=100,
+        help="Righe valutabili minime prima dell'arresto anticipato",
+    )
     parser.add_argument("--compare", action="store_true", help="Confronta Sonnet vs GPT")
     parser.add_argument("--debug", action="store_true", help="Attiva modalità debug con output verbose")
+    parser.add_argument("--http2", action="store_true", help="Usa HTTP/2 (richiede httpx[http2])")
 
     args = parser.parse_args()
 
@@ -512,7 +950,10 @@ def main() -> None:
         model=args.model,
         batch_size=args.batch_size,
         reasoning_effort=reasoning_effort,
+        http2=args.http2,
         debug=args.debug,
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
     )
 
     print("=" * 70)
@@ -524,17 +965,33 @@ def main() -> None:
         print(f"Reasoning effort: {args.reasoning_effort}")
     print(f"Input:  {args.input_file}")
     print(f"Output: {args.output_file}")
-    print(f"Batch size: {args.batch_size}")
+    print(f"Modalità: {args.mode}")
+    if args.mode == "live":
+        print(f"Batch size: {args.batch_size}")
+        print(f"Concorrenza: {args.concurrency}")
     if args.debug:
         print("Modalità DEBUG: attiva")
     print("=" * 70)
 
-    df = annotator.annotate_corpus(
-        input_file=args.input_file,
-        output_file=args.output_file,
-        text_column=args.text_column,
-        resume=not args.no_resume,
-    )
+    if args.mode == "batch":
+        df = annotator.annotate_corpus_batch(
+            input_file=args.input_file,
+            output_file=args.output_file,
+            text_column=args.text_column,
+            resume=not args.no_resume,
+            manifest_file=args.manifest_file,
+            poll_interval_s=args.poll_interval,
+            max_rounds=args.max_batch_rounds,
+        )
+    else:
+        df = annotator.annotate_corpus(
+            input_file=args.input_file,
+            output_file=args.output_file,
+            text_column=args.text_column,
+            resume=not args.no_resume,
+            early_stop_kappa=args.early_stop_kappa,
+            early_stop_min_rows=args.early_stop_min_rows,
+        )
 
     safe_model = sanitize_model_name(args.model)
 
@@ -551,6 +1008,7 @@ def main() -> None:
         print(f"Recall:      {metrics['recall']:.2%}")
         print(f"Specificity: {metrics['specificity']:.2%}")
         print(f"F1-Score:    {metrics['f1_score']:.2%}")
+        print(f"Kappa:       {metrics['kappa']:.4f}")
 
         print("\nMatrice di confusione:")
         print(f"{'':12s} | Pred NO | Pred YES")
@@ -571,6 +1029,7 @@ def main() -> None:
         comparison = annotator.compare_annotators(df)
         print(f"\nRighe confrontate: {comparison['total_compared']:,}")
         print(f"Accordo totale: {comparison['agreement']:,} ({comparison['agreement_rate']:.2%})")
+        print(f"Kappa di Cohen: {comparison['kappa']:.4f}")
         print("\nDettaglio accordo:")
         print(f"  Entrambi YES:       {comparison['both_yes']:7d}")
         print(f"  Entrambi NO:        {comparison['both_no']:7d}")
@@ -5,7 +5,6 @@ usando Claude Sonnet 4.5 via API Anthropic.
 """
 
 import asyncio
-import aiohttp
 import csv
 import json
 import logging
@@ -13,9 +12,14 @@ import os
 import time
 from pathlib import Path
 from dataclasses import dataclass, asdict
-from typing import List, Dict, Optional
+from typing import List, Dict
 from datetime import datetime
 
+from dil_cascade import DILPreClassifier
+from dil_engine import AnnotationEngine
+from dil_providers import HedgedDispatcher, ProviderResult, create_backend
+from dil_transport import HTTPTransport
+
 # Prompt templates
 SYSTEM_PROMPT = """Sei un esperto linguista. Analizza il testo fornito per identificare la presenza di discorso indiretto libero."""
 
@@ -44,6 +48,8 @@ class AnnotationState:
     completed_files: List[str] = None
     start_time: str = ""
     total_cost: float = 0.0
+    auto_resolved_chunks: int = 0
+    hedged_chunks: int = 0
 
     def __post_init__(self):
         if self.completed_files is None:
@@ -65,11 +71,27 @@ class DILAnnotator:
         self.max_retries = self.config['max_retries']
         self.retry_delay = self.config['retry_delay']
         self.checkpoint_interval = self.config['checkpoint_interval']
+        # Finestra di riordino longest-first (0 = ordine originale del file):
+        # sul backend simulato il guadagno è trascurabile (~1-2%), quindi è
+        # disattivata di default
+        self.schedule_window = self.config.get('schedule_window', 0)
 
         self.input_dir = Path(self.config['input_dir'])
         self.output_dir = Path(self.config['output_dir'])
         self.state_file = Path(self.config['state_file'])
 
+        # Cascata cheap-first: pre-classificatore locale davanti all'API
+        self.cascade = None
+        if self.config.get('cascade_enabled', False):
+            self.cascade = DILPreClassifier.from_config(self.config)
+
+        # Backend: 'api' (Claude via HTTP) oppure 'distilled' (modello locale)
+        self.backend = self.config.get('backend', 'api')
+        self.local_model = None
+        if self.backend == 'distilled':
+            from dil_distilled import DistilledDILModel
+            self.local_model = DistilledDILModel.load(self.config['distilled_model_path'])
+
         # Crea directory output
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
@@ -89,13 +111,40 @@ class DILAnnotator:
 
         # Statistiche sessione
         self.session_start = time.time()
-        self.requests_made = 0
         self.input_tokens = 0
         self.output_tokens = 0
+        self.api_cost = 0.0
+
+        # Trasporto HTTP condiviso (la sessione viene aperta in annotate_corpus)
+        self.transport = HTTPTransport.from_config(self.config)
+
+        # Provider: primario ed eventuale secondario per le richieste hedged
+        primary = create_backend(
+            self.config.get('primary_provider', 'anthropic'), self.config,
+            SYSTEM_PROMPT, USER_PROMPT_TEMPLATE, self.logger
+        )
+        secondary = None
+        if self.config.get('hedging_enabled', False):
+            secondary = create_backend(
+                self.config['secondary_provider'], self.config,
+                SYSTEM_PROMPT, USER_PROMPT_TEMPLATE, self.logger
+            )
+        self.dispatcher = HedgedDispatcher(
+            primary, secondary,
+            hedge_quantile=self.config.get('hedge_quantile', 0.95),
+            logger=self.logger
+        )
 
-        # Pricing ($/MTok)
-        self.input_price = 3.00
-        self.output_price = 15.00
+        # Motore condiviso: scheduling longest-first, concorrenza e cache LRU
+        # dei testi già annotati (anche tra file diversi), limitata a
+        # cache_size voci per non crescere con il corpus
+        self.engine = AnnotationEngine(
+            self.dispatcher,
+            concurrency=self.max_concurrent,
+            schedule_window=self.schedule_window,
+            overhead_chars=len(SYSTEM_PROMPT) + len(USER_PROMPT_TEMPLATE),
+            cache_size=self.config.get('cache_size', 100_000),
+        )
 
     def _load_state(self) -> AnnotationState:
         """Carica stato da file o crea nuovo."""
@@ -115,68 +164,15 @@ class DILAnnotator:
         with open(self.state_file, 'w') as f:
             json.dump(asdict(self.state), f, indent=2)
 
-    async def _call_api(self, session: aiohttp.ClientSession, chunk_text: str) -> Optional[str]:
-        """Chiama API Anthropic per annotare un chunk."""
-        url = "https://api.anthropic.com/v1/messages"
-        headers = {
-            "x-api-key": self.api_key,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json"
-        }
-
-        prompt = USER_PROMPT_TEMPLATE.format(testo_blocco=chunk_text)
-
-        payload = {
-            "model": self.model,
-            "max_tokens": 10,  # Solo "YES" o "NO"
-            "system": SYSTEM_PROMPT,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ]
-        }
-
-        for attempt in range(self.max_retries):
-            try:
-                async with session.post(url, headers=headers, json=payload) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-
-                        # Estrai risposta
-                        response_text = data['content'][0]['text'].strip().upper()
-
-                        # Traccia token usage
-                        usage = data.get('usage', {})
-                        self.input_tokens += usage.get('input_tokens', 0)
-                        self.output_tokens += usage.get('output_tokens', 0)
-
-                        # Normalizza risposta
-                        if 'YES' in response_text:
-                            return 'YES'
-                        elif 'NO' in response_text:
-                            return 'NO'
-                        else:
-                            self.logger.warning(f"Risposta ambigua: {response_text}")
-                            return 'UNCLEAR'
-
-                    elif resp.status == 429:
-                        # Rate limit
-                        retry_after = int(resp.headers.get('retry-after', self.retry_delay * (attempt + 1)))
-                        self.logger.warning(f"Rate limit hit, retry dopo {retry_after}s")
-                        await asyncio.sleep(retry_after)
-
-                    else:
-                        error_text = await resp.text()
-                        self.logger.error(f"API error {resp.status}: {error_text}")
-                        await asyncio.sleep(self.retry_delay * (attempt + 1))
-
-            except Exception as e:
-                self.logger.error(f"Errore chiamata API (tentativo {attempt + 1}/{self.max_retries}): {e}")
-                await asyncio.sleep(self.retry_delay * (attempt + 1))
-
-        # Fallito dopo tutti i retry
-        return None
-
-    async def _process_file(self, csv_file: Path, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore):
+    def _track_result(self, i: int, result: ProviderResult):
+        """Traccia token usage e costo del backend che ha risposto."""
+        self.input_tokens += result.input_tokens
+        self.output_tokens += result.output_tokens
+        self.api_cost += result.cost
+        if result.hedged:
+            self.state.hedged_chunks += 1
+
+    async def _process_file(self, csv_file: Path, transport: HTTPTransport):
         """Processa un singolo file CSV."""
         output_file = self.output_dir / csv_file.name
 
@@ -194,14 +190,33 @@ class DILAnnotator:
             reader = csv.DictReader(f)
             rows = list(reader)
 
-        # Processa chunk
-        tasks = []
-        for row in rows:
-            chunk_text = row['chunk']
-            tasks.append(self._annotate_chunk(session, semaphore, chunk_text))
-
-        # Esegui in parallelo con rate limiting
-        annotations = await asyncio.gather(*tasks)
+        # Cascata: i chunk ad alta confidenza sono risolti localmente,
+        # solo la fascia incerta viene inviata all'API
+        annotations = [None] * len(rows)
+        forward_idx = []
+        for i, row in enumerate(rows):
+            if self.cascade is not None:
+                label, _ = self.cascade.route(row['chunk'])
+                if label is not None:
+                    annotations[i] = label
+                    self.state.auto_resolved_chunks += 1
+                    continue
+            forward_idx.append(i)
+
+        # Backend locale: un'unica predizione vettorizzata, nessuna chiamata API
+        if self.local_model is not None:
+            texts = [rows[i]['chunk'] for i in forward_idx]
+            for i, label in zip(forward_idx, self.local_model.predict(texts)):
+                annotations[i] = label
+            forward_idx = []
+
+        # Processa chunk: i più lunghi (latenza maggiore) partono per primi,
+        # così i chunk brevi riempiono la coda del file
+        results = await self.engine.run_async(
+            transport, {i: rows[i]['chunk'] for i in forward_idx}, on_result=self._track_result
+        )
+        for i, result in results.items():
+            annotations[i] = result.label
 
         # Aggiungi annotazioni alle righe
         for row, annotation in zip(rows, annotations):
@@ -226,17 +241,9 @@ class DILAnnotator:
             self._save_state()
             self._log_progress()
 
-    async def _annotate_chunk(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, chunk_text: str) -> Optional[str]:
-        """Annota un singolo chunk con rate limiting."""
-        async with semaphore:
-            self.requests_made += 1
-            return await self._call_api(session, chunk_text)
-
     def _update_cost(self):
-        """Aggiorna costo totale."""
-        input_cost = (self.input_tokens / 1_000_000) * self.input_price
-        output_cost = (self.output_tokens / 1_000_000) * self.output_price
-        self.state.total_cost = input_cost + output_cost
+        """Aggiorna costo totale (incluso il costo extra delle richieste hedged)."""
+        self.state.total_cost = self.api_cost + self.dispatcher.stats.extra_cost
 
     def _log_progress(self):
         """Log progresso corrente."""
@@ -252,6 +259,14 @@ class DILAnnotator:
             f"ETA: {eta/3600:.1f}h | "
             f"Costo: ${self.state.total_cost:.2f}"
         )
+        if self.cascade is not None:
+            self.logger.info(
+                f"Cascata: {self.state.auto_resolved_chunks} chunk risolti localmente, "
+                f"{self.cascade.stats.forwarded_rate:.1%} inoltrati all'API (sessione)"
+            )
+        if self.dispatcher.secondary is not None:
+            self.logger.info(f"Provider: {self.dispatcher.summary()}")
+        self.logger.info(f"Trasporto: {self.transport.metrics.summary()}")
 
     async def annotate_corpus(self):
         """Annota l'intero corpus."""
@@ -271,15 +286,12 @@ class DILAnnotator:
             self.logger.info(f"Chunk totali da processare: {self.state.total_chunks}")
             self._save_state()
 
-        # Setup sessione HTTP e rate limiting
-        connector = aiohttp.TCPConnector(limit=self.max_concurrent)
-        timeout = aiohttp.ClientTimeout(total=60)
-        semaphore = asyncio.Semaphore(self.max_concurrent)
-
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # Trasporto HTTP condiviso (keep-alive, cache DNS); la concorrenza è
+        # limitata dal motore
+        async with self.transport as transport:
             # Processa file
             for csv_file in csv_files:
-                await self._process_file(csv_file, session, semaphore)
+                await self._process_file(csv_file, transport)
 
         # Statistiche finali
         self._update_cost()
@@ -291,10 +303,15 @@ class DILAnnotator:
         self.logger.info("=" * 70)
         self.logger.info(f"Chunk processati: {self.state.processed_chunks}")
         self.logger.info(f"Chunk falliti: {self.state.failed_chunks}")
+        if self.cascade is not None:
+            self.logger.info(f"Chunk risolti dalla cascata: {self.state.auto_resolved_chunks}")
         self.logger.info(f"File completati: {len(self.state.completed_files)}")
         self.logger.info(f"Tempo totale: {elapsed/3600:.2f} ore")
         self.logger.info(f"Input tokens: {self.input_tokens:,}")
         self.logger.info(f"Output tokens: {self.output_tokens:,}")
+        self.logger.info(f"Provider: {self.dispatcher.summary()}")
+        self.logger.info(f"Motore: {self.engine.summary()}")
+        self.logger.info(f"Trasporto: {self.transport.metrics.summary()}")
         self.logger.info(f"Costo totale: ${self.state.total_cost:.2f}")
         self.logger.info("=" * 70)
 
@@ -317,7 +334,9 @@ async def main():
     # Verifica API key
     with open(config_path, 'r') as f:
         config = json.load(f)
-        if config['anthropic_api_key'] == 'YOUR_API_KEY_HERE':
+        if (config.get('backend', 'api') == 'api'
+                and config.get('primary_provider', 'anthropic') == 'anthropic'
+                and config['anthropic_api_key'] == 'YOUR_API_KEY_HERE'):
             print("ERRORE: API key non configurata in config.json")
             print("Sostituisci 'YOUR_API_KEY_HERE' con la tua chiave API Anthropic.")
             return
@@ -325,7 +344,16 @@ async def main():
     # Conferma avvio
     print(f"Input directory: {config['input_dir']}")
     print(f"Output directory: {config['output_dir']}")
+    print(f"Backend: {config.get('backend', 'api')}")
     print(f"Max concurrent requests: {config['max_concurrent_requests']}")
+    if config.get('schedule_window', 0) > 1:
+        print(f"Scheduling: longest-first (finestra {config['schedule_window']})")
+    if config.get('hedging_enabled', False):
+        print(f"Hedging: {config.get('primary_provider', 'anthropic')} -> {config['secondary_provider']}"
+              f" oltre il p{config.get('hedge_quantile', 0.95) * 100:.0f} della latenza")
+    if config.get('cascade_enabled', False):
+        cascade = DILPreClassifier.from_config(config)
+        print(f"Cascata locale: attiva (soglie {cascade.low_threshold} / {cascade.high_threshold})")
     print()
 
     response = input("Avviare l'annotazione? (yes/no): ")
@@ -126,6 +126,12 @@ print_success "Setup script caricato"
 print_step "Caricamento script Python..."
 scp -i "$SSH_KEY" -o StrictHostKeyChecking=no \
     "$SCRIPT_DIR/annotate_dil.py" \
+    "$SCRIPT_DIR/dil_cascade.py" \
+    "$SCRIPT_DIR/dil_distilled.py" \
+    "$SCRIPT_DIR/dil_engine.py" \
+    "$SCRIPT_DIR/dil_providers.py" \
+    "$SCRIPT_DIR/dil_scheduler.py" \
+    "$SCRIPT_DIR/dil_transport.py" \
     "$SCRIPT_DIR/test_annotate.py" \
     $VM_USER@$VM_IP:~/dil_project/
 print_success "Script Python caricati"
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Accordo tra più annotatori: kappa di Fleiss, alfa di Krippendorff e matrice
+delle kappa di Cohen a coppie.
+
+compare_annotators e calcola_metriche confrontano due colonne alla volta.
+Qui le valutazioni di un pannello qualsiasi di annotatori (colonne DIL* di
+un CSV, annotatori umani dei file originali, modelli diversi) sono tenute
+in matrici sparse:
+
+  - valutazioni: elementi × annotatori, valore = categoria + 1 (0 = non
+    valutato), così un pannello in cui ciascun annotatore copre solo una
+    parte del corpus (es. un annotatore umano per opera) occupa memoria
+    proporzionale alle valutazioni effettive
+  - conteggi: elementi × categorie, n_uc = annotatori che hanno assegnato
+    la categoria c all'elemento u
+
+Fleiss e Krippendorff (dati nominali) si ottengono dai conteggi con prodotti
+sparsi; la matrice delle kappa di Cohen dalle indicatrici per categoria
+(Iᵀ I, annotatori × annotatori), ogni coppia sui soli elementi valutati da
+entrambi. Nessun ciclo Python su elementi o coppie.
+
+I file umani originali (01_original_annotated_files, e i CSV con lo stesso
+formato in 02_experiment_csv_base) sono annotati per frase; i trigrammi dei
+CSV di esperimento sono tre frasi consecutive unite da uno spazio e sono DIL
+se almeno una delle tre lo è. attach_human_labels() ricostruisce così
+l'etichetta umana di ogni trigramma come colonna DIL_human. Sul CSV dei 500
+trigrammi coincide con DIL: duplicate_raters() trova le colonne che
+ripetono un altro annotatore e main() le esclude dal pannello.
+
+Uso da riga di comando:
+    python dil_agreement.py corpus_labelled-trigrams_500_DUAL_annotated.csv
+    python dil_agreement.py FILE.csv --human-dir ../01_original_annotated_files ../02_experiment_csv_base
+    python dil_agreement.py FILE.csv --columns DIL DIL_Sonnet DIL_gpt_5_2
+"""
+
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy import sparse
+except ImportError:
+    raise SystemExit("ERRORE: scipy non installato. Eseguire: pip install scipy")
+
+from dil_metrics import annotator_columns, encode_labels
+
+CATEGORIES = ("no", "yes")
+ANNOTATION_COLUMNS = ("DD", "DI", "DIL")
+HUMAN_COLUMN = "DIL_human"
+
+
+def _as_array(values: Iterable) -> np.ndarray:
+    return np.asarray(values if hasattr(values, "__len__") else list(values))
+
+
+@dataclass
+class Ratings:
+    """Valutazioni sparse di un pannello: elementi × annotatori (categoria + 1, 0 = assente)."""
+    matrix: sparse.csr_matrix
+    items: pd.Index
+    raters: pd.Index
+    categories: Sequence[str] = CATEGORIES
+
+    @classmethod
+    def from_columns(cls, df: pd.DataFrame, columns: Sequence[str]) -> "Ratings":
+        """Pannello dalle colonne di un DataFrame (una colonna per annotatore)."""
+        blocks = [encode_labels(df[c]) for c in columns]
+        codes = np.column_stack(blocks) if blocks else np.empty((len(df), 0), dtype=np.int8)
+        rows, cols = np.nonzero(codes >= 0)
+        matrix = sparse.csr_matrix(
+            (codes[rows, cols].astype(np.int8) + 1, (rows, cols)), shape=codes.shape
+        )
+        return cls(matrix, df.index, pd.Index(list(columns)))
+
+    @classmethod
+    def from_long(cls, items: Iterable, raters: Iterable, labels: Iterable) -> "Ratings":
+        """
+        Pannello da triple (elemento, annotatore, etichetta), senza passare da
+        una matrice densa. Se un annotatore valuta più volte lo stesso
+        elemento vale l'ultima valutazione.
+        """
+        codes = encode_labels(_as_array(labels))
+        item_codes, item_index = pd.factorize(_as_array(items))
+        rater_codes, rater_index = pd.factorize(_as_array(raters))
+        keep = codes >= 0
+        frame = pd.DataFrame({"u": item_codes[keep], "r": rater_codes[keep], "c": codes[keep]})
+        frame = frame.drop_duplicates(["u", "r"], keep="last")
+        matrix = sparse.csr_matrix(
+            (frame["c"].to_numpy(np.int8) + 1, (frame["u"].to_numpy(), frame["r"].to_numpy())),
+            shape=(len(item_index), len(rater_index)),
+        )
+        return cls(matrix, pd.Index(item_index), pd.Index(rater_index))
+
+    def indicator(self, category: int) -> sparse.csr_matrix:
+        """Indicatrice sparsa (float) delle valutazioni uguali a `category`."""
+        return (self.matrix == category + 1).astype(np.float64).tocsr()
+
+    def rated(self) -> sparse.csr_matrix:
+        """Indicatrice sparsa (float) delle valutazioni presenti."""
+        return (self.matrix > 0).astype(np.float64).tocsr()
+
+    def counts(self) -> sparse.csr_matrix:
+        """Conteggi elementi × categorie (annotatori per categoria)."""
+        matrix = self.matrix.tocoo()
+        return sparse.csr_matrix(
+            (np.ones(matrix.nnz), (matrix.row, matrix.data.astype(np.int64) - 1)),
+            shape=(matrix.shape[0], len(self.categories)),
+        )
+
+
+def _pairable(counts: sparse.csr_matrix):
+    """Conteggi ristretti agli elementi con almeno due valutazioni, e le loro m_u."""
+    per_item = np.asarray(counts.sum(axis=1)).ravel()
+    keep = per_item >= 2
+    return counts[keep], per_item[keep]
+
+
+def fleiss_kappa(counts: sparse.spmatrix) -> float:
+    """
+    Kappa di Fleiss dai conteggi elementi × categorie. Con un numero di
+    annotatori variabile per elemento si usa la generalizzazione consueta
+    (accordo osservato medio sugli elementi con almeno due valutazioni).
+    """
+    counts, m = _pairable(sparse.csr_matrix(counts, dtype=np.float64))
+    if len(m) == 0:
+        return float("nan")
+    squares = np.asarray(counts.multiply(counts).sum(axis=1)).ravel()
+    p_observed = np.mean((squares - m) / (m * (m - 1)))
+    p_category = np.asarray(counts.sum(axis=0)).ravel() / m.sum()
+    p_expected = float(np.sum(p_category ** 2))
+    if p_expected >= 1.0:
+        return float("nan")
+    return float((p_observed - p_expected) / (1.0 - p_expected))
+
+
+def krippendorff_alpha(counts: sparse.spmatrix) -> float:
+    """
+    Alfa di Krippendorff per dati nominali dai conteggi elementi × categorie,
+    tramite la matrice delle coincidenze o = Nᵀ diag(1/(m_u − 1)) N − diag(·).
+    """
+    counts, m = _pairable(sparse.csr_matrix(counts, dtype=np.float64))
+    if len(m) == 0:
+        return float("nan")
+    weights = sparse.diags(1.0 / (m - 1))
+    coincidences = (counts.T @ weights @ counts).toarray()
+    coincidences -= np.diag(np.asarray(counts.T @ (1.0 / (m - 1))).ravel())
+    n_category = coincidences.sum(axis=1)
+    n = n_category.sum()
+    expected = n * n - np.sum(n_category ** 2)
+    if expected <= 0:
+        return float("nan")
+    return float(1.0 - (n - 1) * (n - np.trace(coincidences)) / expected)
+
+
+def pairwise_kappa(ratings: Ratings) -> Dict[str, pd.DataFrame]:
+    """
+    Kappa di Cohen, accordo osservato ed elementi in comune per ogni coppia
+    di annotatori (matrici annotatori × annotatori). Le coppie senza
+    elementi in comune hanno kappa NaN.
+    """
+    rated = ratings.rated()
+    overlap = (rated.T @ rated).toarray()
+    agree = np.zeros_like(overlap)
+    expected = np.zeros_like(overlap)
+    for c in range(len(ratings.categories)):
+        indicator = ratings.indicator(c)
+        agree += (indicator.T @ indicator).toarray()
+        # Marginali di ciascun annotatore ristrette agli elementi della coppia
+        share = (indicator.T @ rated).toarray()
+        expected += share * share.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_observed = agree / overlap
+        p_expected = expected / (overlap * overlap)
+        kappa = np.where(p_expected < 1.0, (p_observed - p_expected) / (1.0 - p_expected), np.nan)
+    kappa[overlap == 0] = np.nan
+
+    def frame(values):
+        return pd.DataFrame(values, index=ratings.raters, columns=ratings.raters)
+
+    return {"kappa": frame(kappa), "agreement": frame(p_observed), "overlap": frame(overlap.astype(np.int64))}
+
+
+def duplicate_raters(ratings: Ratings, prefer: Sequence[str] = ()) -> Dict[str, str]:
+    """
+    Annotatori che ripetono le valutazioni di un altro: {duplicato: tenuto}.
+
+    Una coppia è duplicata se concorda su tutti gli elementi in comune e uno
+    dei due non valuta nulla fuori dall'altro (es. DIL_human ricostruita
+    dagli stessi file da cui viene la colonna DIL). Tenerle entrambe conta
+    due volte lo stesso giudizio e gonfia Fleiss e Krippendorff. Della
+    coppia resta l'annotatore in `prefer`, altrimenti quello con più
+    valutazioni (a parità, il primo).
+    """
+    pairs = pairwise_kappa(ratings)
+    overlap = pairs["overlap"].to_numpy()
+    n_rated = np.diag(overlap)
+    nested = overlap == np.minimum.outer(n_rated, n_rated)
+    identical = (pairs["agreement"].to_numpy() == 1.0) & nested & (overlap > 0)
+    np.fill_diagonal(identical, False)
+
+    raters = list(ratings.raters)
+    dropped: Dict[str, str] = {}
+    for i, j in zip(*np.nonzero(np.triu(identical))):
+        a, b = raters[i], raters[j]
+        if a in dropped or b in dropped:
+            continue
+        keep_b = b in prefer and a not in prefer or (a not in prefer and n_rated[j] > n_rated[i])
+        drop, keep = (a, b) if keep_b else (b, a)
+        dropped[drop] = keep
+    return dropped
+
+
+def panel_agreement(ratings: Ratings) -> Dict[str, float]:
+    """Riepilogo del pannello: Fleiss, Krippendorff e dimensioni."""
+    counts = ratings.counts()
+    per_item = np.asarray(counts.sum(axis=1)).ravel()
+    return {
+        "items": int(len(ratings.items)),
+        "raters": int(len(ratings.raters)),
+        "ratings": int(ratings.matrix.nnz),
+        "pairable_items": int((per_item >= 2).sum()),
+        "fleiss_kappa": fleiss_kappa(counts),
+        "krippendorff_alpha": krippendorff_alpha(counts),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Annotazioni umane originali
+# ---------------------------------------------------------------------------
+
+def normalize_text(values: pd.Series) -> pd.Series:
+    """Testo confrontabile tra file diversi: senza BOM e con spazi compattati."""
+    return (
+        values.fillna("").astype(str)
+        .str.replace("﻿", "", regex=False)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def _read_human_file(path: Path) -> pd.DataFrame:
+    """Legge un file umano (xlsx o CSV) come tabella di stringhe senza intestazione."""
+    if path.suffix.lower() == ".xlsx":
+        try:
+            return pd.read_excel(path, header=None, dtype=str)
+        except ImportError:
+            raise SystemExit("ERRORE: openpyxl non installato. Eseguire: pip install openpyxl")
+    with open(path, "r", encoding="utf-8-sig") as f:
+        sep = ";" if ";" in f.readline() else ","
+    return pd.read_csv(path, sep=sep, header=None, dtype=str, encoding="utf-8-sig", keep_default_na=False)
+
+
+def _find_header(raw: pd.DataFrame, column: str):
+    """
+    (riga, colonna) dell'intestazione `column` tra le prime righe. Le colonne
+    di annotazione seguono sempre l'ordine DD, DI, DIL: se l'intestazione
+    manca (in un file è stata sovrascritta da un'etichetta) si usa la
+    colonna successiva a quella che la precede.
+    """
+    head = raw.head(5).apply(lambda c: c.str.strip().str.upper())
+    for target, offset in ((column.upper(), 0), (_previous_annotation(column), 1)):
+        if target is None:
+            continue
+        rows, cols = np.nonzero(head.eq(target).to_numpy())
+        if len(rows):
+            return int(rows[0]), int(cols[0]) + offset
+    return None
+
+
+def _previous_annotation(column: str) -> Optional[str]:
+    position = ANNOTATION_COLUMNS.index(column.upper()) if column.upper() in ANNOTATION_COLUMNS else 0
+    return ANNOTATION_COLUMNS[position - 1] if position > 0 else None
+
+
+def _parse_human_file(path: Path, column: str) -> Optional[pd.DataFrame]:
+    """
+    Frasi annotate di un file umano: doc_id, position, text, label.
+
+    I file non hanno tutti la stessa intestazione (riga 1 o 2, colonne
+    novel/sentence, doc_id/text, Testo/Sentence o senza nome): il testo è
+    la colonna più lunga a sinistra di `column` e il doc_id è il valore
+    '*.txt' delle altre colonne. Un file originale riguarda una sola opera:
+    i file con più opere (es. i campioni di trigrammi) non sono annotazioni
+    per frase e vengono saltati.
+    """
+    raw = _read_human_file(path).fillna("").astype(str)
+    header = _find_header(raw, column)
+    if header is None or header[1] == 0 or header[1] >= raw.shape[1]:
+        return None
+    header_row, label_col = header
+    body = raw.iloc[header_row + 1:, :label_col]
+
+    text_col = int(body.apply(lambda c: c.str.len().mean()).to_numpy().argmax())
+    cells = body.drop(columns=body.columns[text_col]).stack().str.strip()
+    doc_ids = cells[cells.str.endswith(".txt")].unique()
+    if len(doc_ids) != 1:
+        return None
+
+    parsed = pd.DataFrame({
+        "doc_id": doc_ids[0],
+        "text": normalize_text(body.iloc[:, text_col]),
+        "label": raw.iloc[header_row + 1:, label_col].str.strip(),
+        "source": path.name,
+    })
+    parsed = parsed[parsed["text"] != ""]
+    parsed.insert(1, "position", np.arange(len(parsed)))
+    return parsed.reset_index(drop=True)
+
+
+def load_human_annotations(directories: Sequence[str], column: str = "DIL") -> pd.DataFrame:
+    """
+    Frasi annotate dei file umani (*.xlsx, *.csv) nelle cartelle indicate.
+    I file senza colonna `column` o senza un'unica opera riconoscibile sono
+    saltati con un avviso.
+    """
+    frames = []
+    for directory in directories:
+        for path in sorted(Path(directory).iterdir()):
+            if path.suffix.lower() not in (".xlsx", ".csv"):
+                continue
+            parsed = _parse_human_file(path, column)
+            if parsed is None:
+                print(f"  Avviso: {path.name} saltato (nessuna colonna {column} o nessuna opera unica)")
+                continue
+            frames.append(parsed)
+    if not frames:
+        return pd.DataFrame(columns=["doc_id", "position", "text", "label", "source"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def human_trigram_labels(human: pd.DataFrame) -> pd.DataFrame:
+    """
+    Etichette umane dei trigrammi (tre frasi consecutive della stessa opera):
+    yes se almeno una frase è DIL, no se nessuna lo è e tutte sono valutate.
+    """
+    human = human.sort_values(["doc_id", "position"], kind="stable")
+    by_doc = human.groupby("doc_id", sort=False)
+    codes = pd.Series(encode_labels(human["label"]).astype(np.float64), index=human.index)
+    codes[codes < 0] = np.nan
+
+    texts, labels = [human["text"]], [codes]
+    for shift in (1, 2):
+        texts.append(by_doc["text"].shift(-shift))
+        labels.append(codes.groupby(human["doc_id"], sort=False).shift(-shift))
+    window = pd.concat(labels, axis=1)
+    complete = pd.concat(texts, axis=1).notna().all(axis=1)
+
+    label = np.where(window.max(axis=1) == 1, "yes", np.where(window.notna().all(axis=1), "no", None))
+    trigrams = pd.DataFrame({
+        "doc_id": human["doc_id"],
+        "text": texts[0] + " " + texts[1] + " " + texts[2],
+        HUMAN_COLUMN: label,
+    })[complete]
+    return trigrams.drop_duplicates(["doc_id", "text"], keep="first")
+
+
+def attach_human_labels(df: pd.DataFrame, human: pd.DataFrame, column: str = HUMAN_COLUMN) -> pd.DataFrame:
+    """Copia di df con l'etichetta umana dei trigrammi, allineata per (doc_id, testo)."""
+    trigrams = human_trigram_labels(human).rename(columns={HUMAN_COLUMN: column})
+    keys = pd.DataFrame({"doc_id": df["doc_id"].astype(str).str.strip(), "text": normalize_text(df["text"])})
+    merged = keys.merge(trigrams, on=["doc_id", "text"], how="left")
+    result = df.copy()
+    result[column] = merged[column].to_numpy()
+    return result
+
+
+def main():
+    """Entry point: accordo del pannello di annotatori di un CSV."""
+    parser = argparse.ArgumentParser(description="Accordo multi-annotatore DIL (Fleiss, Krippendorff, Cohen)")
+    parser.add_argument("input_file", help="CSV con le colonne degli annotatori (es. DIL, DIL_Sonnet, ...)")
+    parser.add_argument("--columns", nargs="+", default=None,
+                        help="Colonne del pannello (default: tutte le colonne DIL*)")
+    parser.add_argument("--human-dir", nargs="+", default=None,
+                        help="Cartelle con i file umani originali da aggiungere come colonna DIL_human")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input_file, encoding="utf-8")
+    columns = args.columns or annotator_columns(df)
+    if args.human_dir:
+        human = load_human_annotations(args.human_dir)
+        df = attach_human_labels(df, human)
+        matched = int(df[HUMAN_COLUMN].notna().sum())
+        print(f"Annotazioni umane: {len(human):,} frasi da {human['source'].nunique()} file, "
+              f"{matched:,}/{len(df):,} righe allineate")
+        if HUMAN_COLUMN not in columns:
+            columns = [*columns, HUMAN_COLUMN]
+
+    ratings = Ratings.from_columns(df, columns)
+    duplicates = duplicate_raters(ratings, prefer=[HUMAN_COLUMN])
+    if duplicates:
+        for drop, keep in duplicates.items():
+            print(f"Colonna {drop} identica a {keep}: esclusa dal pannello")
+        columns = [c for c in columns if c not in duplicates]
+        ratings = Ratings.from_columns(df, columns)
+    summary = panel_agreement(ratings)
+    pairs = pairwise_kappa(ratings)
+
+    print("=" * 70)
+    print(f"ACCORDO DEL PANNELLO — {args.input_file}")
+    print("=" * 70)
+    print(f"Annotatori: {', '.join(columns)}")
+    print(f"Elementi: {summary['items']:,} (con almeno due valutazioni: {summary['pairable_items']:,}) | "
+          f"Valutazioni: {summary['ratings']:,}")
+    print(f"\nKappa di Fleiss:        {summary['fleiss_kappa']:.4f}")
+    print(f"Alfa di Krippendorff:   {summary['krippendorff_alpha']:.4f}")
+    with pd.option_context("display.width", 200, "display.float_format", "{:.4f}".format):
+        print("\nKappa di Cohen a coppie:")
+        print(pairs["kappa"].to_string())
+        print("\nElementi in comune:")
+        print(pairs["overlap"].to_string())
+
+
+if __name__ == "__main__":
+    main()
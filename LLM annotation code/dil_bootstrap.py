@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Intervalli di confidenza bootstrap e test appaiati tra annotatori.
+
+Ricampionare gli indici delle righe e richiamare sklearn.metrics a ogni
+replica costa repliche × righe operazioni Python e NumPy: su 10.000 repliche
+e sull'intero corpus sono ore. Qui le righe vengono prima ridotte
+ai loro profili di etichette: con k colonne codificate da dil_metrics
+(1 = yes, 0 = no, -1 = mancante) i profili distinti sono al più 3^k e in
+pratica poche decine. Estrarre n righe con reinserimento equivale a
+estrarre i conteggi dei profili da una multinomiale con le frequenze
+osservate, quindi ogni replica è un vettore di pesi sui profili e le
+matrici di confusione di tutte le coppie di colonne, per migliaia di
+repliche, sono un unico prodotto matriciale (repliche × profili) ×
+(profili × celle). Il costo non dipende dal numero di righe.
+
+Per ogni annotatore confrontato con il gold:
+  - intervalli percentili di accuracy, precision, recall, specificità, F1
+    e kappa di Cohen
+
+Per ogni coppia di annotatori, sulle righe valide per entrambi e per il gold:
+  - test di McNemar (esatto sotto 25 discordanze, altrimenti chi quadro
+    con correzione di continuità)
+  - differenza delle metriche con intervallo bootstrap appaiato
+  - p-value di permutazione appaiata: per ogni riga le etichette dei due
+    annotatori vengono scambiate con probabilità 1/2 (anche questo
+    campionato per profilo, con una binomiale)
+
+Uso da riga di comando:
+    python dil_bootstrap.py corpus_labelled-trigrams_500_DUAL_annotated.csv
+    python dil_bootstrap.py FILE.csv --resamples 10000 --confidence 0.95 --seed 0
+"""
+
+import argparse
+import math
+import time
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from dil_metrics import annotator_columns, encode_columns, metrics_from_counts
+
+METRICS = ("accuracy", "precision", "recall", "specificity", "f1_score", "kappa")
+PAIRED_METRICS = ("accuracy", "f1_score", "kappa")
+
+# Celle (repliche × profili) generate per blocco: limita la memoria quando
+# i profili distinti sono molti
+BLOCK_CELLS = 4_000_000
+
+# Sotto questa soglia di discordanze McNemar usa il test binomiale esatto
+MCNEMAR_EXACT_BELOW = 25
+
+
+def label_patterns(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Profili di etichette distinti di una matrice codificata (righe × k) e
+    numero di righe per profilo.
+    """
+    k = codes.shape[1]
+    # Ogni riga diventa un intero in base 3: np.unique su un vettore è molto
+    # più rapido che sulle righe di una matrice
+    keys = (codes.astype(np.int64) + 1) @ (3 ** np.arange(k, dtype=np.int64))
+    keys, counts = np.unique(keys, return_counts=True)
+    patterns = (keys[:, None] // (3 ** np.arange(k, dtype=np.int64))) % 3 - 1
+    return patterns.astype(np.int8), counts.astype(np.int64)
+
+
+def _cell_indicators(patterns: np.ndarray) -> np.ndarray:
+    """
+    Matrice (profili × 4k²) che, moltiplicata per i pesi dei profili, dà i
+    conteggi [Y N]ᵀ[Y N] nello stesso ordine di dil_metrics.pairwise_confusion.
+    """
+    k = patterns.shape[1]
+    indicators = np.concatenate([patterns == 1, patterns == 0], axis=1).astype(np.float64)
+    return (indicators[:, :, None] * indicators[:, None, :]).reshape(len(patterns), 4 * k * k)
+
+
+def _gram_metrics(gram: np.ndarray, k: int) -> Dict[str, np.ndarray]:
+    """Metriche (... × k × k) dai conteggi [Y N]ᵀ[Y N] appiattiti (... × 4k²)."""
+    gram = np.rint(gram).reshape(*gram.shape[:-1], 2 * k, 2 * k)
+    return metrics_from_counts(
+        tp=gram[..., :k, :k], tn=gram[..., k:, k:], fp=gram[..., k:, :k], fn=gram[..., :k, k:]
+    )
+
+
+def _metrics(weights: np.ndarray, cells: np.ndarray, k: int) -> Dict[str, np.ndarray]:
+    """Metriche di tutte le coppie di colonne per pesi sui profili (... × profili)."""
+    return _gram_metrics(weights @ cells, k)
+
+
+def _resample_blocks(
+    rng: np.random.Generator, counts: np.ndarray, resamples: int
+) -> Iterator[np.ndarray]:
+    """Pesi bootstrap dei profili (blocco di repliche × profili), a blocchi."""
+    n = int(counts.sum())
+    probabilities = counts / n
+    block = max(1, BLOCK_CELLS // max(1, len(counts)))
+    for start in range(0, resamples, block):
+        yield rng.multinomial(n, probabilities, size=min(block, resamples - start)).astype(np.float64)
+
+
+def _percentile_interval(values: np.ndarray, confidence: float) -> Tuple[np.ndarray, np.ndarray]:
+    alpha = (1.0 - confidence) / 2.0
+    return np.quantile(values, alpha, axis=0), np.quantile(values, 1.0 - alpha, axis=0)
+
+
+def bootstrap_metrics(
+    df: pd.DataFrame,
+    reference: str = "DIL",
+    columns: Optional[Sequence[str]] = None,
+    resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Stima puntuale, errore standard e intervallo percentile di ogni metrica
+    di ciascuna colonna rispetto a `reference`: una riga per
+    (annotatore, metrica).
+    """
+    if columns is None:
+        columns = [c for c in annotator_columns(df) if c != reference]
+    columns = list(columns)
+    patterns, counts = label_patterns(encode_columns(df, [reference, *columns]))
+    k = patterns.shape[1]
+    cells = _cell_indicators(patterns)
+
+    observed = _metrics(counts.astype(np.float64), cells, k)
+    rng = np.random.default_rng(seed)
+    replicas = {metric: [] for metric in METRICS}
+    for weights in _resample_blocks(rng, counts, resamples):
+        values = _metrics(weights, cells, k)
+        for metric in METRICS:
+            replicas[metric].append(values[metric][:, 0, 1:])
+
+    rows = []
+    for metric in METRICS:
+        values = np.concatenate(replicas[metric])
+        low, high = _percentile_interval(values, confidence)
+        std = values.std(axis=0, ddof=1)
+        for j, column in enumerate(columns):
+            rows.append({
+                "annotator": column,
+                "metric": metric,
+                "n": int(observed["total"][0, j + 1]),
+                "estimate": float(observed[metric][0, j + 1]),
+                "std_error": float(std[j]),
+                "ci_low": float(low[j]),
+                "ci_high": float(high[j]),
+            })
+    table = pd.DataFrame(rows).set_index(["annotator", "metric"])
+    return table.loc[columns]
+
+
+def mcnemar_test(b: int, c: int) -> Tuple[float, float]:
+    """
+    Test di McNemar sulle discordanze b (solo il primo corretto) e c (solo il
+    secondo corretto): restituisce (statistica, p-value bilaterale). Sotto
+    MCNEMAR_EXACT_BELOW discordanze il test è binomiale esatto e la
+    statistica è min(b, c).
+    """
+    m = b + c
+    if m == 0:
+        return 0.0, 1.0
+    if m < MCNEMAR_EXACT_BELOW:
+        tail = sum(math.comb(m, i) for i in range(min(b, c) + 1)) / 2 ** m
+        return float(min(b, c)), min(1.0, 2.0 * tail)
+    statistic = (abs(b - c) - 1) ** 2 / m
+    # Sopravvivenza del chi quadro con 1 grado di libertà
+    return statistic, math.erfc(math.sqrt(statistic / 2.0))
+
+
+def _delta(values: Dict[str, np.ndarray], metrics: Sequence[str]) -> Dict[str, np.ndarray]:
+    """Differenza A − B delle metriche vs gold, con profili ordinati (gold, A, B)."""
+    return {m: values[m][..., 0, 1] - values[m][..., 0, 2] for m in metrics}
+
+
+def paired_tests(
+    df: pd.DataFrame,
+    reference: str = "DIL",
+    columns: Optional[Sequence[str]] = None,
+    resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    metrics: Sequence[str] = PAIRED_METRICS,
+) -> pd.DataFrame:
+    """
+    Confronti appaiati di tutte le coppie di colonne rispetto a `reference`,
+    sulle righe con etichetta valida in tutte e tre le colonne: una riga per
+    (annotatore A, annotatore B). delta_<metrica> è A − B.
+    """
+    if columns is None:
+        columns = [c for c in annotator_columns(df) if c != reference]
+    columns = list(columns)
+    patterns, counts = label_patterns(encode_columns(df, [reference, *columns]))
+    rng = np.random.default_rng(seed)
+
+    rows = []
+    for a in range(len(columns)):
+        for b in range(a + 1, len(columns)):
+            # Profili ristretti a (gold, A, B) e alle righe valide per tutti e tre
+            sub = patterns[:, [0, a + 1, b + 1]]
+            valid = (sub >= 0).all(axis=1)
+            sub_patterns, inverse = np.unique(sub[valid], axis=0, return_inverse=True)
+            sub_counts = np.bincount(inverse.ravel(), weights=counts[valid], minlength=len(sub_patterns))
+            sub_counts = sub_counts.astype(np.int64)
+            row = {"annotator_a": columns[a], "annotator_b": columns[b], "n": int(sub_counts.sum())}
+
+            correct_a = sub_patterns[:, 1] == sub_patterns[:, 0]
+            correct_b = sub_patterns[:, 2] == sub_patterns[:, 0]
+            only_a = int(sub_counts[correct_a & ~correct_b].sum())
+            only_b = int(sub_counts[~correct_a & correct_b].sum())
+            statistic, p_value = mcnemar_test(only_a, only_b)
+            row.update({"only_a_correct": only_a, "only_b_correct": only_b,
+                        "mcnemar_stat": statistic, "mcnemar_p": p_value})
+
+            if row["n"] == 0:
+                rows.append(row)
+                continue
+
+            cells = _cell_indicators(sub_patterns)
+            swapped = _cell_indicators(sub_patterns[:, [0, 2, 1]])
+            observed = _delta(_metrics(sub_counts.astype(np.float64), cells, 3), metrics)
+
+            boot = {m: [] for m in metrics}
+            for weights in _resample_blocks(rng, sub_counts, resamples):
+                for m, values in _delta(_metrics(weights, cells, 3), metrics).items():
+                    boot[m].append(values)
+
+            # Permutazione appaiata: in ogni profilo un numero binomiale di
+            # righe scambia le etichette di A e B
+            extreme = {m: 0 for m in metrics}
+            block = max(1, BLOCK_CELLS // len(sub_counts))
+            for start in range(0, resamples, block):
+                size = min(block, resamples - start)
+                flipped = rng.binomial(sub_counts, 0.5, size=(size, len(sub_counts))).astype(np.float64)
+                gram = (sub_counts - flipped) @ cells + flipped @ swapped
+                for m, values in _delta(_gram_metrics(gram, 3), metrics).items():
+                    extreme[m] += int((np.abs(values) >= abs(observed[m]) - 1e-12).sum())
+
+            for m in metrics:
+                values = np.concatenate(boot[m])
+                low, high = _percentile_interval(values, confidence)
+                row.update({
+                    f"delta_{m}": float(observed[m]),
+                    f"delta_{m}_ci_low": float(low),
+                    f"delta_{m}_ci_high": float(high),
+                    f"delta_{m}_p": (extreme[m] + 1) / (resamples + 1),
+                })
+            rows.append(row)
+    return pd.DataFrame(rows).set_index(["annotator_a", "annotator_b"])
+
+
+def main():
+    """Entry point: intervalli bootstrap e test appaiati per un CSV annotato."""
+    parser = argparse.ArgumentParser(description="Intervalli bootstrap e test appaiati tra annotatori DIL")
+    parser.add_argument("input_file", help="CSV con la colonna gold e le colonne degli annotatori")
+    parser.add_argument("--reference", default="DIL", help="Colonna di riferimento (default: DIL)")
+    parser.add_argument("--columns", nargs="+", default=None,
+                        help="Colonne da valutare (default: tutte le colonne DIL*)")
+    parser.add_argument("--resamples", type=int, default=10_000, help="Repliche bootstrap e permutazioni")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Livello degli intervalli")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input_file, encoding="utf-8")
+    start = time.perf_counter()
+    intervals = bootstrap_metrics(df, args.reference, args.columns, args.resamples, args.confidence, args.seed)
+    tests = paired_tests(df, args.reference, args.columns, args.resamples, args.confidence, args.seed)
+    elapsed = time.perf_counter() - start
+
+    level = f"{args.confidence:.0%}"
+    with pd.option_context("display.width", 200, "display.max_columns", None,
+                           "display.float_format", "{:.4f}".format):
+        print("=" * 70)
+        print(f"INTERVALLI BOOTSTRAP ({level}, {args.resamples:,} repliche) vs {args.reference}")
+        print("=" * 70)
+        print(intervals.to_string())
+
+        print("\n" + "=" * 70)
+        print("TEST APPAIATI (A − B)")
+        print("=" * 70)
+        for (a, b), row in tests.iterrows():
+            print(f"\n{a} vs {b} — {int(row['n']):,} righe comuni")
+            print(f"  McNemar: solo A corretto {int(row['only_a_correct']):,}, solo B corretto "
+                  f"{int(row['only_b_correct']):,}, statistica {row['mcnemar_stat']:.3f}, p = {row['mcnemar_p']:.4g}")
+            for m in PAIRED_METRICS:
+                if f"delta_{m}" not in row:
+                    continue
+                print(f"  Δ {m:<9} {row[f'delta_{m}']:+.4f}  IC {level} "
+                      f"[{row[f'delta_{m}_ci_low']:+.4f}, {row[f'delta_{m}_ci_high']:+.4f}]  "
+                      f"p perm. = {row[f'delta_{m}_p']:.4g}")
+    print(f"\nTempo di calcolo: {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
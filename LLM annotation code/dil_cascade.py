@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Pre-classificatore locale per la cascata "cheap-first" dell'annotazione DIL.
+
+Ogni chunk riceve un punteggio in [0, 1] calcolato sui marcatori che i prompt
+elencano già come indizi di discorso indiretto libero:
+  - esclamazioni e interiezioni
+  - interrogative (retoriche)
+  - modalizzatori epistemici e puntini di sospensione
+  - deissi dell'indiretto libero (avverbi come 'ora', 'oggi', 'qui' accanto
+    a un tempo del passato)
+  - assenza di verbi dichiarativi ('pensò', 'disse', ...)
+
+I marcatori vengono contati solo fuori dal discorso diretto (segmenti tra
+virgolette o introdotti dal trattino di dialogo), che non è DIL.
+
+I chunk con punteggio <= low_threshold vengono risolti localmente come NO,
+quelli con punteggio >= high_threshold come YES; solo la fascia incerta
+viene inoltrata all'API.
+
+I pesi sono stimati su chunk_annotated/ escludendo le opere del gold
+standard (fit_weights, opzione --fit), e la cascata si valuta poi sui 500
+trigrammi del gold (--gold), che non entrano nella stima. Il punteggio
+separa le classi solo in parte (AUC 0.70 sui chunk di validazione, 0.72
+sul gold): la fascia YES non supera una precisione di 0.70 e la fascia NO
+risparmia richieste solo a costo di recall. Le soglie di default sono
+quindi prudenti (NO sotto 0.08, fascia YES disattivata) e la cascata resta
+spenta in config.json (cascade_enabled: false).
+
+Uso da riga di comando:
+    python dil_cascade.py --fit ../chunk_annotated --exclude corpus_labelled-trigrams_500_DUAL_annotated.csv
+    python dil_cascade.py --gold corpus_labelled-trigrams_500_DUAL_annotated.csv
+    python dil_cascade.py --gold ... --low 0.1 --high 0.8 --llm-column DIL_gpt_5_2
+"""
+
+import argparse
+import csv
+import math
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# Segmenti di discorso diretto: virgolette basse/alte e battute col trattino
+DIRECT_SPEECH_RE = re.compile(r'«[^»]*»|“[^”]*”|"[^"]*"')
+DASH_DIALOGUE_RE = re.compile(r'(?:^|(?<=\s))[-–—]\s[^-–—]*(?:[-–—]|$)')
+
+EXCLAMATION_RE = re.compile(r'!')
+QUESTION_RE = re.compile(r'\?')
+ELLIPSIS_RE = re.compile(r'\.\.\.|…')
+INTERJECTION_RE = re.compile(
+    r"\b(?:oh|ah|ahi|ahimè|ahimé|ohimè|ohimé|eh|mah|orsù|dio mio|povero|povera)\b",
+    re.IGNORECASE
+)
+MODALIZER_RE = re.compile(
+    r"\b(?:forse|certo|certamente|probabilmente|chissà|davvero|senza dubbio|"
+    r"magari|possibile|impossibile|nemmeno|neppure)\b",
+    re.IGNORECASE
+)
+DEICTIC_RE = re.compile(
+    r"\b(?:ora|adesso|oggi|domani|ieri|qui|qua|stasera|stanotte|stamani)\b",
+    re.IGNORECASE
+)
+PAST_TENSE_RE = re.compile(r"\b(?:era|erano|aveva|avevano|\w+(?:ava|eva|iva|avano|evano|ivano|ebbe|rebbe))\b",
+                           re.IGNORECASE)
+DECLARATIVE_RE = re.compile(
+    r"\b(?:pensò|pensava|disse|diceva|chiese|domandò|rispose|esclamò|mormorò|"
+    r"rifletté|gridò|soggiunse|replicò|si disse|si chiese|si domandò)\b",
+    re.IGNORECASE
+)
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?…])\s+')
+
+# Pesi del modello logistico, stimati con --fit su 40.000 chunk di
+# chunk_annotated/ estratti dalle opere fuori dal gold standard (seed 0) e
+# arrotondati; i conteggi sono troncati a MAX_COUNT per evitare che un solo
+# marcatore ripetuto domini il punteggio.
+MAX_COUNT = 3
+DEFAULT_WEIGHTS = {
+    "esclamazioni": 0.52,
+    "interrogative": 0.61,
+    "interiezioni": 0.16,
+    "modalizzatori": 0.50,
+    "sospensioni": 0.24,
+    "deissi": 0.46,
+    "verbi_dichiarativi": -0.44,
+    "discorso_diretto": -0.40,
+}
+DEFAULT_BIAS = -1.06
+
+# Soglie scelte su altri 40.000 chunk di validazione (seed 1): sotto 0.08
+# cade il 2,0% dei chunk perdendo lo 0,4% dei YES; la fascia YES è
+# disattivata (nessun punteggio raggiunge 1.0) perché la sua precisione
+# resta sotto 0.70 a qualunque soglia.
+DEFAULT_LOW_THRESHOLD = 0.08
+DEFAULT_HIGH_THRESHOLD = 1.0
+
+
+@dataclass
+class CascadeStats:
+    """Contatori di instradamento della cascata."""
+    auto_yes: int = 0
+    auto_no: int = 0
+    forwarded: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.auto_yes + self.auto_no + self.forwarded
+
+    @property
+    def forwarded_rate(self) -> float:
+        return self.forwarded / self.total if self.total else 0.0
+
+
+@dataclass
+class DILPreClassifier:
+    """Scorer locale dei marcatori DIL con soglie di instradamento."""
+    low_threshold: float = DEFAULT_LOW_THRESHOLD
+    high_threshold: float = DEFAULT_HIGH_THRESHOLD
+    weights: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_WEIGHTS))
+    bias: float = DEFAULT_BIAS
+    stats: CascadeStats = field(default_factory=CascadeStats)
+
+    def __post_init__(self):
+        if not 0.0 <= self.low_threshold <= self.high_threshold <= 1.0:
+            raise ValueError(
+                f"Soglie non valide: low={self.low_threshold}, high={self.high_threshold} "
+                "(richiesto 0 <= low <= high <= 1)"
+            )
+
+    @classmethod
+    def from_config(cls, config: dict) -> "DILPreClassifier":
+        """Costruisce il pre-classificatore dalle chiavi 'cascade_*' del config."""
+        return cls(
+            low_threshold=config.get('cascade_low_threshold', DEFAULT_LOW_THRESHOLD),
+            high_threshold=config.get('cascade_high_threshold', DEFAULT_HIGH_THRESHOLD),
+        )
+
+    @staticmethod
+    def extract_markers(text: str) -> Dict[str, int]:
+        """Conta i marcatori DIL nel testo narrativo (discorso diretto escluso)."""
+        direct = DIRECT_SPEECH_RE.findall(text) + DASH_DIALOGUE_RE.findall(text)
+        narrative = DASH_DIALOGUE_RE.sub(' ', DIRECT_SPEECH_RE.sub(' ', text))
+
+        # Deissi dell'indiretto libero: avverbio deittico nella stessa frase
+        # di un tempo del passato ("Ora era tardi, troppo tardi.")
+        deissi = sum(
+            1 for frase in SENTENCE_SPLIT_RE.split(narrative)
+            if DEICTIC_RE.search(frase) and PAST_TENSE_RE.search(frase)
+        )
+
+        return {
+            "esclamazioni": len(EXCLAMATION_RE.findall(narrative)),
+            "interrogative": len(QUESTION_RE.findall(narrative)),
+            "interiezioni": len(INTERJECTION_RE.findall(narrative)),
+            "modalizzatori": len(MODALIZER_RE.findall(narrative)),
+            "sospensioni": len(ELLIPSIS_RE.findall(narrative)),
+            "deissi": deissi,
+            "verbi_dichiarativi": len(DECLARATIVE_RE.findall(text)),
+            "discorso_diretto": len(direct),
+        }
+
+    def score(self, text: str) -> float:
+        """Probabilità stimata di DIL (0-1) per un chunk."""
+        markers = self.extract_markers(text or "")
+        z = self.bias + sum(
+            self.weights.get(nome, 0.0) * min(valore, MAX_COUNT)
+            for nome, valore in markers.items()
+        )
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def route(self, text: str) -> Tuple[Optional[str], float]:
+        """
+        Decide se il chunk può essere risolto localmente.
+
+        Returns
+        -------
+        (label, score): label è 'YES'/'NO' se risolto localmente, None se il
+        chunk va inoltrato all'API.
+        """
+        p = self.score(text)
+        if p <= self.low_threshold:
+            self.stats.auto_no += 1
+            return 'NO', p
+        if p >= self.high_threshold:
+            self.stats.auto_yes += 1
+            return 'YES', p
+        self.stats.forwarded += 1
+        return None, p
+
+
+# ---------------------------------------------------------------------------
+# Stima dei pesi
+# ---------------------------------------------------------------------------
+
+def fit_weights(
+    input_dir: str,
+    exclude_file: Optional[str] = None,
+    sample: int = 40_000,
+    seed: int = 0,
+    l2: float = 1.0,
+) -> Tuple[Dict[str, float], float]:
+    """
+    Stima pesi e bias del modello logistico sulle etichette di chunk_annotated/.
+
+    Le opere presenti in exclude_file (colonna doc_id del gold standard)
+    vengono escluse, così la valutazione con --gold resta fuori campione.
+    Regressione logistica con penalità L2 (bias escluso) risolta con Newton.
+    """
+    # numpy e il loader servono solo alla stima: lo scorer resta senza dipendenze
+    import numpy as np
+    from dil_corpus_loader import LABEL_COLUMN, load_corpus
+
+    corpus = load_corpus(input_dir, text="memory")
+    chunks = corpus.chunks
+    valid = chunks[LABEL_COLUMN].to_numpy() >= 0
+    if exclude_file:
+        with open(exclude_file, 'r', encoding='utf-8') as f:
+            excluded = {re.sub(r'\.txt$', '', r["doc_id"]) for r in csv.DictReader(f)}
+        valid &= ~chunks["filename"].isin(excluded).to_numpy()
+    rows = np.flatnonzero(valid)
+    rows = np.random.default_rng(seed).choice(rows, min(sample, len(rows)), replace=False)
+
+    names = list(DEFAULT_WEIGHTS)
+    markers = map(DILPreClassifier.extract_markers, corpus.texts[rows])
+    X = np.array([[1.0] + [min(m[n], MAX_COUNT) for n in names] for m in markers])
+    y = chunks[LABEL_COLUMN].to_numpy()[rows].astype(float)
+
+    penalty = l2 * np.eye(X.shape[1])
+    penalty[0, 0] = 0.0
+    w = np.zeros(X.shape[1])
+    for _ in range(50):
+        p = 1.0 / (1.0 + np.exp(-X @ w))
+        hessian = X.T @ (X * (p * (1 - p))[:, None]) + penalty
+        step = np.linalg.solve(hessian, X.T @ (y - p) - penalty @ w)
+        w += step
+        if np.abs(step).max() < 1e-8:
+            break
+    return dict(zip(names, w[1:].round(2).tolist())), round(float(w[0]), 2)
+
+
+# ---------------------------------------------------------------------------
+# Valutazione sul gold standard
+# ---------------------------------------------------------------------------
+
+def _binary_metrics(gold: List[bool], pred: List[bool]) -> Dict[str, float]:
+    """Accuracy, precision, recall e F1 per etichette booleane (True = DIL)."""
+    tp = sum(1 for g, p in zip(gold, pred) if g and p)
+    tn = sum(1 for g, p in zip(gold, pred) if not g and not p)
+    fp = sum(1 for g, p in zip(gold, pred) if not g and p)
+    fn = sum(1 for g, p in zip(gold, pred) if g and not p)
+    total = len(gold)
+    precision = tp / (tp + fp) if (tp + fp) else 0.0
+    recall = tp / (tp + fn) if (tp + fn) else 0.0
+    return {
+        "n": total,
+        "accuracy": (tp + tn) / total if total else 0.0,
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if (precision + recall) else 0.0,
+    }
+
+
+def evaluate_on_gold(
+    gold_file: str,
+    classifier: DILPreClassifier,
+    text_column: str = "text",
+    gold_column: str = "DIL",
+    llm_column: Optional[str] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Valuta la cascata sul gold standard annotato manualmente.
+
+    Riporta le metriche dei chunk risolti localmente e, se è disponibile una
+    colonna con le annotazioni LLM già calcolate (es. DIL_gpt_5_2), le metriche
+    della cascata completa (locale + LLM sulla fascia incerta) confrontate con
+    l'LLM da solo.
+    """
+    with open(gold_file, 'r', encoding='utf-8') as f:
+        rows = [r for r in csv.DictReader(f) if r[gold_column].strip().lower() in ("yes", "no")]
+
+    gold_auto, pred_auto = [], []
+    gold_all, pred_cascade, pred_llm = [], [], []
+
+    for row in rows:
+        gold = row[gold_column].strip().lower() == "yes"
+        label, _ = classifier.route(row[text_column])
+        if label is not None:
+            gold_auto.append(gold)
+            pred_auto.append(label == 'YES')
+        if llm_column:
+            llm = row[llm_column].strip().lower() == "yes"
+            gold_all.append(gold)
+            pred_llm.append(llm)
+            pred_cascade.append(label == 'YES' if label is not None else llm)
+
+    risultati = {"risolti_localmente": _binary_metrics(gold_auto, pred_auto)}
+    if llm_column:
+        risultati["cascata"] = _binary_metrics(gold_all, pred_cascade)
+        risultati["solo_llm"] = _binary_metrics(gold_all, pred_llm)
+    return risultati
+
+
+def main():
+    """Entry point: stima i pesi (--fit) o valuta la cascata sul gold standard (--gold)."""
+    parser = argparse.ArgumentParser(description="Valutazione cascata DIL sul gold standard")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--gold", help="CSV gold standard (colonne text, DIL)")
+    mode.add_argument("--fit", metavar="DIR", help="Stima i pesi sui *_chunk.csv di DIR")
+    parser.add_argument("--exclude", default=None,
+                        help="Con --fit: CSV gold standard le cui opere (doc_id) vanno escluse")
+    parser.add_argument("--sample", type=int, default=40_000, help="Con --fit: chunk campionati")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--low", type=float, default=DEFAULT_LOW_THRESHOLD, help="Soglia sotto cui il chunk è NO")
+    parser.add_argument("--high", type=float, default=DEFAULT_HIGH_THRESHOLD, help="Soglia sopra cui il chunk è YES")
+    parser.add_argument("--text-column", default="text")
+    parser.add_argument("--gold-column", default="DIL")
+    parser.add_argument("--llm-column", default=None,
+                        help="Colonna con le annotazioni LLM da usare per la fascia inoltrata")
+    args = parser.parse_args()
+
+    if args.fit:
+        weights, bias = fit_weights(args.fit, args.exclude, args.sample, args.seed)
+        print(f"DEFAULT_WEIGHTS = {weights}")
+        print(f"DEFAULT_BIAS = {bias}")
+        return
+
+    classifier = DILPreClassifier(low_threshold=args.low, high_threshold=args.high)
+    risultati = evaluate_on_gold(
+        args.gold, classifier, args.text_column, args.gold_column, args.llm_column
+    )
+
+    stats = classifier.stats
+    print("=" * 70)
+    print(f"CASCATA DIL — soglie low={args.low} high={args.high}")
+    print("=" * 70)
+    print(f"Righe valutate:       {stats.total}")
+    print(f"Risolte YES (locale): {stats.auto_yes}")
+    print(f"Risolte NO (locale):  {stats.auto_no}")
+    print(f"Inoltrate all'API:    {stats.forwarded} ({stats.forwarded_rate:.1%})")
+    print()
+    print(f"{'Insieme':<20} {'N':>5} {'Accuracy':>9} {'Precision':>10} {'Recall':>8} {'F1':>8}")
+    print("-" * 64)
+    for nome, m in risultati.items():
+        print(f"{nome:<20} {m['n']:>5} {m['accuracy']:>9.2%} {m['precision']:>10.2%} "
+              f"{m['recall']:>8.2%} {m['f1']:>8.2%}")
+    print("=" * 70)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Indice colonnare del corpus annotato (chunk_annotated/) per interrogazioni
+sulla prevalenza del DIL per autore, opera, anno e decennio.
+
+Ogni domanda del tipo "tasso di DIL per decennio" richiedeva di rileggere
+con pandas i 500 CSV (229 MB, 537k chunk). L'indice legge il corpus una
+volta e conserva in un solo file .npz:
+
+  - una riga per opera: filename, nome, titolo, anno, conteggi YES/NO/non
+    validi, posizione dei suoi chunk nel vettore delle etichette, dimensione
+    e mtime del CSV (per l'aggiornamento incrementale)
+  - il vettore int8 delle etichette di tutti i chunk (1 = YES, 0 = NO,
+    -1 = ERROR o mancante), opera dopo opera nell'ordine dei chunk
+
+Le aggregazioni per autore/anno/decennio sono somme sulle ~500 righe delle
+opere; le finestre mobili sugli anni usano somme cumulative; il profilo per
+posizione nel testo usa il vettore delle etichette. Tutte rispondono in
+millisecondi. Alla ricostruzione vengono riletti solo i CSV nuovi o
+modificati.
+
+Uso da riga di comando:
+    python dil_corpus_index.py build ../chunk_annotated
+    python dil_corpus_index.py query --by decade
+    python dil_corpus_index.py query --by nome --min-chunks 200 --output dil_per_autore.md
+    python dil_corpus_index.py rolling --window 10 --output dil_finestra_10_anni.csv
+    python dil_corpus_index.py position --bins 10
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from dil_corpus_loader import METADATA_COLUMNS, read_chunk_file
+
+DEFAULT_INPUT_DIR = "../chunk_annotated"
+DEFAULT_INDEX = "../chunk_annotated_index.npz"
+
+# Colonne delle opere salvate nell'indice (oltre alle etichette)
+WORK_COLUMNS = METADATA_COLUMNS + ["n_chunks", "n_yes", "n_no", "n_invalid", "offset", "path", "size", "mtime_ns"]
+
+# Raggruppamenti ammessi: colonne delle opere più alcuni derivati
+GROUP_ALIASES = {"author": "nome", "work": "titolo", "year": "anno"}
+
+Z_95 = 1.959963984540054
+
+
+def _scan_file(path: str) -> Tuple[Dict[str, object], np.ndarray]:
+    """Metadati e etichette codificate di un CSV *_chunk.csv (una opera)."""
+    chunk_file = read_chunk_file(path)
+    labels = chunk_file.labels
+    stat = os.stat(path)
+    meta = {
+        **chunk_file.meta,
+        "n_chunks": len(labels),
+        "n_yes": int((labels == 1).sum()),
+        "n_no": int((labels == 0).sum()),
+        "n_invalid": int((labels < 0).sum()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "path": Path(path).name,
+    }
+    return meta, labels
+
+
+@dataclass
+class CorpusIndex:
+    """Indice del corpus: tabella delle opere e vettore delle etichette dei chunk."""
+    works: pd.DataFrame
+    labels: np.ndarray
+    rescanned: int = 0
+
+    # -- Costruzione e persistenza ------------------------------------------
+
+    @classmethod
+    def build(
+        cls,
+        input_dir: str,
+        previous: Optional["CorpusIndex"] = None,
+        workers: Optional[int] = None,
+    ) -> "CorpusIndex":
+        """
+        Costruisce l'indice dei *_chunk.csv di input_dir. Se è dato un indice
+        precedente, i file con stessa dimensione e mtime non vengono riletti.
+        """
+        paths = sorted(Path(input_dir).glob("*_chunk.csv"))
+        if not paths:
+            raise SystemExit(f"ERRORE: nessun file *_chunk.csv in {input_dir}")
+
+        reusable = {}
+        if previous is not None:
+            for i, row in enumerate(previous.works.itertuples(index=False)):
+                reusable[row.path] = (row, i)
+
+        results: Dict[str, Tuple[Dict[str, object], np.ndarray]] = {}
+        to_scan = []
+        for path in paths:
+            stat = path.stat()
+            cached = reusable.get(path.name)
+            if cached and cached[0].size == stat.st_size and cached[0].mtime_ns == stat.st_mtime_ns:
+                results[path.name] = (cached[0]._asdict(), previous.work_labels(cached[1]))
+            else:
+                to_scan.append(str(path))
+
+        if workers == 1 or len(to_scan) <= 1:
+            scanned = [_scan_file(path) for path in to_scan]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                scanned = list(executor.map(_scan_file, to_scan, chunksize=8))
+        for meta, labels in scanned:
+            results[meta["path"]] = (meta, labels)
+
+        metas, blocks = zip(*(results[p.name] for p in paths))
+        works = pd.DataFrame(list(metas))
+        works["offset"] = np.concatenate([[0], np.cumsum(works["n_chunks"].to_numpy())[:-1]])
+        labels = np.concatenate(blocks).astype(np.int8)
+        return cls(works[WORK_COLUMNS].reset_index(drop=True), labels, rescanned=len(to_scan))
+
+    def save(self, path: str):
+        """Salva l'indice in un .npz (colonne come array NumPy, senza pickle)."""
+        arrays = {f"works_{c}": self.works[c].to_numpy() for c in self.works.columns}
+        for c in ("filename", "nome", "titolo", "path"):
+            arrays[f"works_{c}"] = self.works[c].astype(str).to_numpy(dtype=str)
+        tmp = f"{path}.tmp.npz"
+        np.savez_compressed(tmp, labels=self.labels, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CorpusIndex":
+        with np.load(path, allow_pickle=False) as data:
+            works = pd.DataFrame({
+                key[len("works_"):]: data[key] for key in data.files if key.startswith("works_")
+            })
+            labels = data["labels"]
+        return cls(works, labels)
+
+    # -- Interrogazioni ------------------------------------------------------
+
+    def work_labels(self, i: int) -> np.ndarray:
+        """Etichette dei chunk dell'opera i."""
+        start = int(self.works["offset"].iat[i])
+        return self.labels[start:start + int(self.works["n_chunks"].iat[i])]
+
+    def _work_table(self) -> pd.DataFrame:
+        works = self.works.copy()
+        works["decade"] = np.where(works["anno"] >= 0, works["anno"] // 10 * 10, -1)
+        return works
+
+    def prevalence(self, by: Union[str, Sequence[str]] = "decade", min_chunks: int = 0) -> pd.DataFrame:
+        """
+        Prevalenza del DIL per gruppo (nome/author, titolo/work, anno/year,
+        decade, o una lista di questi): opere, chunk, conteggi, tasso sui
+        chunk validi con intervallo di Wilson al 95% e media dei tassi delle
+        opere. Le opere con meno di min_chunks chunk validi sono escluse.
+        """
+        keys = [by] if isinstance(by, str) else list(by)
+        keys = [GROUP_ALIASES.get(k, k) for k in keys]
+        works = self._work_table()
+        valid = works["n_yes"] + works["n_no"]
+        works = works[valid >= max(1, min_chunks)]
+        works = works.assign(work_rate=works["n_yes"] / (works["n_yes"] + works["n_no"]))
+        table = works.groupby(keys, sort=True).agg(
+            works=("filename", "size"),
+            chunks=("n_chunks", "sum"),
+            yes=("n_yes", "sum"),
+            no=("n_no", "sum"),
+            invalid=("n_invalid", "sum"),
+            work_rate_mean=("work_rate", "mean"),
+        )
+        return _with_rate(table)
+
+    def rolling(self, window: int = 10, min_chunks: int = 0) -> pd.DataFrame:
+        """
+        Prevalenza in finestre mobili di `window` anni centrate su ogni anno
+        del corpus, con somme cumulative sui conteggi annuali.
+        """
+        works = self.works[(self.works["anno"] >= 0) & (self.works["n_yes"] + self.works["n_no"] >= max(1, min_chunks))]
+        first, last = int(works["anno"].min()), int(works["anno"].max())
+        years = np.arange(first, last + 1)
+        offset = works["anno"].to_numpy() - first
+        cumulative = {}
+        for column, name in (("n_yes", "yes"), ("n_no", "no"), ("n_chunks", "chunks")):
+            per_year = np.bincount(offset, weights=works[column].to_numpy(), minlength=len(years))
+            cumulative[name] = np.concatenate([[0.0], np.cumsum(per_year)])
+        per_year_works = np.concatenate([[0], np.cumsum(np.bincount(offset, minlength=len(years)))])
+
+        low = np.clip(years - first - (window - 1) // 2, 0, len(years))
+        high = np.clip(years - first + window // 2 + 1, 0, len(years))
+        table = pd.DataFrame({
+            "from": years[low],
+            "to": years[high - 1],
+            "works": per_year_works[high] - per_year_works[low],
+            **{name: (values[high] - values[low]).astype(np.int64) for name, values in cumulative.items()},
+        }, index=pd.Index(years, name="anno"))
+        table = table[table["works"] > 0]
+        return _with_rate(table)
+
+    def position_profile(self, bins: int = 10, by: Optional[str] = None) -> pd.DataFrame:
+        """
+        Prevalenza per posizione relativa del chunk nell'opera (bins parti
+        uguali), complessiva o per gruppo (es. by="decade").
+        """
+        counts = self.works["n_chunks"].to_numpy()
+        work_of_chunk = np.repeat(np.arange(len(counts)), counts)
+        position = np.arange(len(self.labels)) - np.repeat(self.works["offset"].to_numpy(), counts)
+        relative = np.minimum(position * bins // np.maximum(np.repeat(counts, counts), 1), bins - 1)
+
+        if by is None:
+            group_codes, groups = np.zeros(len(counts), dtype=np.int64), pd.Index(["corpus"], name="gruppo")
+        else:
+            works = self._work_table()
+            group_codes, groups = pd.factorize(works[GROUP_ALIASES.get(by, by)], sort=True)
+            groups = pd.Index(groups, name=GROUP_ALIASES.get(by, by))
+        cell = group_codes[work_of_chunk] * bins + relative
+        size = len(groups) * bins
+        yes = np.bincount(cell, weights=self.labels == 1, minlength=size)
+        no = np.bincount(cell, weights=self.labels == 0, minlength=size)
+
+        index = pd.MultiIndex.from_product([groups, np.arange(1, bins + 1)], names=[groups.name, "parte"])
+        table = pd.DataFrame({"yes": yes.astype(np.int64), "no": no.astype(np.int64)}, index=index)
+        if by is None:
+            table = table.droplevel(0)
+        return _with_rate(table)
+
+    def summary(self) -> str:
+        yes, no = int(self.works["n_yes"].sum()), int(self.works["n_no"].sum())
+        return (
+            f"{len(self.works)} opere, {len(self.labels):,} chunk "
+            f"(YES {yes:,}, NO {no:,}, non validi {int(self.works['n_invalid'].sum()):,}), "
+            f"prevalenza {yes / max(1, yes + no):.2%}"
+        )
+
+
+def _with_rate(table: pd.DataFrame) -> pd.DataFrame:
+    """Aggiunge tasso YES/(YES+NO) e intervallo di Wilson al 95%."""
+    n = (table["yes"] + table["no"]).to_numpy(dtype=np.float64)
+    p = np.divide(table["yes"].to_numpy(dtype=np.float64), n, out=np.zeros_like(n), where=n > 0)
+    denom = 1 + Z_95 ** 2 / np.maximum(n, 1)
+    centre = (p + Z_95 ** 2 / (2 * np.maximum(n, 1))) / denom
+    half = Z_95 * np.sqrt(p * (1 - p) / np.maximum(n, 1) + Z_95 ** 2 / (4 * np.maximum(n, 1) ** 2)) / denom
+    table = table.copy()
+    table["rate"] = p
+    table["ci_low"] = np.where(n > 0, centre - half, np.nan)
+    table["ci_high"] = np.where(n > 0, centre + half, np.nan)
+    return table
+
+
+def export_table(table: pd.DataFrame, path: str):
+    """
+    Esporta una tabella in CSV o, se path termina in .md, in Markdown con i
+    tassi in percentuale e la virgola decimale, come le tabelle dei report.
+    """
+    if not path.endswith(".md"):
+        table.to_csv(path, encoding="utf-8")
+        return
+
+    flat = table.reset_index()
+    rate_columns = {"rate", "ci_low", "ci_high", "work_rate_mean"}
+    plain_columns = {"anno", "decade", "from", "to", "parte"}
+
+    def fmt(column, value):
+        if column in rate_columns:
+            return "—" if pd.isna(value) else f"{value * 100:.1f}%".replace(".", ",")
+        if isinstance(value, (int, np.integer)) and column not in plain_columns:
+            return f"{value:,}".replace(",", ".")
+        return str(value)
+
+    lines = [
+        "| " + " | ".join(map(str, flat.columns)) + " |",
+        "|" + "---|" * len(flat.columns),
+    ]
+    for row in flat.itertuples(index=False):
+        lines.append("| " + " | ".join(fmt(c, v) for c, v in zip(flat.columns, row)) + " |")
+    Path(path).write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def open_index(index_path: str, input_dir: Optional[str] = None, workers: Optional[int] = None) -> CorpusIndex:
+    """Carica l'indice; se input_dir è indicato lo aggiorna prima (solo i file cambiati)."""
+    previous = CorpusIndex.load(index_path) if Path(index_path).exists() else None
+    if input_dir is None:
+        if previous is None:
+            raise SystemExit(f"ERRORE: indice {index_path} non trovato. Eseguire prima il comando build")
+        return previous
+    index = CorpusIndex.build(input_dir, previous, workers)
+    if index.rescanned or previous is None:
+        index.save(index_path)
+    return index
+
+
+def main():
+    """Entry point: costruzione dell'indice e interrogazioni."""
+    parser = argparse.ArgumentParser(description="Indice e prevalenza DIL del corpus annotato")
+    parser.add_argument("--index", default=DEFAULT_INDEX, help=f"File dell'indice (default: {DEFAULT_INDEX})")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="Costruisce o aggiorna l'indice")
+    p_build.add_argument("input_dir", nargs="?", default=DEFAULT_INPUT_DIR)
+    p_build.add_argument("--workers", type=int, default=None, help="Processi per la lettura dei CSV")
+
+    p_query = sub.add_parser("query", help="Prevalenza per gruppo")
+    p_query.add_argument("--by", nargs="+", default=["decade"],
+                         help="nome/author, titolo/work, anno/year, decade (anche più di uno)")
+    p_query.add_argument("--min-chunks", type=int, default=0, help="Escludi opere con meno chunk validi")
+    p_query.add_argument("--output", default=None, help="Esporta in .csv o .md")
+
+    p_rolling = sub.add_parser("rolling", help="Prevalenza in finestre mobili di anni")
+    p_rolling.add_argument("--window", type=int, default=10, help="Ampiezza della finestra in anni")
+    p_rolling.add_argument("--min-chunks", type=int, default=0)
+    p_rolling.add_argument("--output", default=None)
+
+    p_position = sub.add_parser("position", help="Prevalenza per posizione nel testo")
+    p_position.add_argument("--bins", type=int, default=10, help="Parti in cui dividere ogni opera")
+    p_position.add_argument("--by", default=None, help="Raggruppamento opzionale (es. decade)")
+    p_position.add_argument("--output", default=None)
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        index = open_index(args.index, args.input_dir, args.workers)
+        print(f"Indice {args.index}: {index.summary()}")
+        print(f"File riletti: {index.rescanned} | Tempo: {time.perf_counter() - start:.2f} s")
+        return
+
+    index = open_index(args.index)
+    start = time.perf_counter()
+    if args.command == "query":
+        table = index.prevalence(args.by, args.min_chunks)
+    elif args.command == "rolling":
+        table = index.rolling(args.window, args.min_chunks)
+    else:
+        table = index.position_profile(args.bins, args.by)
+    elapsed = time.perf_counter() - start
+
+    with pd.option_context("display.width", 200, "display.max_rows", 200, "display.float_format", "{:.4f}".format):
+        print(table.to_string())
+    print(f"\n{index.summary()} | Interrogazione: {elapsed * 1000:.1f} ms")
+    if args.output:
+        export_table(table, args.output)
+        print(f"✓ Tabella esportata in: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
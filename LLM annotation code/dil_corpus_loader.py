@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Caricamento compatto del corpus annotato (chunk_annotated/*_chunk.csv).
+
+Concatenando i 500 CSV con pandas, filename, nome, titolo e anno vengono
+ripetuti come stringhe su ognuna delle 537k righe e DIL resta una colonna di
+stringhe: per 229 MB di CSV il DataFrame occupa 429 MB (memory_usage deep)
+e il processo cresce di 332 MB di RSS al picco (--benchmark, pandas 3).
+Qui ogni file viene letto in un processo separato e restituisce solo:
+
+  - i metadati dell'opera (una volta per file: sono costanti nel CSV)
+  - le etichette DIL codificate in int8 (1 = YES, 0 = NO, -1 = non valida)
+  - su richiesta, i testi dei chunk come buffer UTF-8 con le lunghezze
+
+Il processo principale costruisce un DataFrame con filename/nome/titolo
+categoriali (codici interi + un'unica copia di ogni stringa), anno int16,
+posizione del chunk nell'opera int32 e DIL int8. I testi non finiscono nel
+DataFrame: ChunkTexts li conserva in un buffer unico, in memoria oppure in
+un file mappato con np.memmap e decodificato solo per le righe richieste.
+
+Uso da riga di comando:
+    python dil_corpus_loader.py ../chunk_annotated
+    python dil_corpus_loader.py ../chunk_annotated --text mmap --text-path ../chunk_annotated_text.bin
+    python dil_corpus_loader.py ../chunk_annotated --benchmark
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from dil_metrics import encode_labels
+
+DEFAULT_INPUT_DIR = "../chunk_annotated"
+DEFAULT_TEXT_PATH = "../chunk_annotated_text.bin"
+METADATA_COLUMNS = ["filename", "nome", "titolo", "anno"]
+CATEGORY_COLUMNS = ["filename", "nome", "titolo"]
+LABEL_COLUMN = "DIL"
+TEXT_COLUMN = "chunk"
+
+# none = senza testi, memory = buffer in RAM, mmap = file mappato su disco
+TEXT_MODES = ("none", "memory", "mmap")
+
+
+@dataclass
+class ChunkFile:
+    """Contenuto compatto di un *_chunk.csv: metadati, etichette e testi opzionali."""
+    meta: Dict[str, object]
+    labels: np.ndarray
+    text: Optional[bytes] = None
+    lengths: Optional[np.ndarray] = None
+
+
+def read_chunk_file(path: Union[str, Path], text: bool = False) -> ChunkFile:
+    """Legge un CSV di chunk annotati; con text=True include i testi in UTF-8."""
+    columns = METADATA_COLUMNS + [LABEL_COLUMN] + ([TEXT_COLUMN] if text else [])
+    df = pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False, encoding="utf-8")
+    first = df.iloc[0] if len(df) else pd.Series("", index=METADATA_COLUMNS)
+    anno = str(first["anno"]).strip()
+    meta = {
+        "filename": first["filename"] or Path(path).name.replace("_chunk.csv", ""),
+        "nome": first["nome"],
+        "titolo": first["titolo"],
+        "anno": int(anno) if anno.isdigit() else -1,
+    }
+    chunk_file = ChunkFile(meta, encode_labels(df[LABEL_COLUMN]))
+    if text:
+        encoded = [s.encode("utf-8") for s in df[TEXT_COLUMN]]
+        chunk_file.lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        chunk_file.text = b"".join(encoded)
+    return chunk_file
+
+
+def _read_with_text(path: str) -> ChunkFile:
+    return read_chunk_file(path, text=True)
+
+
+def iter_chunk_files(
+    paths: Sequence[Union[str, Path]],
+    text: bool = False,
+    workers: Optional[int] = None,
+) -> Iterable[ChunkFile]:
+    """
+    Legge i file in parallelo (workers=None: un processo per CPU; 1: nessun
+    processo) restituendoli nell'ordine di `paths`, uno alla volta.
+    """
+    reader = _read_with_text if text else read_chunk_file
+    paths = [str(p) for p in paths]
+    if workers == 1 or len(paths) <= 1:
+        yield from map(reader, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(reader, paths, chunksize=4)
+
+
+class ChunkTexts:
+    """
+    Testi dei chunk in un unico buffer UTF-8 con gli offset di inizio di
+    ciascun chunk; il buffer può essere un file mappato (np.memmap).
+    """
+
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray, path: Optional[str] = None):
+        self.buffer = buffer
+        self.offsets = offsets  # len(self) + 1 elementi
+        self.path = path
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _decode(self, i: int) -> str:
+        return bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __getitem__(self, rows) -> Union[str, List[str]]:
+        if isinstance(rows, (int, np.integer)):
+            return self._decode(int(rows) % len(self))
+        return [self._decode(i) for i in np.arange(len(self))[rows]]
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria occupata in RAM (0 per il buffer mappato, oltre agli offset)."""
+        buffer = 0 if isinstance(self.buffer, np.memmap) else self.buffer.nbytes
+        return buffer + self.offsets.nbytes
+
+
+@dataclass
+class Corpus:
+    """Corpus caricato: una riga per chunk e, opzionalmente, i testi."""
+    chunks: pd.DataFrame
+    texts: Optional[ChunkTexts] = None
+
+    def with_text(self, rows=None) -> pd.DataFrame:
+        """Copia delle righe richieste (tutte se rows è None) con la colonna chunk."""
+        if self.texts is None:
+            raise ValueError("Corpus caricato senza testi: usare text='memory' o text='mmap'")
+        positions = np.arange(len(self.chunks)) if rows is None else np.asarray(rows)
+        frame = self.chunks.iloc[positions].copy()
+        frame[TEXT_COLUMN] = self.texts[positions]
+        return frame
+
+    def memory_usage(self) -> int:
+        """Byte in RAM del DataFrame e dei testi (buffer mappato escluso)."""
+        total = int(self.chunks.memory_usage(deep=True).sum())
+        return total + (self.texts.nbytes if self.texts is not None else 0)
+
+
+def load_corpus(
+    input_dir: str = DEFAULT_INPUT_DIR,
+    text: str = "none",
+    text_path: str = DEFAULT_TEXT_PATH,
+    workers: Optional[int] = None,
+) -> Corpus:
+    """
+    Carica tutti i *_chunk.csv di input_dir in un Corpus compatto.
+    Con text='mmap' i testi vengono scritti in text_path (sovrascritto a
+    ogni caricamento) e letti dal disco solo quando richiesti.
+    """
+    if text not in TEXT_MODES:
+        raise ValueError(f"text deve essere uno di {', '.join(TEXT_MODES)}")
+    paths = sorted(Path(input_dir).glob("*_chunk.csv"))
+    if not paths:
+        raise SystemExit(f"ERRORE: nessun file *_chunk.csv in {input_dir}")
+
+    metas, labels, lengths = [], [], []
+    buffer = bytearray()
+    sink = open(text_path, "wb") if text == "mmap" else None
+    try:
+        for chunk_file in iter_chunk_files(paths, text=text != "none", workers=workers):
+            metas.append(chunk_file.meta)
+            labels.append(chunk_file.labels)
+            if chunk_file.text is not None:
+                lengths.append(chunk_file.lengths)
+                # Un solo file alla volta in memoria oltre al buffer
+                if sink is not None:
+                    sink.write(chunk_file.text)
+                else:
+                    buffer += chunk_file.text
+    finally:
+        if sink is not None:
+            sink.close()
+
+    works = pd.DataFrame(metas)
+    n_chunks = np.array([len(block) for block in labels], dtype=np.int64)
+    work_codes = np.repeat(np.arange(len(works), dtype=np.int32), n_chunks)
+    starts = np.concatenate([[0], np.cumsum(n_chunks)[:-1]])
+
+    columns = {}
+    for column in CATEGORY_COLUMNS:
+        # Fattorizzazione sulle ~500 opere, poi un codice per chunk
+        codes, categories = pd.factorize(works[column])
+        columns[column] = pd.Categorical.from_codes(codes[work_codes], categories=categories)
+    columns["anno"] = works["anno"].to_numpy(dtype=np.int16)[work_codes]
+    columns["position"] = (np.arange(len(work_codes), dtype=np.int64) - starts[work_codes]).astype(np.int32)
+    columns[LABEL_COLUMN] = np.concatenate(labels).astype(np.int8)
+    chunks = pd.DataFrame(columns)
+
+    texts = None
+    if text != "none":
+        offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        if sink is not None:
+            mapped = np.memmap(text_path, dtype=np.uint8, mode="r") if offsets[-1] else np.zeros(0, np.uint8)
+            texts = ChunkTexts(mapped, offsets, text_path)
+        else:
+            texts = ChunkTexts(np.frombuffer(buffer, dtype=np.uint8), offsets)
+    return Corpus(chunks, texts)
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+
+def load_naive(input_dir: str) -> pd.DataFrame:
+    """Caricamento precedente (read_csv + concat), solo per il confronto."""
+    paths = sorted(Path(input_dir).glob("*_chunk.csv"))
+    return pd.concat([pd.read_csv(p, encoding="utf-8") for p in paths], ignore_index=True)
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    """Picco di memoria residente in MB (ru_maxrss è in KB su Linux, in byte su macOS)."""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _measure(mode: str, input_dir: str, workers: Optional[int], text_path: str):
+    """Eseguito in un processo separato: carica il corpus e stampa tempi e memoria in JSON."""
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "naive":
+        frame = load_naive(input_dir)
+        rows, in_ram = len(frame), int(frame.memory_usage(deep=True).sum())
+    else:
+        corpus = load_corpus(input_dir, text=mode, text_path=text_path, workers=workers)
+        rows, in_ram = len(corpus.chunks), corpus.memory_usage()
+    print(json.dumps({
+        "mode": mode,
+        "rows": rows,
+        "seconds": time.perf_counter() - start,
+        "data_mb": in_ram / 2 ** 20,
+        "peak_mb": _peak_rss_mb() - baseline,
+        "worker_peak_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }))
+
+
+def _benchmark(input_dir: str, workers: Optional[int]):
+    results = []
+    # Ogni modalità in un processo nuovo, perché il picco RSS non si azzera
+    with tempfile.TemporaryDirectory() as tmp:
+        text_path = os.path.join(tmp, "chunk_text.bin")
+        for mode in ("naive",) + TEXT_MODES:
+            command = [sys.executable, __file__, input_dir, "--measure", mode, "--text-path", text_path]
+            if workers is not None:
+                command += ["--workers", str(workers)]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print("=" * 78)
+    print(f"CARICAMENTO CORPUS — {input_dir}, {results[0]['rows']:,} chunk, workers={workers or os.cpu_count()}")
+    print("=" * 78)
+    print(f"{'Modalità':<18}{'Tempo (s)':>11}{'Dati (MB)':>12}{'Picco RSS (MB)':>16}{'Picco worker':>14}")
+    labels = {"naive": "concat pandas", "none": "compatto", "memory": "+ testi in RAM", "mmap": "+ testi mmap"}
+    for r in results:
+        print(f"{labels[r['mode']]:<18}{r['seconds']:>11.2f}{r['data_mb']:>12.1f}"
+              f"{r['peak_mb']:>16.1f}{r['worker_peak_mb']:>14.1f}")
+    print("Picco RSS: aumento del processo principale durante il caricamento")
+
+
+def main():
+    """Entry point: riepilogo del corpus caricato o benchmark."""
+    parser = argparse.ArgumentParser(description="Caricamento compatto del corpus annotato DIL")
+    parser.add_argument("input_dir", nargs="?", default=DEFAULT_INPUT_DIR)
+    parser.add_argument("--text", choices=TEXT_MODES, default="none", help="Caricamento dei testi (default: none)")
+    parser.add_argument("--text-path", default=DEFAULT_TEXT_PATH, help="File dei testi per --text mmap")
+    parser.add_argument("--workers", type=int, default=None, help="Processi per la lettura dei CSV")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Confronta tempo e picco di memoria con read_csv + concat")
+    parser.add_argument("--measure", choices=("naive",) + TEXT_MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        _measure(args.measure, args.input_dir, args.workers, args.text_path)
+        return
+    if args.benchmark:
+        _benchmark(args.input_dir, args.workers)
+        return
+
+    start = time.perf_counter()
+    corpus = load_corpus(args.input_dir, args.text, args.text_path, args.workers)
+    elapsed = time.perf_counter() - start
+    chunks = corpus.chunks
+    print(f"Chunk: {len(chunks):,} | Opere: {chunks['filename'].cat.categories.size} | "
+          f"Autori: {chunks['nome'].cat.categories.size} | Tempo: {elapsed:.2f} s")
+    print(f"Memoria: {corpus.memory_usage() / 2 ** 20:.1f} MB")
+    print(chunks.dtypes.to_string())
+    counts = chunks[LABEL_COLUMN].value_counts()
+    print(f"YES: {counts.get(1, 0):,} | NO: {counts.get(0, 0):,} | non valide: {counts.get(-1, 0):,}")
+
+
+if __name__ == "__main__":
+    main()
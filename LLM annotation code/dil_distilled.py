@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Classificatore DIL locale distillato dalle annotazioni LLM del corpus.
+
+I file `chunk_annotated/*_chunk.csv` contengono le etichette YES/NO prodotte
+da Claude Sonnet 4.5 per tutti i 536.676 chunk. Questo modulo le usa come
+training set per un modello lineare veloce (n-grammi di parole e punteggiatura
+con feature hashing + regressione logistica via SGD), che gira su CPU a decine
+di migliaia di chunk al secondo.
+
+Le opere del gold standard vanno escluse dal training (--exclude): 18 dei
+34 doc_id dei 500 trigrammi sono in chunk_annotated/ e metà dei trigrammi
+vi compare testualmente, quindi senza esclusione `evaluate --gold`
+misurerebbe il modello su dati già visti.
+
+Comandi:
+    python dil_distilled.py train    --input-dir ./chunk_annotated --model dil_distilled.joblib --exclude corpus_labelled-trigrams_500_DUAL_annotated.csv
+    python dil_distilled.py evaluate --model dil_distilled.joblib --gold corpus_labelled-trigrams_500_DUAL_annotated.csv
+    python dil_distilled.py predict  --model dil_distilled.joblib --input-dir ./chunk --output-dir ./chunk_annotated_local
+
+Il modello addestrato può essere usato come backend alternativo in
+annotate_dil.py impostando in config.json:
+    "backend": "distilled",
+    "distilled_model_path": "./dil_distilled.joblib"
+"""
+
+import argparse
+import csv
+import os
+import re
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+try:
+    import joblib
+    from sklearn.feature_extraction.text import HashingVectorizer
+    from sklearn.linear_model import SGDClassifier
+except ImportError:
+    raise SystemExit("ERRORE: scikit-learn non installato. Eseguire: pip install scikit-learn")
+
+# Parole, più la punteggiatura che i prompt indicano come marcatore DIL
+TOKEN_PATTERN = r"(?u)\b\w+\b|[!?…«»—]|\.\.\."
+N_FEATURES = 2 ** 20
+VALID_LABELS = {'YES', 'NO'}
+
+
+class DistilledDILModel:
+    """Modello lineare su n-grammi hashati, addestrato sulle etichette LLM."""
+
+    def __init__(self, threshold: float = 0.5, alpha: float = 1e-6, epochs: int = 3):
+        self.vectorizer = HashingVectorizer(
+            n_features=N_FEATURES,
+            ngram_range=(1, 2),
+            token_pattern=TOKEN_PATTERN,
+            lowercase=True,
+            alternate_sign=False,
+            norm='l2',
+        )
+        self.classifier = SGDClassifier(
+            loss='log_loss',
+            alpha=alpha,
+            random_state=0,
+        )
+        self.threshold = threshold
+        self.epochs = epochs
+        self.trained_on = 0
+        self.excluded_works: List[str] = []
+
+    def partial_fit(self, texts: List[str], labels: List[str]):
+        """Aggiorna il modello con un blocco di chunk (etichette 'YES'/'NO')."""
+        X = self.vectorizer.transform(texts)
+        y = np.fromiter((label == 'YES' for label in labels), dtype=np.int8, count=len(labels))
+        self.classifier.partial_fit(X, y, classes=np.array([0, 1], dtype=np.int8))
+        self.trained_on += len(labels)
+
+    def predict_proba(self, texts: List[str]) -> np.ndarray:
+        """Probabilità di DIL per ciascun testo."""
+        X = self.vectorizer.transform(texts)
+        return self.classifier.predict_proba(X)[:, 1]
+
+    def predict(self, texts: List[str]) -> List[str]:
+        """Etichette 'YES'/'NO' per ciascun testo."""
+        return np.where(self.predict_proba(texts) >= self.threshold, 'YES', 'NO').tolist()
+
+    def save(self, path: str):
+        """
+        Salva solo i componenti (classificatore, parametri del vettorizzatore,
+        soglia): un pickle dell'istanza registrerebbe la classe come
+        __main__.DistilledDILModel quando il modello è addestrato da riga di
+        comando, e non sarebbe caricabile da annotate_dil.py.
+        """
+        joblib.dump({
+            "vectorizer_params": self.vectorizer.get_params(),
+            "classifier": self.classifier,
+            "threshold": self.threshold,
+            "epochs": self.epochs,
+            "trained_on": self.trained_on,
+            "excluded_works": self.excluded_works,
+        }, path)
+
+    @classmethod
+    def load(cls, path: str) -> "DistilledDILModel":
+        state = joblib.load(path)
+        model = cls(threshold=state["threshold"], epochs=state["epochs"])
+        model.vectorizer.set_params(**state["vectorizer_params"])
+        model.classifier = state["classifier"]
+        model.trained_on = state["trained_on"]
+        model.excluded_works = state.get("excluded_works", [])
+        return model
+
+
+# ---------------------------------------------------------------------------
+# Lettura del corpus annotato
+# ---------------------------------------------------------------------------
+
+def is_holdout(csv_file: Path, holdout_fraction: float) -> bool:
+    """Assegna in modo deterministico un intero file (opera) al validation set."""
+    bucket = zlib.crc32(csv_file.name.encode('utf-8')) % 1000
+    return bucket < holdout_fraction * 1000
+
+
+def gold_works(gold_file: str) -> Set[str]:
+    """Opere del gold standard (doc_id senza .txt), come nei nomi dei *_chunk.csv."""
+    with open(gold_file, 'r', encoding='utf-8') as f:
+        return {re.sub(r'\.txt$', '', row['doc_id']) for row in csv.DictReader(f)}
+
+
+def work_name(csv_file: Path) -> str:
+    return csv_file.name[:-len("_chunk.csv")]
+
+
+def iter_labelled_blocks(
+    csv_files: List[Path],
+    block_size: int = 20000,
+) -> Iterator[Tuple[List[str], List[str]]]:
+    """Legge i chunk etichettati in blocchi, scartando ERROR/UNCLEAR."""
+    texts, labels = [], []
+    for csv_file in csv_files:
+        with open(csv_file, 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                label = row.get('DIL', '').strip().upper()
+                if label not in VALID_LABELS:
+                    continue
+                texts.append(row['chunk'])
+                labels.append(label)
+                if len(texts) >= block_size:
+                    yield texts, labels
+                    texts, labels = [], []
+    if texts:
+        yield texts, labels
+
+
+def binary_metrics(gold: np.ndarray, pred: np.ndarray) -> Dict[str, float]:
+    """Accuracy, precision, recall, F1 e Cohen's kappa per vettori booleani."""
+    tp = int(np.sum(gold & pred))
+    tn = int(np.sum(~gold & ~pred))
+    fp = int(np.sum(~gold & pred))
+    fn = int(np.sum(gold & ~pred))
+    n = tp + tn + fp + fn
+    accuracy = (tp + tn) / n if n else 0.0
+    precision = tp / (tp + fp) if (tp + fp) else 0.0
+    recall = tp / (tp + fn) if (tp + fn) else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if (precision + recall) else 0.0
+    p_e = ((tp + fp) * (tp + fn) + (tn + fn) * (tn + fp)) / (n * n) if n else 0.0
+    kappa = (accuracy - p_e) / (1 - p_e) if p_e < 1 else 0.0
+    return {"n": n, "accuracy": accuracy, "precision": precision, "recall": recall,
+            "f1": f1, "kappa": kappa, "tp": tp, "tn": tn, "fp": fp, "fn": fn}
+
+
+# ---------------------------------------------------------------------------
+# Comandi
+# ---------------------------------------------------------------------------
+
+def train(
+    input_dir: str,
+    model_path: str,
+    holdout_fraction: float = 0.1,
+    epochs: int = 3,
+    exclude_file: Optional[str] = None,
+    seed: int = 0,
+):
+    """
+    Addestra il modello sulle etichette LLM e lo valuta sulle opere escluse.
+
+    Le opere di exclude_file (gold standard) non entrano né nel training né
+    nella validazione. A ogni epoca l'ordine dei file e quello dei chunk in
+    ogni blocco vengono rimescolati, così SGD non vede le opere sempre
+    raggruppate nello stesso ordine.
+    """
+    csv_files = sorted(Path(input_dir).glob("*_chunk.csv"))
+    if not csv_files:
+        raise SystemExit(f"ERRORE: nessun file *_chunk.csv in {input_dir}")
+
+    excluded = sorted(gold_works(exclude_file)) if exclude_file else []
+    n_files = len(csv_files)
+    csv_files = [f for f in csv_files if work_name(f) not in excluded]
+    train_files = [f for f in csv_files if not is_holdout(f, holdout_fraction)]
+    valid_files = [f for f in csv_files if is_holdout(f, holdout_fraction)]
+    print(f"File di training: {len(train_files)} | file di validazione: {len(valid_files)} | "
+          f"file di opere del gold esclusi: {n_files - len(csv_files)}")
+
+    model = DistilledDILModel(epochs=epochs)
+    model.excluded_works = excluded
+    rng = np.random.default_rng(seed)
+    start = time.time()
+    for epoch in range(1, epochs + 1):
+        files = [train_files[i] for i in rng.permutation(len(train_files))]
+        for texts, labels in iter_labelled_blocks(files):
+            order = rng.permutation(len(texts))
+            model.partial_fit([texts[i] for i in order], [labels[i] for i in order])
+        print(f"  Epoca {epoch}/{epochs} completata ({time.time() - start:.0f}s)")
+
+    model.save(model_path)
+    print(f"✓ Modello salvato in: {model_path} ({model.trained_on // epochs:,} chunk per epoca)")
+
+    if valid_files:
+        gold, pred = [], []
+        for texts, labels in iter_labelled_blocks(valid_files):
+            gold.extend(label == 'YES' for label in labels)
+            pred.extend(p == 'YES' for p in model.predict(texts))
+        m = binary_metrics(np.array(gold), np.array(pred))
+        print(f"Accordo con l'LLM sulle opere escluse: accuracy {m['accuracy']:.2%}, "
+              f"F1 {m['f1']:.2%}, kappa {m['kappa']:.3f} (n={m['n']:,})")
+
+
+def evaluate(model_path: str, gold_file: str, text_column: str = "text", gold_column: str = "DIL"):
+    """Valuta il modello sul gold standard umano dei 500 trigrammi."""
+    model = DistilledDILModel.load(model_path)
+    seen = gold_works(gold_file) - set(model.excluded_works)
+    if seen:
+        print(f"ATTENZIONE: {len(seen)} opere del gold non escluse dal training "
+              f"(train --exclude {gold_file}): metriche potenzialmente ottimistiche")
+
+    with open(gold_file, 'r', encoding='utf-8') as f:
+        rows = [r for r in csv.DictReader(f) if r[gold_column].strip().upper() in VALID_LABELS]
+
+    texts = [r[text_column] for r in rows]
+    start = time.perf_counter()
+    pred = np.array([p == 'YES' for p in model.predict(texts)])
+    elapsed = time.perf_counter() - start
+    gold = np.array([r[gold_column].strip().upper() == 'YES' for r in rows])
+
+    m = binary_metrics(gold, pred)
+    print("=" * 70)
+    print("CLASSIFICATORE DISTILLATO vs GOLD STANDARD")
+    print("=" * 70)
+    print(f"Righe valutate: {m['n']}")
+    print(f"Accuracy:  {m['accuracy']:.2%}")
+    print(f"Precision: {m['precision']:.2%}")
+    print(f"Recall:    {m['recall']:.2%}")
+    print(f"F1-Score:  {m['f1']:.2%}")
+    print(f"Cohen's κ: {m['kappa']:.3f}")
+    print(f"Confusion matrix: TN={m['tn']} FP={m['fp']} FN={m['fn']} TP={m['tp']}")
+    print(f"Throughput: {len(texts) / elapsed:,.0f} chunk/s")
+    print("=" * 70)
+    return m
+
+
+_worker_model = None
+
+
+def _init_worker(model_path: str):
+    global _worker_model
+    _worker_model = DistilledDILModel.load(model_path)
+
+
+def _annotate_file(csv_file: Path, output_dir: Path, column: str) -> int:
+    """Annota un singolo file di chunk e ritorna il numero di righe scritte."""
+    with open(csv_file, 'r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        return 0
+    for row, label in zip(rows, _worker_model.predict([r['chunk'] for r in rows])):
+        row[column] = label
+
+    with open(output_dir / csv_file.name, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()), quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+def predict(model_path: str, input_dir: str, output_dir: str, column: str = "DIL", workers: int = 1):
+    """Ri-annota offline tutti i file *_chunk.csv di una directory."""
+    out = Path(output_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    csv_files = sorted(Path(input_dir).glob("*_chunk.csv"))
+
+    start = time.time()
+    if workers > 1:
+        # Il vettorizzatore è stateless: ogni processo carica il modello una
+        # volta e annota file interi in parallelo
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(model_path,)) as pool:
+            total = sum(pool.map(_annotate_file, csv_files, repeat(out), repeat(column)))
+    else:
+        _init_worker(model_path)
+        total = sum(_annotate_file(csv_file, out, column) for csv_file in csv_files)
+
+    elapsed = time.time() - start
+    print(f"✓ Annotati {total:,} chunk in {len(csv_files)} file ({elapsed:.1f}s, "
+          f"{total / elapsed if elapsed else 0:,.0f} chunk/s)")
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description="Classificatore DIL locale distillato dalle etichette LLM")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_train = sub.add_parser("train", help="Addestra il modello su chunk_annotated/")
+    p_train.add_argument("--input-dir", default="./chunk_annotated")
+    p_train.add_argument("--model", default="./dil_distilled.joblib")
+    p_train.add_argument("--holdout", type=float, default=0.1, help="Frazione di opere per la validazione")
+    p_train.add_argument("--epochs", type=int, default=3)
+    p_train.add_argument("--exclude", default=None,
+                         help="CSV gold standard le cui opere (doc_id) vanno escluse dal training")
+    p_train.add_argument("--seed", type=int, default=0, help="Seed del rimescolamento per epoca")
+
+    p_eval = sub.add_parser("evaluate", help="Valuta il modello sul gold standard")
+    p_eval.add_argument("--model", default="./dil_distilled.joblib")
+    p_eval.add_argument("--gold", required=True)
+    p_eval.add_argument("--text-column", default="text")
+    p_eval.add_argument("--gold-column", default="DIL")
+
+    p_pred = sub.add_parser("predict", help="Ri-annota un corpus di chunk")
+    p_pred.add_argument("--model", default="./dil_distilled.joblib")
+    p_pred.add_argument("--input-dir", default="./chunk")
+    p_pred.add_argument("--output-dir", default="./chunk_annotated_local")
+    p_pred.add_argument("--column", default="DIL")
+    p_pred.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Processi paralleli (default: numero di CPU)")
+
+    args = parser.parse_args()
+    if args.command == "train":
+        train(args.input_dir, args.model, args.holdout, args.epochs, args.exclude, args.seed)
+    elif args.command == "evaluate":
+        evaluate(args.model, args.gold, args.text_column, args.gold_column)
+    else:
+        predict(args.model, args.input_dir, args.output_dir, args.column, args.workers)
+
+
+if __name__ == "__main__":
+    main()
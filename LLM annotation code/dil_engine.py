@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Motore di annotazione condiviso dagli script DIL.
+
+Gli script di annotazione ripetevano ciascuno lo stesso ciclo: costruzione
+del prompt, chiamata con retry, normalizzazione YES/NO, concorrenza e
+salvataggio dei risultati. AnnotationEngine raccoglie il ciclo in un solo
+punto, con componenti intercambiabili:
+
+  - backend: un oggetto con `annotate(transport, text)` asincrono che
+    restituisce un ProviderResult (i backend di dil_providers.py e
+    HedgedDispatcher; prompt, retry e normalizzazione stanno lì), oppure
+    una funzione sincrona testo -> etichetta avvolta in FunctionBackend
+    (SDK sincroni, modelli locali)
+  - esecuzione: run_async() esegue i backend asincroni con run_scheduled(),
+    run() quelli sincroni su un pool di thread con run_threaded(); in
+    entrambi i casi longest-first a finestre se schedule_window > 1
+  - cache: un testo già annotato con successo dallo stesso motore non
+    viene reinviato (duplicati nel file o tra file diversi); la cache è
+    una LRU di al più cache_size voci indicizzata dal digest del testo,
+    quindi la memoria resta limitata anche sull'intero corpus. Con
+    cache=False ogni chiave genera la propria richiesta, anche se il
+    testo è ripetuto (es. esperimenti che confrontano annotazioni riga
+    per riga)
+  - sink: qualunque oggetto con `write(key, label)`, ad esempio il
+    ResultsSidecar di dil_results.py, riceve ogni etichetta appena prodotta
+
+Uso tipico:
+
+    engine = AnnotationEngine(create_backend('anthropic', config, SYSTEM_PROMPT, USER_PROMPT_TEMPLATE),
+                              concurrency=5)
+    async with HTTPTransport.from_config(config) as transport:
+        results = await engine.run_async(transport, {i: row['chunk'] for i, row in enumerate(rows)})
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, Hashable, Iterator, List, Mapping, Optional, Tuple
+
+from dil_providers import ProviderResult
+from dil_scheduler import estimate_tokens, run_scheduled, run_threaded
+
+
+class FunctionBackend:
+    """
+    Backend sincrono: avvolge una funzione testo -> etichetta che gestisce
+    da sé prompt e retry (es. analyze_text degli script GPT).
+    """
+
+    def __init__(self, func: Callable[[str], Optional[str]], name: str = "function"):
+        self.func = func
+        self.name = name
+
+    def annotate_sync(self, text: str) -> ProviderResult:
+        start = time.perf_counter()
+        label = self.func(text)
+        return ProviderResult(label=label, backend=self.name, latency=time.perf_counter() - start)
+
+
+@dataclass
+class EngineStats:
+    """Contatori del motore: richieste effettive, risposte dalla cache, fallimenti."""
+    requests: int = 0
+    cache_hits: int = 0
+    failures: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost: float = 0.0
+
+
+class AnnotationEngine:
+    """Esegue un backend su un insieme di testi indicizzati da una chiave."""
+
+    def __init__(
+        self,
+        backend,
+        concurrency: int = 5,
+        schedule_window: int = 0,
+        overhead_chars: int = 0,
+        sink=None,
+        cache: bool = True,
+        cache_size: int = 100_000,
+    ):
+        self.backend = backend
+        self.concurrency = concurrency
+        self.schedule_window = schedule_window
+        self.overhead_chars = overhead_chars
+        self.sink = sink
+        self.cache: Optional["OrderedDict[bytes, ProviderResult]"] = OrderedDict() if cache else None
+        self.cache_size = cache_size
+        self.stats = EngineStats()
+
+    @staticmethod
+    def _digest(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _lookup(self, text: str) -> Optional[ProviderResult]:
+        if self.cache is None:
+            return None
+        digest = self._digest(text)
+        result = self.cache.get(digest)
+        if result is not None:
+            self.cache.move_to_end(digest)
+        return result
+
+    def _store(self, text: str, result: ProviderResult):
+        if self.cache is None or self.cache_size <= 0:
+            return
+        digest = self._digest(text)
+        self.cache[digest] = result
+        self.cache.move_to_end(digest)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _plan(self, texts: Mapping[Hashable, str]) -> Tuple[List[Tuple[Hashable, ProviderResult]], List[Tuple[str, list]]]:
+        """
+        Separa le chiavi già risolte dalla cache da quelle da inviare.
+        Con la cache attiva le chiavi con lo stesso testo sono raggruppate
+        e ogni testo distinto viene inviato una sola volta; senza cache
+        ogni chiave forma un gruppo a sé.
+        """
+        if self.cache is None:
+            return [], [(text, [key]) for key, text in texts.items()]
+        cached, groups = [], {}
+        for key, text in texts.items():
+            hit = self._lookup(text)
+            if hit is not None:
+                cached.append((key, self._reused(hit)))
+            else:
+                groups.setdefault(text, []).append(key)
+        return cached, list(groups.items())
+
+    @staticmethod
+    def _reused(result: ProviderResult) -> ProviderResult:
+        # Un risultato riusato non ha costo né latenza propri
+        return replace(result, latency=0.0, input_tokens=0, output_tokens=0, cost=0.0, hedged=False)
+
+    def _cost(self, text: str) -> float:
+        return estimate_tokens(text, self.overhead_chars)
+
+    def _emit(self, keys: list, text: str, result: ProviderResult) -> Iterator[Tuple[Hashable, ProviderResult]]:
+        """Registra l'esito di un testo e lo distribuisce a tutte le sue chiavi."""
+        self.stats.requests += 1
+        self.stats.input_tokens += result.input_tokens
+        self.stats.output_tokens += result.output_tokens
+        self.stats.cost += result.cost
+        if result.label is None:
+            self.stats.failures += 1
+        else:
+            self._store(text, result)
+
+        for n, key in enumerate(keys):
+            key_result = result if n == 0 else self._reused(result)
+            if n > 0:
+                self.stats.cache_hits += 1
+            yield key, key_result
+
+    def _deliver(self, key: Hashable, result: ProviderResult):
+        if self.sink is not None and result.label is not None:
+            self.sink.write(key, result.label)
+
+    def run(
+        self,
+        texts: Mapping[Hashable, str],
+        stop: Optional[Callable[[], bool]] = None,
+    ) -> Iterator[Tuple[Hashable, ProviderResult]]:
+        """
+        Annota con un backend sincrono su `concurrency` thread e restituisce
+        le coppie (chiave, ProviderResult) in ordine di completamento, nel
+        thread chiamante. Le eccezioni del backend vengono propagate.
+
+        Per interrompere il run si usa `stop` invece di uscire dal ciclo:
+        quando diventa vero non partono altre richieste, ma quelle già in
+        volo vengono restituite e passate al sink.
+        """
+        if not isinstance(self.backend, FunctionBackend):
+            raise TypeError("run() richiede un FunctionBackend: per i backend asincroni usare run_async()")
+        cached, groups = self._plan(texts)
+        for key, result in cached:
+            self.stats.cache_hits += 1
+            self._deliver(key, result)
+            yield key, result
+
+        window = self.schedule_window if self.schedule_window > 1 else 0
+        for n, result in run_threaded(
+            range(len(groups)), lambda n: self.backend.annotate_sync(groups[n][0]), self.concurrency,
+            cost=(lambda n: self._cost(groups[n][0])) if window else None, window=window, stop=stop,
+        ):
+            text, keys = groups[n]
+            for key, key_result in self._emit(keys, text, result):
+                self._deliver(key, key_result)
+                yield key, key_result
+
+    async def run_async(
+        self,
+        transport,
+        texts: Mapping[Hashable, str],
+        on_result: Optional[Callable[[Hashable, ProviderResult], None]] = None,
+    ) -> Dict[Hashable, ProviderResult]:
+        """
+        Annota con un backend asincrono (al più `concurrency` richieste in
+        volo) e restituisce {chiave: ProviderResult}; `on_result` viene
+        chiamato per ogni chiave appena il suo esito è disponibile.
+        """
+        results: Dict[Hashable, ProviderResult] = {}
+
+        def deliver(key, result):
+            results[key] = result
+            self._deliver(key, result)
+            if on_result is not None:
+                on_result(key, result)
+
+        cached, groups = self._plan(texts)
+        for key, result in cached:
+            self.stats.cache_hits += 1
+            deliver(key, result)
+
+        async def worker(n):
+            text, keys = groups[n]
+            result = await self.backend.annotate(transport, text)
+            for key, key_result in self._emit(keys, text, result):
+                deliver(key, key_result)
+
+        window = self.schedule_window if self.schedule_window > 1 else 0
+        await run_scheduled(
+            range(len(groups)), worker, self.concurrency,
+            cost=(lambda n: self._cost(groups[n][0])) if window else None, window=window,
+        )
+        return results
+
+    def summary(self) -> str:
+        return (
+            f"Richieste: {self.stats.requests} | Dalla cache: {self.stats.cache_hits} | "
+            f"Fallite: {self.stats.failures} | Costo: ${self.stats.cost:.4f}"
+        )
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Metriche di accordo e di performance per più annotatori in un solo passaggio.
+
+Gli script calcolavano le metriche costruendo un DataFrame filtrato per
+ciascuna cella della matrice di confusione e ripetendo i filtri per ogni
+coppia di annotatori. Qui le etichette di tutte le colonne (gold umano DIL,
+DIL_Sonnet, DIL_gpt_5_2, DIL_Claude_API, ...) vengono codificate una sola
+volta in una matrice di interi (1 = yes, 0 = no, -1 = mancante o non
+valida). Affiancando le indicatrici Y (yes) e N (no) in V = [Y N], un solo
+prodotto matriciale Vᵀ V dà le matrici di confusione di tutte le coppie di
+colonne, ciascuna sulle sole righe valide per entrambe:
+
+    TP = Yᵀ Y   FN = Yᵀ N   FP = Nᵀ Y   TN = Nᵀ N
+
+(riga = colonna di riferimento, colonna = colonna confrontata). Accuracy,
+precision, recall, specificità, F1 e kappa di Cohen sono poi operazioni
+vettoriali sulle matrici k × k dei conteggi.
+
+Uso da riga di comando:
+    python dil_metrics.py corpus_labelled-trigrams_500_DUAL_annotated.csv
+    python dil_metrics.py FILE.csv --reference DIL --columns DIL_Sonnet DIL_gpt_5_2
+    python dil_metrics.py --benchmark 537000
+"""
+
+import argparse
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# Le annotazioni umane originali usano Si/No
+LABEL_CODES = {"no": 0, "yes": 1, "si": 1, "sì": 1}
+
+# Colonne di conteggio, nell'ordine in cui compaiono nelle tabelle
+COUNT_KEYS = ("tp", "tn", "fp", "fn")
+
+
+def encode_labels(values) -> np.ndarray:
+    """
+    Codifica una sequenza di etichette in int8: 1 = yes, 0 = no, -1 per
+    valori mancanti o non validi. Maiuscole e spazi sono ignorati.
+    """
+    # Le etichette distinte sono poche: si normalizzano i valori distinti,
+    # non le singole righe
+    codes, uniques = pd.factorize(pd.Series(values, copy=False))
+    mapping = np.array(
+        [LABEL_CODES.get(str(u).strip().lower(), -1) for u in uniques] + [-1], dtype=np.int8
+    )
+    return mapping[codes]  # il codice -1 di factorize (NaN) prende l'ultimo elemento
+
+
+def encode_columns(df: pd.DataFrame, columns: Sequence[str]) -> np.ndarray:
+    """Matrice (righe × colonne) int8 delle etichette codificate."""
+    missing = [c for c in columns if c not in df.columns]
+    if missing:
+        raise ValueError(f"Colonne non trovate: {', '.join(missing)}")
+    if not columns:
+        return np.empty((len(df), 0), dtype=np.int8)
+    return np.column_stack([encode_labels(df[c]) for c in columns])
+
+
+def annotator_columns(df: pd.DataFrame, prefix: str = "DIL") -> List[str]:
+    """Colonne di annotazione: nome che inizia per `prefix` e almeno un'etichetta yes/no."""
+    return [
+        c for c in df.columns
+        if str(c).startswith(prefix) and (encode_labels(df[c]) >= 0).any()
+    ]
+
+
+def pairwise_confusion(codes: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Conteggi TP/TN/FP/FN (matrici k × k int64) per tutte le coppie di
+    colonne di `codes`; l'elemento [i, j] confronta la colonna j con la
+    colonna i presa come riferimento.
+    """
+    n, k = codes.shape
+    # float32 è esatto fino a 2^24 righe e usa il prodotto BLAS più veloce
+    dtype = np.float32 if n < 2 ** 24 else np.float64
+    indicators = np.empty((n, 2 * k), dtype=dtype)
+    np.equal(codes, 1, out=indicators[:, :k])
+    np.equal(codes, 0, out=indicators[:, k:])
+    gram = np.rint(indicators.T @ indicators).astype(np.int64)
+    return {
+        "tp": gram[:k, :k],
+        "fn": gram[:k, k:],
+        "fp": gram[k:, :k],
+        "tn": gram[k:, k:],
+    }
+
+
+def _ratio(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    """num / den elemento per elemento, 0 dove den è 0."""
+    num = np.asarray(num, dtype=np.float64)
+    den = np.asarray(den, dtype=np.float64)
+    return np.divide(num, den, out=np.zeros(np.broadcast(num, den).shape), where=den > 0)
+
+
+def metrics_from_counts(tp, tn, fp, fn) -> Dict[str, np.ndarray]:
+    """
+    Metriche binarie da conteggi (scalari o array della stessa forma).
+    Le divisioni per zero danno 0; kappa è 0 se l'accordo atteso è 1.
+    """
+    tp, tn, fp, fn = (np.asarray(x, dtype=np.int64) for x in (tp, tn, fp, fn))
+    total = tp + tn + fp + fn
+    accuracy = _ratio(tp + tn, total)
+    precision = _ratio(tp, tp + fp)
+    recall = _ratio(tp, tp + fn)
+    # Accordo atteso dalle distribuzioni marginali dei due annotatori
+    p_e = _ratio((tp + fn) * (tp + fp) + (tn + fp) * (tn + fn), total * total)
+    kappa = _ratio(accuracy - p_e, 1.0 - p_e)
+    kappa = np.where((total > 0) & (p_e < 1.0), kappa, 0.0)
+    return {
+        "total": total,
+        "accuracy": accuracy,
+        "precision": precision,
+        "recall": recall,
+        "specificity": _ratio(tn, tn + fp),
+        "f1_score": _ratio(2 * tp, 2 * tp + fp + fn),
+        "kappa": kappa,
+        "tp": tp,
+        "tn": tn,
+        "fp": fp,
+        "fn": fn,
+    }
+
+
+def pair_metrics(df: pd.DataFrame, reference: str, column: str) -> Dict[str, float]:
+    """
+    Metriche di `column` rispetto a `reference` come dizionario di scalari
+    Python (serializzabile in JSON).
+    """
+    counts = pairwise_confusion(encode_columns(df, [reference, column]))
+    metrics = metrics_from_counts(*(counts[key][0, 1] for key in COUNT_KEYS))
+    return {key: value.item() for key, value in metrics.items()}
+
+
+def annotator_metrics(
+    df: pd.DataFrame,
+    reference: str = "DIL",
+    columns: Optional[Sequence[str]] = None,
+) -> pd.DataFrame:
+    """
+    Tabella delle metriche di ciascuna colonna rispetto a `reference`, una
+    riga per annotatore. Di default tutte le colonne DIL* con etichette.
+    """
+    if columns is None:
+        columns = [c for c in annotator_columns(df) if c != reference]
+    codes = encode_columns(df, [reference, *columns])
+    counts = pairwise_confusion(codes)
+    metrics = metrics_from_counts(*(counts[key][0, 1:] for key in COUNT_KEYS))
+    table = pd.DataFrame(metrics, index=pd.Index(list(columns), name="annotator"))
+    table["yes_rate"] = _ratio(counts["tp"][0, 1:] + counts["fp"][0, 1:], table["total"].to_numpy())
+    return table
+
+
+def agreement_matrix(
+    df: pd.DataFrame,
+    columns: Optional[Sequence[str]] = None,
+    metric: str = "kappa",
+) -> pd.DataFrame:
+    """Matrice k × k di una metrica (default kappa di Cohen) tra tutte le coppie di colonne."""
+    if columns is None:
+        columns = annotator_columns(df)
+    counts = pairwise_confusion(encode_columns(df, columns))
+    values = metrics_from_counts(*(counts[key] for key in COUNT_KEYS))[metric]
+    return pd.DataFrame(values, index=list(columns), columns=list(columns))
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+
+def _filtered_metrics(df: pd.DataFrame, gold: str, pred: str) -> Dict[str, float]:
+    """Implementazione precedente (un filtro per cella), solo per il confronto."""
+    df_eval = df[df[pred].isin(["yes", "no"]) & df[gold].isin(["yes", "no"])]
+    tp = len(df_eval[(df_eval[gold] == "yes") & (df_eval[pred] == "yes")])
+    tn = len(df_eval[(df_eval[gold] == "no") & (df_eval[pred] == "no")])
+    fp = len(df_eval[(df_eval[gold] == "no") & (df_eval[pred] == "yes")])
+    fn = len(df_eval[(df_eval[gold] == "yes") & (df_eval[pred] == "no")])
+    return {"tp": tp, "tn": tn, "fp": fp, "fn": fn}
+
+
+def _synthetic_corpus(rows: int, annotators: int, seed: int) -> pd.DataFrame:
+    """Corpus sintetico: gold e annotatori che concordano col gold all'80-90%."""
+    rng = np.random.default_rng(seed)
+    gold = rng.random(rows) < 0.3
+    data = {"DIL": np.where(gold, "yes", "no")}
+    for a in range(annotators):
+        flip = rng.random(rows) < 0.1 + 0.02 * a
+        labels = np.where(gold ^ flip, "yes", "no").astype(object)
+        labels[rng.random(rows) < 0.01] = None  # risposte mancanti
+        data[f"DIL_annotator_{a}"] = labels
+    return pd.DataFrame(data)
+
+
+def _benchmark(rows: int, annotators: int, seed: int):
+    df = _synthetic_corpus(rows, annotators, seed)
+    columns = list(df.columns)
+    pairs = [(a, b) for i, a in enumerate(columns) for b in columns[i + 1:]]
+
+    start = time.perf_counter()
+    old = {(a, b): _filtered_metrics(df, a, b) for a, b in pairs}
+    t_old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    counts = pairwise_confusion(encode_columns(df, columns))
+    metrics = metrics_from_counts(*(counts[key] for key in COUNT_KEYS))
+    t_new = time.perf_counter() - start
+
+    for a, b in pairs:
+        i, j = columns.index(a), columns.index(b)
+        assert all(old[a, b][key] == metrics[key][i, j] for key in COUNT_KEYS), (a, b)
+
+    print("=" * 70)
+    print(f"METRICHE DIL — {rows:,} righe, {annotators} annotatori + gold, {len(pairs)} coppie")
+    print("=" * 70)
+    print(f"Filtri per cella:          {t_old:8.3f} s")
+    print(f"Matrice di confusione:     {t_new:8.3f} s  ({t_old / t_new:.1f}x)")
+    print("Conteggi identici all'implementazione precedente")
+
+
+def main():
+    """Entry point: tabella delle metriche di un CSV annotato o benchmark."""
+    parser = argparse.ArgumentParser(description="Metriche multi-annotatore DIL")
+    parser.add_argument("input_file", nargs="?", help="CSV con la colonna gold e le colonne degli annotatori")
+    parser.add_argument("--reference", default="DIL", help="Colonna di riferimento (default: DIL)")
+    parser.add_argument("--columns", nargs="+", default=None,
+                        help="Colonne da valutare (default: tutte le colonne DIL*)")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="RIGHE",
+                        help="Confronta con l'implementazione a filtri su un corpus sintetico")
+    parser.add_argument("--annotators", type=int, default=4, help="Annotatori sintetici nel benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        _benchmark(args.benchmark, args.annotators, args.seed)
+        return
+    if not args.input_file:
+        parser.error("indicare un file CSV oppure --benchmark")
+
+    df = pd.read_csv(args.input_file, encoding="utf-8")
+    table = annotator_metrics(df, args.reference, args.columns)
+    columns = [args.reference, *table.index]
+
+    with pd.option_context("display.width", 200, "display.float_format", "{:.4f}".format):
+        print("=" * 70)
+        print(f"METRICHE vs {args.reference} — {args.input_file}")
+        print("=" * 70)
+        print(table.to_string())
+        print("\nKappa di Cohen tra tutte le coppie:")
+        print(agreement_matrix(df, columns).to_string())
+
+
+if __name__ == "__main__":
+    main()
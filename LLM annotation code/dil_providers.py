@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Livello di astrazione sui provider LLM per l'annotazione DIL.
+
+Ogni backend (Anthropic Messages API, OpenAI Responses API) espone la stessa
+interfaccia asincrona `annotate(transport, text)` e restituisce un
+ProviderResult con etichetta, latenza, token e costo della chiamata.
+SimulatedBackend riproduce una latenza proporzionale alla lunghezza del
+prompt senza chiamate di rete, per i benchmark dello scheduler.
+
+HedgedDispatcher combina un backend primario e uno secondario con richieste
+"hedged": se il primario non risponde entro il p95 della propria latenza
+recente, lo stesso chunk viene inviato anche al secondario e vince la prima
+risposta valida. Il dispatcher registra quale backend ha risposto e il costo
+extra delle richieste duplicate, così da poter lavorare sul provider più sano.
+"""
+
+import asyncio
+import logging
+import random
+import time
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from dil_transport import HTTPTransport
+
+# Prezzi ($/MTok) per il calcolo dei costi
+ANTHROPIC_PRICES = (3.00, 15.00)
+OPENAI_PRICES = (1.75, 14.00)
+
+# Stima grossolana caratteri/token per il costo delle richieste annullate
+CHARS_PER_TOKEN = 4
+
+
+def normalize_label(response_text: str) -> str:
+    """Normalizza la risposta del modello in 'YES'/'NO'/'UNCLEAR'."""
+    text = response_text.strip().upper()
+    if 'YES' in text:
+        return 'YES'
+    elif 'NO' in text:
+        return 'NO'
+    return 'UNCLEAR'
+
+
+@dataclass
+class ProviderResult:
+    """Esito di una chiamata a un backend (label None = chiamata fallita)."""
+    label: Optional[str]
+    backend: str
+    latency: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost: float = 0.0
+    hedged: bool = False
+    response_text: str = ""
+
+
+class ProviderBackend:
+    """Backend base: retry, storico latenze e calcolo dei costi."""
+
+    name = "base"
+
+    def __init__(
+        self,
+        model: str,
+        system_prompt: str,
+        prompt_template: str,
+        prices: tuple,
+        max_retries: int = 3,
+        retry_delay: float = 2,
+        max_tokens: int = 10,
+        latency_window: int = 500,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.model = model
+        self.system_prompt = system_prompt
+        self.prompt_template = prompt_template
+        self.input_price, self.output_price = prices
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_tokens = max_tokens
+        self.latencies = deque(maxlen=latency_window)
+        self.logger = logger or logging.getLogger(__name__)
+
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        return (input_tokens * self.input_price + output_tokens * self.output_price) / 1_000_000
+
+    def estimated_cost(self, text: str) -> float:
+        """Costo stimato di una richiesta annullata (solo input)."""
+        prompt = self.prompt_template.format(testo_blocco=text)
+        tokens = (len(self.system_prompt) + len(prompt)) // CHARS_PER_TOKEN
+        return self.cost(tokens, 0)
+
+    def latency_quantile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        """Quantile q delle latenze recenti, None se lo storico è troppo corto."""
+        if len(self.latencies) < min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    async def _request(self, transport: HTTPTransport, text: str):
+        """Una singola richiesta HTTP: ritorna (status, data|testo errore, headers)."""
+        return await transport.post_json(self.url, self.headers, self._payload(text))
+
+    def _payload(self, text: str) -> dict:
+        """Corpo JSON della richiesta per un chunk."""
+        raise NotImplementedError
+
+    def _parse(self, data: dict) -> tuple:
+        """Estrae (testo risposta, input_tokens, output_tokens) dal JSON."""
+        raise NotImplementedError
+
+    async def annotate(self, transport: HTTPTransport, text: str) -> ProviderResult:
+        """
+        Annota un chunk con retry; in caso di fallimento label è None.
+
+        Lo storico usato per il quantile dell'hedging riceve un campione per
+        ogni chiamata, riuscita, fallita o annullata (in quest'ultimo caso
+        il tempo trascorso è un limite inferiore): scartare le chiamate
+        lente annullate dall'hedge abbasserebbe il p95 e farebbe scattare
+        l'hedging sempre prima. Le attese imposte dai 429 (retry-after) non
+        dipendono dalla latenza del provider e sono escluse dal campione.
+        """
+        start = time.perf_counter()
+        paused = 0.0
+
+        def sample() -> float:
+            return time.perf_counter() - start - paused
+
+        for attempt in range(self.max_retries):
+            try:
+                status, data, headers = await self._request(transport, text)
+                if status == 200:
+                    response_text, in_tok, out_tok = self._parse(data)
+                    label = normalize_label(response_text)
+                    if label == 'UNCLEAR':
+                        self.logger.warning(f"[{self.name}] Risposta ambigua: {response_text}")
+                    latency = time.perf_counter() - start
+                    self.latencies.append(sample())
+                    return ProviderResult(
+                        label=label,
+                        backend=self.name,
+                        latency=latency,
+                        input_tokens=in_tok,
+                        output_tokens=out_tok,
+                        cost=self.cost(in_tok, out_tok),
+                        response_text=response_text,
+                    )
+                elif status == 429:
+                    retry_after = int(headers.get('retry-after', self.retry_delay * (attempt + 1)))
+                    self.logger.warning(f"[{self.name}] Rate limit hit, retry dopo {retry_after}s")
+                    pause_start = time.perf_counter()
+                    try:
+                        await asyncio.sleep(retry_after)
+                    finally:
+                        paused += time.perf_counter() - pause_start
+                else:
+                    self.logger.error(f"[{self.name}] API error {status}: {data}")
+                    await asyncio.sleep(self.retry_delay * (attempt + 1))
+
+            except asyncio.CancelledError:
+                # Tipicamente la richiesta perdente di un hedge: è la coda lenta
+                self.latencies.append(sample())
+                raise
+            except Exception as e:
+                self.logger.error(
+                    f"[{self.name}] Errore chiamata API (tentativo {attempt + 1}/{self.max_retries}): {e}"
+                )
+                await asyncio.sleep(self.retry_delay * (attempt + 1))
+
+        self.latencies.append(sample())
+        return ProviderResult(label=None, backend=self.name, latency=time.perf_counter() - start)
+
+
+class AnthropicBackend(ProviderBackend):
+    """Claude via Messages API."""
+
+    name = "anthropic"
+    url = "https://api.anthropic.com/v1/messages"
+
+    def __init__(self, api_key: str, model: str, system_prompt: str, prompt_template: str, **kwargs):
+        super().__init__(model, system_prompt, prompt_template, ANTHROPIC_PRICES, **kwargs)
+        self.headers = {
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01",
+        }
+
+    def _payload(self, text):
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "system": self.system_prompt,
+            "messages": [
+                {"role": "user", "content": self.prompt_template.format(testo_blocco=text)}
+            ]
+        }
+
+    def _parse(self, data):
+        usage = data.get('usage', {})
+        return (
+            data['content'][0]['text'],
+            usage.get('input_tokens', 0),
+            usage.get('output_tokens', 0),
+        )
+
+
+class OpenAIBackend(ProviderBackend):
+    """GPT via Responses API."""
+
+    name = "openai"
+    url = "https://api.openai.com/v1/responses"
+
+    def __init__(self, api_key: str, model: str, system_prompt: str, prompt_template: str, **kwargs):
+        kwargs.setdefault('max_tokens', 100)
+        super().__init__(model, system_prompt, prompt_template, OPENAI_PRICES, **kwargs)
+        self.headers = {
+            "authorization": f"Bearer {api_key}",
+        }
+
+    def _payload(self, text):
+        return {
+            "model": self.model,
+            "instructions": self.system_prompt,
+            "input": self.prompt_template.format(testo_blocco=text),
+            "max_output_tokens": self.max_tokens,
+        }
+
+    def _parse(self, data):
+        testo = "".join(
+            blocco.get('text', '')
+            for item in data.get('output', [])
+            if item.get('type') == 'message'
+            for blocco in item.get('content', [])
+            if blocco.get('type') == 'output_text'
+        )
+        usage = data.get('usage', {})
+        return testo, usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+
+
+class SimulatedBackend(ProviderBackend):
+    """
+    Backend fittizio per benchmark offline: nessuna chiamata HTTP.
+
+    La latenza cresce linearmente con i token stimati del prompt (come il
+    prefill di un modello reale) con rumore log-normale; la risposta è
+    sempre 'NO' e il costo è nullo.
+    """
+
+    name = "simulated"
+
+    def __init__(self, model: str, system_prompt: str, prompt_template: str,
+                 base_latency: float = 0.3, latency_per_token: float = 0.002,
+                 jitter: float = 0.1, seed: int = 0, **kwargs):
+        super().__init__(model, system_prompt, prompt_template, (0.0, 0.0), **kwargs)
+        self.base_latency = base_latency
+        self.latency_per_token = latency_per_token
+        self.jitter = jitter
+        self.seed = seed
+
+    def expected_latency(self, text: str) -> float:
+        """Latenza media simulata per un chunk (senza rumore)."""
+        prompt = self.prompt_template.format(testo_blocco=text)
+        tokens = (len(self.system_prompt) + len(prompt)) // CHARS_PER_TOKEN
+        return self.base_latency + self.latency_per_token * tokens
+
+    def simulated_latency(self, text: str) -> float:
+        """
+        Latenza simulata con rumore deterministico per chunk: a parità di seed
+        lo stesso testo ha sempre la stessa latenza, qualunque sia l'ordine di invio.
+        """
+        rng = random.Random(zlib.crc32(text.encode('utf-8')) ^ self.seed)
+        return self.expected_latency(text) * rng.lognormvariate(0.0, self.jitter)
+
+    async def _request(self, transport, text):
+        await asyncio.sleep(self.simulated_latency(text))
+        return 200, {"content": [{"text": "NO"}], "usage": {}}, {}
+
+    def _parse(self, data):
+        return data['content'][0]['text'], 0, 0
+
+
+BACKENDS = {
+    AnthropicBackend.name: AnthropicBackend,
+    OpenAIBackend.name: OpenAIBackend,
+    SimulatedBackend.name: SimulatedBackend,
+}
+
+
+def create_backend(name: str, config: dict, system_prompt: str, prompt_template: str,
+                   logger: Optional[logging.Logger] = None) -> ProviderBackend:
+    """Costruisce un backend dal nome e dalle chiavi del config.json."""
+    if name not in BACKENDS:
+        raise ValueError(f"Provider sconosciuto: {name} (disponibili: {', '.join(BACKENDS)})")
+    if name == 'simulated':
+        return SimulatedBackend(
+            model="simulated",
+            system_prompt=system_prompt,
+            prompt_template=prompt_template,
+            base_latency=config.get('simulated_base_latency', 0.3),
+            latency_per_token=config.get('simulated_latency_per_token', 0.002),
+            logger=logger,
+        )
+    if name == 'anthropic':
+        api_key, model = config['anthropic_api_key'], config['model']
+    else:
+        api_key, model = config['openai_api_key'], config['openai_model']
+    return BACKENDS[name](
+        api_key=api_key,
+        model=model,
+        system_prompt=system_prompt,
+        prompt_template=prompt_template,
+        max_retries=config.get('max_retries', 3),
+        retry_delay=config.get('retry_delay', 2),
+        logger=logger,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Dispatcher con richieste hedged
+# ---------------------------------------------------------------------------
+
+@dataclass
+class HedgeStats:
+    """Statistiche del dispatcher: chi ha risposto e quanto è costato l'hedging."""
+    requests: int = 0
+    hedged: int = 0
+    failovers: int = 0
+    wins: Dict[str, int] = field(default_factory=dict)
+    extra_cost: float = 0.0
+
+    def record_win(self, backend: str):
+        self.wins[backend] = self.wins.get(backend, 0) + 1
+
+
+class HedgedDispatcher:
+    """Invia al primario; oltre il suo p95 duplica sul secondario e vince il primo."""
+
+    def __init__(
+        self,
+        primary: ProviderBackend,
+        secondary: Optional[ProviderBackend] = None,
+        hedge_quantile: float = 0.95,
+        min_samples: int = 20,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.primary = primary
+        self.secondary = secondary
+        self.hedge_quantile = hedge_quantile
+        self.min_samples = min_samples
+        self.stats = HedgeStats()
+        self.logger = logger or logging.getLogger(__name__)
+
+    async def annotate(self, transport: HTTPTransport, text: str) -> ProviderResult:
+        self.stats.requests += 1
+        primary_task = asyncio.create_task(self.primary.annotate(transport, text))
+
+        if self.secondary is None:
+            return self._finish(await primary_task)
+
+        delay = self.primary.latency_quantile(self.hedge_quantile, self.min_samples)
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done:
+            result = primary_task.result()
+            if result.label is not None:
+                return self._finish(result)
+            # Primario fallito dopo tutti i retry: failover sul secondario
+            self.stats.failovers += 1
+            return self._finish(await self.secondary.annotate(transport, text))
+
+        # Il primario ha superato il p95: richiesta duplicata sul secondario
+        self.stats.hedged += 1
+        hedge_task = asyncio.create_task(self.secondary.annotate(transport, text))
+        tasks = {primary_task: self.primary, hedge_task: self.secondary}
+        pending = set(tasks)
+        winner = None
+        completed = []
+
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                completed.append(result)
+                if result.label is not None and winner is None:
+                    winner = result
+
+        for task in pending:
+            task.cancel()
+            # Richiesta annullata: si contabilizza almeno il costo dell'input
+            self.stats.extra_cost += tasks[task].estimated_cost(text)
+        for result in completed:
+            if result is not winner:
+                self.stats.extra_cost += result.cost
+
+        if winner is None:
+            # Entrambi falliti: si restituisce l'ultimo esito (label None)
+            winner = completed[-1]
+        winner.hedged = True
+        return self._finish(winner)
+
+    def _finish(self, result: ProviderResult) -> ProviderResult:
+        if result.label is not None:
+            self.stats.record_win(result.backend)
+        return result
+
+    def summary(self) -> str:
+        wins = ", ".join(f"{nome}={n}" for nome, n in sorted(self.stats.wins.items())) or "-"
+        return (
+            f"Richieste: {self.stats.requests} | Hedged: {self.stats.hedged} | "
+            f"Failover: {self.stats.failovers} | Risposte per backend: {wins} | "
+            f"Costo extra hedging: ${self.stats.extra_cost:.4f}"
+        )
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Log dei ragionamenti in JSON Lines scritto in streaming.
+
+Ogni entry viene scritta su disco appena prodotta, invece di accumulare
+l'intero log in memoria fino alla fine del run: la memoria resta costante
+qualunque sia la dimensione del corpus e un crash perde al più il blocco
+in corso.
+
+Struttura su disco (percorso base DIL_API_reasoning_log.jsonl):
+  - segmenti: DIL_API_reasoning_log.jsonl, DIL_API_reasoning_log.1.jsonl, ...
+    con estensione .gz o .zst se compressi; si passa al segmento successivo
+    quando quello corrente supera max_bytes (0 = nessuna rotazione)
+  - indice: DIL_API_reasoning_log.jsonl.idx, una riga TSV per entry
+    (index, segmento, offset del blocco, offset nel blocco, lunghezza)
+
+Con la compressione le entry vengono raggruppate in blocchi di
+block_entries righe, ciascuno compresso come membro gzip (o frame zstd)
+indipendente: il file resta leggibile per intero con gzip/zstd, e la
+ricerca di una riga tramite l'indice decomprime un solo blocco. Senza
+compressione ogni entry è scritta subito ed è un blocco a sé.
+
+Uso da riga di comando:
+    python dil_reasoning_log.py --lookup DIL_API_reasoning_log.jsonl 42 137
+    python dil_reasoning_log.py --convert DIL_annotation_reasoning_log.jsonl --compression gzip --max-mb 64
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dil_transport import json_dumps, json_loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_EXT = {None: "", "gzip": ".gz", "zstd": ".zst"}
+INDEX_SUFFIX = ".idx"
+
+
+def segment_path(base: str, number: int, compression: Optional[str] = None) -> str:
+    """Percorso del segmento `number` (0 = percorso base)."""
+    path = Path(base)
+    if number > 0:
+        path = path.with_name(f"{path.stem}.{number}{path.suffix}")
+    return str(path) + COMPRESSION_EXT[compression]
+
+
+def log_segments(base: str) -> List[Tuple[int, str, Optional[str]]]:
+    """
+    Segmenti esistenti del log, in ordine: (numero, percorso, compressione).
+    """
+    path = Path(base)
+    pattern = re.compile(
+        rf"^{re.escape(path.stem)}(?:\.(\d+))?{re.escape(path.suffix)}(\.gz|\.zst)?$"
+    )
+    ext_to_compression = {v: k for k, v in COMPRESSION_EXT.items()}
+    segments = []
+    if not path.parent.exists():
+        return segments
+    for candidate in path.parent.iterdir():
+        match = pattern.match(candidate.name)
+        if match:
+            number = int(match.group(1) or 0)
+            segments.append((number, str(candidate), ext_to_compression[match.group(2) or ""]))
+    return sorted(segments)
+
+
+def _check_compression(compression: Optional[str]):
+    if compression not in COMPRESSION_EXT:
+        raise ValueError(f"Compressione non supportata: {compression!r} (None, 'gzip', 'zstd')")
+    if compression == "zstd" and zstandard is None:
+        raise RuntimeError("La compressione zstd richiede zstandard: pip install zstandard")
+
+
+def _compress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def _loads_entry(line: bytes) -> dict:
+    # I log storici scritti con json.dumps possono contenere NaN, che
+    # orjson rifiuta: in quel caso si ricade sul parser della stdlib
+    try:
+        return json_loads(line)
+    except ValueError:
+        return json.loads(line)
+
+
+class ReasoningLogWriter:
+    """
+    Scrittore in streaming del log dei ragionamenti, da usare come context
+    manager:
+
+        with ReasoningLogWriter(path, compression="gzip", max_bytes=64 << 20) as log:
+            log.write(entry)
+
+    Con append=True prosegue un log esistente (ripresa di un run); altrimenti
+    cancella segmenti e indice precedenti.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compression: Optional[str] = None,
+        max_bytes: int = 0,
+        block_entries: int = 256,
+        append: bool = False,
+    ):
+        _check_compression(compression)
+        self.path = path
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.block_entries = max(1, block_entries) if compression else 1
+        self.entries_written = 0
+        self._block: List[bytes] = []
+        self._block_indices: List[int] = []
+
+        existing = log_segments(path)
+        if not append:
+            for _, segment, _ in existing:
+                os.remove(segment)
+            if Path(path + INDEX_SUFFIX).exists():
+                os.remove(path + INDEX_SUFFIX)
+            existing = []
+        elif existing and existing[-1][2] != compression:
+            # Non si mescolano formati nello stesso segmento: la ripresa
+            # prosegue in un segmento nuovo
+            existing.append((existing[-1][0] + 1, None, compression))
+
+        self._segment = existing[-1][0] if existing else 0
+        self._file = open(segment_path(path, self._segment, compression), "ab")
+        self._index = open(path + INDEX_SUFFIX, "a", encoding="utf-8", newline="")
+
+    def __enter__(self) -> "ReasoningLogWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, entry: dict):
+        """Aggiunge un'entry (deve contenere la chiave 'index')."""
+        self._block.append(json_dumps(entry) + b"\n")
+        self._block_indices.append(entry.get("index", -1))
+        self.entries_written += 1
+        if len(self._block) >= self.block_entries:
+            self.flush()
+
+    def flush(self):
+        """Chiude il blocco corrente e lo porta su disco, insieme all'indice."""
+        if self._block:
+            data = b"".join(self._block)
+            block_offset = self._file.tell()
+            self._file.write(_compress(data, self.compression))
+
+            entry_offset = 0
+            righe = []
+            for idx, line in zip(self._block_indices, self._block):
+                righe.append(f"{idx}\t{self._segment}\t{block_offset}\t{entry_offset}\t{len(line)}\n")
+                entry_offset += len(line)
+            self._index.write("".join(righe))
+            self._block, self._block_indices = [], []
+
+        self._file.flush()
+        self._index.flush()
+
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._file.close()
+            self._segment += 1
+            self._file = open(segment_path(self.path, self._segment, self.compression), "ab")
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        self._index.close()
+
+
+def open_log_segment(path: str, compression: Optional[str]) -> io.BufferedIOBase:
+    """Apre un segmento in lettura come stream binario decompresso."""
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "zstd":
+        _check_compression(compression)
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.BufferedReader(reader)
+    return open(path, "rb")
+
+
+def iter_log_entries(path: str) -> Iterator[dict]:
+    """Tutte le entry del log, segmento per segmento, nell'ordine di scrittura."""
+    for _, segment, compression in log_segments(path):
+        with open_log_segment(segment, compression) as f:
+            for line in f:
+                if line.strip():
+                    yield _loads_entry(line)
+
+
+def iter_log_frames(path: str, chunksize: int = 50_000):
+    """
+    DataFrame pandas a blocchi di `chunksize` entry su tutti i segmenti,
+    per join vettoriali senza caricare l'intero log.
+    """
+    import pandas as pd
+
+    for _, segment, compression in log_segments(path):
+        if os.path.getsize(segment) == 0:
+            continue
+        with open_log_segment(segment, compression) as f:
+            testo = io.TextIOWrapper(f, encoding="utf-8")
+            yield from pd.read_json(testo, lines=True, chunksize=chunksize, dtype=False)
+
+
+class ReasoningLogIndex:
+    """Ricerca delle entry per indice di riga tramite il file .idx."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._compression = {number: compression for number, _, compression in log_segments(path)}
+        self._positions: Dict[int, Tuple[int, int, int, int]] = {}
+        with open(path + INDEX_SUFFIX, "r", encoding="utf-8", newline="") as f:
+            for idx, segment, block_offset, entry_offset, length in csv.reader(f, delimiter="\t"):
+                # In caso di entry ripetute per la stessa riga vale l'ultima
+                self._positions[int(idx)] = (int(segment), int(block_offset), int(entry_offset), int(length))
+
+    def __contains__(self, idx: int) -> bool:
+        return idx in self._positions
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def get(self, idx: int) -> Optional[dict]:
+        """Entry della riga `idx`, o None se assente."""
+        if idx not in self._positions:
+            return None
+        segment, block_offset, entry_offset, length = self._positions[idx]
+        compression = self._compression[segment]
+        with open(segment_path(self.path, segment, compression), "rb") as f:
+            f.seek(block_offset)
+            if compression is None:
+                return _loads_entry(f.read(length))
+            # Legge fino a fine blocco: il decompressore si ferma da solo a
+            # fine membro/frame, quindi basta leggere a pezzi finché serve
+            decompressor = (zlib.decompressobj(wbits=31) if compression == "gzip"
+                            else zstandard.ZstdDecompressor().decompressobj())
+            data = b""
+            while len(data) < entry_offset + length:
+                raw = f.read(1 << 16)
+                if not raw:
+                    break
+                data += decompressor.decompress(raw)
+            return _loads_entry(data[entry_offset:entry_offset + length])
+
+
+def convert_log(source: str, dest: str, compression: Optional[str], max_bytes: int, block_entries: int) -> int:
+    """Riscrive un log esistente (anche monolitico) nel formato a segmenti indicizzato."""
+    with ReasoningLogWriter(dest, compression, max_bytes, block_entries) as writer:
+        for entry in iter_log_entries(source):
+            writer.write(entry)
+    return writer.entries_written
+
+
+def main():
+    """Entry point: ricerca per indice o conversione di un log."""
+    parser = argparse.ArgumentParser(description="Log dei ragionamenti DIL (JSONL in streaming)")
+    parser.add_argument("--lookup", nargs="+", metavar=("LOG", "INDEX"),
+                        help="Stampa le entry delle righe indicate")
+    parser.add_argument("--convert", metavar="LOG", help="Log JSONL da convertire")
+    parser.add_argument("--output", default=None, help="Percorso base del log convertito")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None)
+    parser.add_argument("--max-mb", type=float, default=0, help="Dimensione massima di un segmento (MB)")
+    parser.add_argument("--block-entries", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.lookup:
+        path, indices = args.lookup[0], args.lookup[1:]
+        index = ReasoningLogIndex(path)
+        for idx in indices:
+            entry = index.get(int(idx))
+            print(json_dumps(entry).decode("utf-8") if entry else f"{idx}: non presente")
+    elif args.convert:
+        output = args.output or str(Path(args.convert).with_name(Path(args.convert).stem + "_indexed.jsonl"))
+        n = convert_log(args.convert, output, args.compression, int(args.max_mb * (1 << 20)), args.block_entries)
+        segments = log_segments(output)
+        size = sum(os.path.getsize(s) for _, s, _ in segments)
+        print(f"{n} entry scritte in {len(segments)} segmenti ({size / 1024:.0f} KB) + indice '{output}{INDEX_SUFFIX}'")
+    else:
+        parser.error("indicare --lookup o --convert")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Risultati delle annotazioni in un file JSON Lines append-only.
+
+Gli script di annotazione salvavano l'intero CSV di output ogni
+batch_size righe: il volume scritto cresce col quadrato del corpus e la
+ripresa richiede di rileggere e parsare tutto il CSV. Con il sidecar ogni
+etichetta è una riga JSONL aggiunta in coda ({"index": 12, "label": "yes"}),
+la ripresa è un dizionario indice -> etichetta costruito leggendo solo il
+sidecar, e il CSV completo viene scritto una sola volta a fine run.
+
+Il file è scritto con flush a ogni riga e fsync ogni sync_every righe; una
+riga troncata da un'interruzione viene ignorata in lettura. Se per la
+stessa riga compaiono più etichette vale l'ultima.
+"""
+
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+from dil_transport import json_dumps, json_loads
+
+
+def results_path(output_file: str, column: str) -> str:
+    """Percorso del sidecar per la colonna `column` di output_file."""
+    return str(Path(output_file).with_suffix("")) + f"_{column}.results.jsonl"
+
+
+class ResultsSidecar:
+    """
+    Sidecar append-only delle etichette di una colonna, da usare come
+    context manager per la scrittura:
+
+        sidecar = ResultsSidecar(results_path(output_file, column), sync_every=50)
+        results = sidecar.resume(output_file, column) if resume else sidecar.reset()
+        with sidecar:
+            sidecar.write(idx, "yes")
+    """
+
+    def __init__(self, path: str, sync_every: int = 0):
+        self.path = path
+        self.sync_every = sync_every
+        self.written = 0
+        self._file = None
+
+    def load(self) -> Dict[int, str]:
+        """Etichette presenti nel sidecar (indice di riga -> etichetta)."""
+        results: Dict[int, str] = {}
+        if not Path(self.path).exists():
+            return results
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    continue  # riga troncata da un'interruzione
+                results[entry["index"]] = entry["label"]
+        return results
+
+    def resume(self, output_file: Optional[str] = None, column: Optional[str] = None) -> Dict[int, str]:
+        """
+        Etichette già prodotte da run precedenti.
+
+        Se il sidecar non esiste ma esiste un CSV di output scritto dalle
+        versioni precedenti degli script, ne legge la sola colonna `column`
+        e la riversa nel sidecar: la conversione avviene una volta sola.
+        """
+        if Path(self.path).exists() or not output_file or not Path(output_file).exists():
+            return self.load()
+
+        import pandas as pd
+
+        existing = pd.read_csv(output_file, encoding="utf-8", usecols=lambda c: c == column)
+        if column not in existing.columns:
+            return {}
+        labels = existing[column].dropna().astype(str).str.strip()
+        results = {int(idx): label for idx, label in labels[labels != ""].items()}
+        with self:
+            for idx, label in results.items():
+                self.write(idx, label)
+        return results
+
+    def reset(self) -> Dict[int, str]:
+        """Svuota il sidecar (nuovo run)."""
+        open(self.path, "wb").close()
+        return {}
+
+    def __enter__(self) -> "ResultsSidecar":
+        self._file = open(self.path, "ab")
+        # Un'interruzione può lasciare l'ultima riga senza newline: la nuova
+        # riga non deve esserle accodata
+        if self._file.tell() > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write(b"\n")
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, idx: int, label: str):
+        """Aggiunge l'etichetta della riga `idx`."""
+        self._file.write(json_dumps({"index": int(idx), "label": label}) + b"\n")
+        self._file.flush()
+        self.written += 1
+        if self.sync_every and self.written % self.sync_every == 0:
+            os.fsync(self._file.fileno())
+
+    def sync(self):
+        """Porta su disco (fsync) le righe scritte finora."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is None or self._file.closed:
+            return
+        self.sync()
+        self._file.close()
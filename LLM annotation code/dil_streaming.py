@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Metriche progressive durante l'annotazione.
+
+Gli script calcolavano accuracy, F1 e kappa solo a fine run: su un run
+lungo o costoso un prompt che funziona male si scopriva dopo averlo pagato
+per intero. StreamingMetrics accumula la matrice di confusione rispetto al
+gold (tp, tn, fp, fn) riga per riga, man mano che le annotazioni arrivano,
+e in qualunque momento restituisce le metriche correnti con intervalli di
+confidenza.
+
+Gli intervalli sono percentili di un bootstrap sui quattro conteggi: dato
+che le righe sono indipendenti, ricampionare le righe equivale a estrarre
+i conteggi da una multinomiale con le frequenze osservate (lo stesso
+principio di dil_bootstrap.py), quindi il costo non dipende dal numero di
+righe annotate. Il risultato viene ricalcolato solo se i conteggi sono
+cambiati.
+
+Regola di arresto anticipato: con should_stop(target) il run può essere
+interrotto quando, dopo almeno min_rows righe valutabili, anche l'estremo
+superiore dell'intervallo della kappa è sotto il target, cioè quando la
+kappa è chiaramente insufficiente e non solo rumorosa.
+
+Uso tipico:
+
+    stream = StreamingMetrics()
+    for idx, label in annotazioni:
+        stream.update(df.at[idx, "DIL"], label)
+        progress.set_postfix_str(stream.summary())
+        if stream.should_stop(0.4, min_rows=100):
+            break
+
+Uso da riga di comando (simulazione su un CSV già annotato):
+    python dil_streaming.py corpus_labelled-trigrams_500_DUAL_annotated.csv --column DIL_Sonnet --target 0.8
+"""
+
+import argparse
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from dil_metrics import COUNT_KEYS, LABEL_CODES, encode_labels, metrics_from_counts
+
+# Metriche riportate nell'avanzamento, con l'etichetta breve
+REPORTED_METRICS = {"accuracy": "acc", "f1_score": "F1", "kappa": "κ"}
+
+# Cella di COUNT_KEYS per (riferimento, predizione): tp, tn, fp, fn
+_CELL = {(1, 1): 0, (0, 0): 1, (0, 1): 2, (1, 0): 3}
+
+
+def _code(value) -> int:
+    """Codice di una singola etichetta: 1 = yes, 0 = no, -1 altrimenti."""
+    if value is None:
+        return -1
+    return LABEL_CODES.get(str(value).strip().lower(), -1)
+
+
+@dataclass
+class StreamingMetrics:
+    """Matrice di confusione aggiornata riga per riga, con intervalli bootstrap."""
+    resamples: int = 2000
+    confidence: float = 0.95
+    seed: int = 0
+    counts: np.ndarray = field(default_factory=lambda: np.zeros(len(COUNT_KEYS), dtype=np.int64))
+    skipped: int = 0
+    _cache: Optional[Tuple[tuple, Dict[str, Tuple[float, float]]]] = field(default=None, repr=False)
+
+    @property
+    def n(self) -> int:
+        """Righe valutabili (gold e predizione entrambi yes/no)."""
+        return int(self.counts.sum())
+
+    def update(self, reference, prediction) -> bool:
+        """Aggiunge una riga; False se una delle due etichette non è yes/no."""
+        cell = _CELL.get((_code(reference), _code(prediction)))
+        if cell is None:
+            self.skipped += 1
+            return False
+        self.counts[cell] += 1
+        return True
+
+    def update_many(self, reference, predictions):
+        """Aggiunge più righe in una volta (es. quelle già annotate alla ripresa)."""
+        ref = encode_labels(reference)
+        pred = encode_labels(predictions)
+        valid = (ref >= 0) & (pred >= 0)
+        # Indice di cella come in _CELL: tp=0, tn=1, fp=2, fn=3
+        cells = np.where(ref == pred, 1 - ref, 2 + ref)[valid]
+        self.counts += np.bincount(cells, minlength=len(COUNT_KEYS))
+        self.skipped += int((~valid).sum())
+
+    def metrics(self) -> Dict[str, float]:
+        """Metriche correnti come scalari Python (stesse chiavi di metrics_from_counts)."""
+        return {key: value.item() for key, value in metrics_from_counts(*self.counts).items()}
+
+    def intervals(self) -> Dict[str, Tuple[float, float]]:
+        """Intervalli di confidenza bootstrap di accuracy, F1 e kappa."""
+        key = tuple(self.counts)
+        if self._cache is not None and self._cache[0] == key:
+            return self._cache[1]
+        n = self.n
+        if n == 0:
+            result = {metric: (float("nan"), float("nan")) for metric in REPORTED_METRICS}
+        else:
+            rng = np.random.default_rng(self.seed)
+            draws = rng.multinomial(n, self.counts / n, size=self.resamples)
+            sampled = metrics_from_counts(*draws.T)
+            alpha = (1.0 - self.confidence) / 2.0
+            result = {
+                metric: tuple(np.quantile(sampled[metric], [alpha, 1.0 - alpha]).tolist())
+                for metric in REPORTED_METRICS
+            }
+        self._cache = (key, result)
+        return result
+
+    def should_stop(self, target: Optional[float], min_rows: int = 100, metric: str = "kappa") -> bool:
+        """
+        True se, con almeno min_rows righe valutabili, l'estremo superiore
+        dell'intervallo di `metric` è sotto `target` (None: mai).
+        """
+        if target is None or self.n < max(1, min_rows):
+            return False
+        return self.intervals()[metric][1] < target
+
+    def summary(self) -> str:
+        """Riga compatta per l'avanzamento: n, accuracy, F1 e kappa con intervalli."""
+        if self.n == 0:
+            return "n=0"
+        values, bounds = self.metrics(), self.intervals()
+        parts = [f"n={self.n}"]
+        for metric, label in REPORTED_METRICS.items():
+            low, high = bounds[metric]
+            parts.append(f"{label} {values[metric]:.3f} [{low:.2f}, {high:.2f}]")
+        return " | ".join(parts)
+
+
+# ---------------------------------------------------------------------------
+# Simulazione
+# ---------------------------------------------------------------------------
+
+def replay(df: pd.DataFrame, reference: str, column: str, target: Optional[float], min_rows: int,
+           report_every: int, seed: int):
+    """Riproduce un run in ordine casuale e indica dove l'arresto anticipato avrebbe interrotto."""
+    order = np.random.default_rng(seed).permutation(len(df))
+    refs = df[reference].to_numpy()[order]
+    preds = df[column].to_numpy()[order]
+    stream = StreamingMetrics(seed=seed)
+    start = time.perf_counter()
+    stopped = None
+    for i, (ref, pred) in enumerate(zip(refs, preds), 1):
+        stream.update(ref, pred)
+        if i % report_every == 0:
+            print(f"[{i}/{len(df)}] {stream.summary()}")
+        if stream.should_stop(target, min_rows):
+            stopped = i
+            print(f"[{i}/{len(df)}] {stream.summary()}")
+            print(f"→ Arresto anticipato dopo {i} righe: intervallo al {stream.confidence:.0%} della kappa "
+                  f"interamente sotto {target}")
+            break
+    elapsed = time.perf_counter() - start
+
+    final = StreamingMetrics()
+    final.update_many(df[reference], df[column])
+    print(f"\nFinale su tutte le righe: {final.summary()}")
+    print(f"Tempo per aggiornamento (con verifica dell'arresto): {elapsed / (stopped or len(df)) * 1e6:.0f} µs")
+
+
+def main():
+    """Entry point: simulazione delle metriche progressive su un CSV annotato."""
+    parser = argparse.ArgumentParser(description="Metriche progressive DIL con arresto anticipato")
+    parser.add_argument("input_file", help="CSV con la colonna gold e quella dell'annotatore")
+    parser.add_argument("--reference", default="DIL", help="Colonna di riferimento (default: DIL)")
+    parser.add_argument("--column", required=True, help="Colonna dell'annotatore da simulare")
+    parser.add_argument("--target", type=float, default=None, help="Kappa minima accettabile (arresto anticipato)")
+    parser.add_argument("--min-rows", type=int, default=100, help="Righe minime prima dell'arresto")
+    parser.add_argument("--report-every", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input_file, encoding="utf-8")
+    replay(df, args.reference, args.column, args.target, args.min_rows, args.report_every, args.seed)
+
+
+if __name__ == "__main__":
+    main()
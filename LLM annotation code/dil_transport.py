@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""
+Trasporto HTTP condiviso da tutti gli annotatori DIL.
+
+Centralizza in un solo punto:
+  - pool di connessioni keep-alive con limiti espliciti e cache DNS
+  - HTTP/2 opzionale (multiplexing di più richieste sulla stessa connessione)
+  - codec JSON veloce (orjson se installato, altrimenti json della stdlib)
+  - metriche per richiesta: tempo di apertura connessione, risoluzione DNS,
+    connessioni riutilizzate, tempo di serializzazione/deserializzazione
+  (codec veloce e tempi di serializzazione valgono solo per HTTPTransport:
+  con i client per gli SDK il corpo delle richieste lo serializza l'SDK e
+  le metriche coprono solo connessioni e DNS)
+  - budget di richieste al minuto condiviso (RateLimiter) tra più client,
+    thread ed event loop, con pausa globale sulle risposte 429
+  - attesa dei ritentativi con backoff esponenziale e jitter (jittered_backoff)
+
+Client disponibili:
+  - HTTPTransport: client asincrono (aiohttp, oppure httpx se http2=True)
+    usato da annotate_dil.py, dil_providers.py e dagli script di test
+  - create_httpx_client / create_async_httpx_client: client httpx sincrono
+    e asincrono da passare agli SDK ufficiali (OpenAI, Anthropic) tramite
+    `http_client=`
+  - create_requests_session: sessione requests per gli script basati
+    sull'SDK OpenAI legacy (< 1.0)
+"""
+
+import asyncio
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# ---------------------------------------------------------------------------
+# Codec JSON
+# ---------------------------------------------------------------------------
+
+def json_dumps(obj) -> bytes:
+    """Serializza in JSON UTF-8 (bytes)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_loads(data: Union[bytes, str]):
+    """Deserializza JSON da bytes o stringa."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# ---------------------------------------------------------------------------
+# Metriche di trasporto
+# ---------------------------------------------------------------------------
+
+@dataclass
+class TransportMetrics:
+    """Tempi di connessione e serializzazione accumulati su tutte le richieste."""
+    requests: int = 0
+    connections_created: int = 0
+    connections_reused: int = 0
+    connect_time: float = 0.0
+    dns_time: float = 0.0
+    serialize_time: float = 0.0
+    deserialize_time: float = 0.0
+
+    def summary(self) -> str:
+        n = self.requests or 1
+        summary = (
+            f"Richieste HTTP: {self.requests} | "
+            f"Connessioni nuove: {self.connections_created}, riusate: {self.connections_reused} | "
+            f"Setup connessione: {self.connect_time / n * 1000:.2f} ms/req "
+            f"(DNS {self.dns_time / n * 1000:.2f} ms/req)"
+        )
+        # Misurata solo da HTTPTransport: con gli SDK resterebbe a zero
+        serialize = self.serialize_time + self.deserialize_time
+        if serialize:
+            summary += f" | Serializzazione: {serialize / n * 1000:.3f} ms/req"
+        return summary
+
+    # Callback di tracing httpcore (usato da httpx, sync e async)
+    def _httpcore_event(self, event_name: str, starts: dict):
+        now = time.perf_counter()
+        if event_name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            starts[event_name.rsplit('.', 1)[0]] = now
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            inizio = starts.pop(event_name.rsplit('.', 1)[0], None)
+            if inizio is not None:
+                self.connect_time += now - inizio
+            if event_name == "connection.connect_tcp.complete":
+                self.connections_created += 1
+
+    def httpcore_trace(self):
+        """Callback sincrona da passare in `extensions={'trace': ...}`."""
+        starts = {}
+
+        def trace(event_name, info):
+            self._httpcore_event(event_name, starts)
+        return trace
+
+    def httpcore_trace_async(self):
+        """Variante asincrona della callback di tracing httpcore."""
+        starts = {}
+
+        async def trace(event_name, info):
+            self._httpcore_event(event_name, starts)
+        return trace
+
+
+# ---------------------------------------------------------------------------
+# Budget di richieste condiviso
+# ---------------------------------------------------------------------------
+
+class RateLimiter:
+    """
+    Budget di richieste al minuto condiviso da tutti i client che lo
+    ricevono, anche se girano in thread ed event loop diversi (es. le
+    configurazioni di uno sweep eseguite in parallelo).
+
+    Ogni richiesta prenota il primo slot libero, a distanza di almeno
+    60 / requests_per_minute secondi dal precedente (0 = nessun limite);
+    una risposta 429 sposta in avanti il prossimo slot di tutti i client
+    fino allo scadere di retry-after.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, default_pause: float = 5.0):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.default_pause = default_pause
+        self.waited = 0.0
+        self.pauses = 0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Prenota uno slot e restituisce i secondi di attesa."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+            self.waited += slot - now
+            return slot - now
+
+    def acquire(self):
+        """Attende il proprio slot (client sincroni)."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Attende il proprio slot senza bloccare l'event loop."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def observe(self, status: int, headers):
+        """Registra l'esito di una richiesta: un 429 sospende tutti i client."""
+        if status != 429:
+            return
+        try:
+            pause = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pause = self.default_pause
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic() + pause)
+            self.pauses += 1
+
+    def summary(self) -> str:
+        return f"Attesa per il budget di richieste: {self.waited:.1f}s | Pause per 429: {self.pauses}"
+
+
+def jittered_backoff(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Secondi di attesa prima di ritentare dopo il tentativo `attempt` (da 0):
+    backoff esponenziale limitato a `cap`, di cui metà fissa e metà casuale,
+    così i worker che falliscono insieme non ritentano nello stesso istante.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _aiohttp_trace_config(metrics: TransportMetrics):
+    """TraceConfig aiohttp che alimenta TransportMetrics."""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connect_start = time.perf_counter()
+
+    async def on_connection_create_end(session, ctx, params):
+        metrics.connections_created += 1
+        metrics.connect_time += time.perf_counter() - ctx.connect_start
+
+    async def on_connection_reuseconn(session, ctx, params):
+        metrics.connections_reused += 1
+
+    async def on_dns_resolvehost_start(session, ctx, params):
+        ctx.dns_start = time.perf_counter()
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        metrics.dns_time += time.perf_counter() - ctx.dns_start
+
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    return trace_config
+
+
+# ---------------------------------------------------------------------------
+# Client asincrono
+# ---------------------------------------------------------------------------
+
+class HTTPTransport:
+    """
+    Client HTTP asincrono condiviso, da usare come context manager:
+
+        async with HTTPTransport.from_config(config) as transport:
+            status, data, headers = await transport.post_json(url, headers, payload)
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 10,
+        keepalive_timeout: float = 60,
+        dns_cache_ttl: int = 300,
+        timeout: float = 60,
+        http2: bool = False,
+    ):
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self.http2 = http2
+        self.metrics = TransportMetrics()
+        self._session = None
+        self._client = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "HTTPTransport":
+        """Costruisce il trasporto dalle chiavi del config.json."""
+        return cls(
+            max_connections=config.get('max_concurrent_requests', 10),
+            keepalive_timeout=config.get('keepalive_timeout', 60),
+            dns_cache_ttl=config.get('dns_cache_ttl', 300),
+            timeout=config.get('request_timeout', 60),
+            http2=config.get('http2', False),
+        )
+
+    async def __aenter__(self) -> "HTTPTransport":
+        if self.http2:
+            if httpx is None:
+                raise RuntimeError("HTTP/2 richiede httpx: pip install 'httpx[http2]'")
+            # httpx risolve il DNS tramite il sistema; il multiplexing HTTP/2
+            # riduce comunque le connessioni a una per host
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_timeout,
+                ),
+            )
+        else:
+            if aiohttp is None:
+                raise RuntimeError("aiohttp non installato: pip install aiohttp")
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[_aiohttp_trace_config(self.metrics)],
+            )
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._session is not None:
+            await self._session.close()
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def post_json(self, url: str, headers: dict, payload: dict) -> Tuple[int, Union[dict, str], dict]:
+        """
+        POST di un payload JSON.
+
+        Returns
+        -------
+        (status, data, headers): data è il JSON decodificato se status == 200,
+        altrimenti il corpo della risposta come testo.
+        """
+        self.metrics.requests += 1
+        start = time.perf_counter()
+        body = json_dumps(payload)
+        self.metrics.serialize_time += time.perf_counter() - start
+
+        headers = {**headers, "content-type": "application/json"}
+
+        if self._client is not None:
+            resp = await self._client.post(
+                url, content=body, headers=headers,
+                extensions={"trace": self.metrics.httpcore_trace_async()},
+            )
+            status, raw, resp_headers = resp.status_code, resp.content, resp.headers
+        else:
+            async with self._session.post(url, data=body, headers=headers) as resp:
+                status, raw, resp_headers = resp.status, await resp.read(), resp.headers
+
+        if status != 200:
+            return status, raw.decode('utf-8', errors='replace'), resp_headers
+
+        start = time.perf_counter()
+        data = json_loads(raw)
+        self.metrics.deserialize_time += time.perf_counter() - start
+        return status, data, resp_headers
+
+
+# ---------------------------------------------------------------------------
+# Client sincroni per gli SDK
+# ---------------------------------------------------------------------------
+
+if httpx is not None:
+    class _TracingTransport(httpx.HTTPTransport):
+        """Trasporto httpx che aggiunge il tracing delle connessioni a ogni richiesta."""
+
+        def __init__(self, metrics: TransportMetrics, rate_limiter: Optional[RateLimiter] = None, **kwargs):
+            super().__init__(**kwargs)
+            self.metrics = metrics
+            self.rate_limiter = rate_limiter
+
+        def handle_request(self, request):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            self.metrics.requests += 1
+            request.extensions["trace"] = self.metrics.httpcore_trace()
+            response = super().handle_request(request)
+            if self.rate_limiter is not None:
+                self.rate_limiter.observe(response.status_code, response.headers)
+            return response
+
+    class _TracingAsyncTransport(httpx.AsyncHTTPTransport):
+        """Variante asincrona di _TracingTransport."""
+
+        def __init__(self, metrics: TransportMetrics, rate_limiter: Optional[RateLimiter] = None, **kwargs):
+            super().__init__(**kwargs)
+            self.metrics = metrics
+            self.rate_limiter = rate_limiter
+
+        async def handle_async_request(self, request):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            self.metrics.requests += 1
+            request.extensions["trace"] = self.metrics.httpcore_trace_async()
+            response = await super().handle_async_request(request)
+            if self.rate_limiter is not None:
+                self.rate_limiter.observe(response.status_code, response.headers)
+            return response
+
+
+def _httpx_limits(max_connections: int, keepalive_expiry: float):
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+def create_httpx_client(
+    timeout: float = 120.0,
+    max_connections: int = 10,
+    keepalive_expiry: float = 60,
+    http2: bool = False,
+    metrics: Optional[TransportMetrics] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+):
+    """
+    Client httpx sincrono con pool keep-alive, da passare agli SDK:
+
+        OpenAI(api_key=..., http_client=create_httpx_client(...))
+        anthropic.Anthropic(api_key=..., http_client=create_httpx_client(...))
+
+    Client creati con lo stesso `rate_limiter` condividono un unico budget
+    di richieste al minuto.
+    """
+    if httpx is None:
+        raise RuntimeError("httpx non installato: pip install httpx")
+    limits = _httpx_limits(max_connections, keepalive_expiry)
+    transport = _TracingTransport(metrics or TransportMetrics(), rate_limiter, http2=http2, limits=limits)
+    return httpx.Client(transport=transport, timeout=timeout)
+
+
+def create_async_httpx_client(
+    timeout: float = 120.0,
+    max_connections: int = 10,
+    keepalive_expiry: float = 60,
+    http2: bool = False,
+    metrics: Optional[TransportMetrics] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+):
+    """
+    Client httpx asincrono con pool keep-alive, da passare agli SDK asincroni:
+
+        anthropic.AsyncAnthropic(api_key=..., http_client=create_async_httpx_client(...))
+    """
+    if httpx is None:
+        raise RuntimeError("httpx non installato: pip install httpx")
+    limits = _httpx_limits(max_connections, keepalive_expiry)
+    transport = _TracingAsyncTransport(metrics or TransportMetrics(), rate_limiter, http2=http2, limits=limits)
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+def create_requests_session(max_connections: int = 10, rate_limiter: Optional[RateLimiter] = None):
+    """
+    Sessione requests con pool keep-alive per l'SDK OpenAI legacy (< 1.0).
+
+    Con `rate_limiter` ogni richiesta attende il proprio slot nel budget
+    condiviso e un 429 sospende tutti i thread che usano la sessione.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class RateLimitedAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            response = super().send(request, **kwargs)
+            if rate_limiter is not None:
+                rate_limiter.observe(response.status_code, response.headers)
+            return response
+
+    session = requests.Session()
+    adapter = RateLimitedAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount("https://", adapter)
+    return session
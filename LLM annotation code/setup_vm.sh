@@ -43,8 +43,10 @@ sudo apt install -y python3 python3-pip
 print_success "Python installato: $(python3 --version)"
 
 # Step 3: Installa dipendenze Python
-print_step "Installazione dipendenze Python (aiohttp)..."
-pip3 install aiohttp --quiet
+# aiohttp: trasporto HTTP; orjson: codec JSON veloce (opzionale);
+# scikit-learn: backend "distilled" (dil_distilled.py)
+print_step "Installazione dipendenze Python (aiohttp, orjson, scikit-learn)..."
+pip3 install aiohttp orjson scikit-learn --quiet
 print_success "Dipendenze installate"
 
 # Step 4: Installa screen per persistenza
@@ -121,6 +123,7 @@ echo ""
 echo "Python: $(python3 --version)"
 echo "pip: $(pip3 --version)"
 echo "aiohttp: $(python3 -c 'import aiohttp; print(aiohttp.__version__)')"
+echo "scikit-learn: $(python3 -c 'import sklearn; print(sklearn.__version__)')"
 echo "screen: $(screen --version | head -1)"
 echo ""
 print_success "Tutte le dipendenze verificate"
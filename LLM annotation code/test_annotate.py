@@ -9,12 +9,15 @@ Usa solo i primi N chunk del primo file per verificare:
 """
 
 import asyncio
-import aiohttp
 import csv
 import json
 import time
 from pathlib import Path
 
+from dil_engine import AnnotationEngine
+from dil_providers import create_backend
+from dil_transport import HTTPTransport
+
 # Usa gli stessi prompt dello script principale
 SYSTEM_PROMPT = """Sei un esperto linguista. Analizza il testo fornito per identificare la presenza di discorso indiretto libero."""
 
@@ -33,7 +36,7 @@ Rispondi solo: YES (se presente discorso indiretto libero) o NO (se assente).
 Risposta:"""
 
 
-async def test_annotation(api_key: str, model: str, input_dir: str, test_chunks: int = 50):
+async def test_annotation(config: dict, input_dir: str, test_chunks: int = 50):
     """Testa annotazione su un campione."""
 
     print("=" * 70)
@@ -70,74 +73,34 @@ async def test_annotation(api_key: str, model: str, input_dir: str, test_chunks:
     print(f"Chunk da testare: {len(chunks)}")
     print()
 
-    # Setup API
-    url = "https://api.anthropic.com/v1/messages"
-    headers = {
-        "x-api-key": api_key,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
+    # Backend Anthropic e motore condiviso con lo script principale
+    # (chunk processati sequenzialmente per test)
+    backend = create_backend('anthropic', config, SYSTEM_PROMPT, USER_PROMPT_TEMPLATE)
+    engine = AnnotationEngine(backend, concurrency=1, cache=False)
 
     # Statistiche
     start_time = time.time()
-    input_tokens = 0
-    output_tokens = 0
     results = []
 
-    # Processa chunk sequenzialmente per test
-    async with aiohttp.ClientSession() as session:
-        for i, chunk_data in enumerate(chunks, 1):
-            chunk_text = chunk_data['chunk']
-
-            prompt = USER_PROMPT_TEMPLATE.format(testo_blocco=chunk_text)
-            payload = {
-                "model": model,
-                "max_tokens": 10,
-                "system": SYSTEM_PROMPT,
-                "messages": [{"role": "user", "content": prompt}]
-            }
-
-            try:
-                async with session.post(url, headers=headers, json=payload) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        response = data['content'][0]['text'].strip().upper()
-
-                        usage = data.get('usage', {})
-                        input_tokens += usage.get('input_tokens', 0)
-                        output_tokens += usage.get('output_tokens', 0)
-
-                        # Normalizza
-                        if 'YES' in response:
-                            annotation = 'YES'
-                        elif 'NO' in response:
-                            annotation = 'NO'
-                        else:
-                            annotation = 'UNCLEAR'
-
-                        results.append({
-                            'chunk_preview': chunk_text[:100] + '...',
-                            'annotation': annotation,
-                            'raw_response': response
-                        })
-
-                        print(f"[{i}/{len(chunks)}] {annotation}", end='\r')
-
-                    else:
-                        error = await resp.text()
-                        print(f"\nERRORE API [{resp.status}]: {error}")
-                        return
-
-            except Exception as e:
-                print(f"\nERRORE: {e}")
-                return
+    def mostra(i, result):
+        annotation = result.label or 'ERROR'
+        results.append({
+            'chunk_preview': chunks[i]['chunk'][:100] + '...',
+            'annotation': annotation,
+            'raw_response': result.response_text.strip().upper()
+        })
+        print(f"[{len(results)}/{len(chunks)}] {annotation}", end='\r')
+
+    transport = HTTPTransport(max_connections=1)
+    async with transport:
+        await engine.run_async(transport, {i: row['chunk'] for i, row in enumerate(chunks)}, on_result=mostra)
 
     elapsed = time.time() - start_time
 
     # Calcola costi
-    input_cost = (input_tokens / 1_000_000) * 3.00
-    output_cost = (output_tokens / 1_000_000) * 15.00
-    total_cost = input_cost + output_cost
+    input_tokens = engine.stats.input_tokens
+    output_tokens = engine.stats.output_tokens
+    total_cost = engine.stats.cost
 
     # Report
     print()
@@ -155,6 +118,7 @@ async def test_annotation(api_key: str, model: str, input_dir: str, test_chunks:
     print(f"Token medi per chunk: {input_tokens/len(results):.0f} input + {output_tokens/len(results):.0f} output")
     print()
     print(f"Costo test: ${total_cost:.4f}")
+    print(f"Trasporto: {transport.metrics.summary()}")
     print(f"Costo stimato per corpus completo: ${total_cost * (536676/len(results)):.2f}")
     print()
 
@@ -162,11 +126,13 @@ async def test_annotation(api_key: str, model: str, input_dir: str, test_chunks:
     yes_count = sum(1 for r in results if r['annotation'] == 'YES')
     no_count = sum(1 for r in results if r['annotation'] == 'NO')
     unclear_count = sum(1 for r in results if r['annotation'] == 'UNCLEAR')
+    error_count = sum(1 for r in results if r['annotation'] == 'ERROR')
 
     print(f"Distribuzione annotazioni:")
     print(f"  YES: {yes_count} ({yes_count/len(results)*100:.1f}%)")
     print(f"  NO: {no_count} ({no_count/len(results)*100:.1f}%)")
     print(f"  UNCLEAR: {unclear_count} ({unclear_count/len(results)*100:.1f}%)")
+    print(f"  ERROR: {error_count} ({error_count/len(results)*100:.1f}%)")
     print()
 
     # Mostra alcuni esempi
@@ -200,7 +166,6 @@ async def main():
         config = json.load(f)
 
     api_key = config['anthropic_api_key']
-    model = config['model']
     input_dir = config['input_dir']
 
     if api_key == 'YOUR_API_KEY_HERE':
@@ -223,7 +188,7 @@ async def main():
         test_chunks = 50
 
     print()
-    await test_annotation(api_key, model, input_dir, test_chunks)
+    await test_annotation(config, input_dir, test_chunks)
 
 
 if __name__ == "__main__":
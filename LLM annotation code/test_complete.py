@@ -5,12 +5,15 @@ Annota un file completo e salva il risultato in chunk_annotated_test/.
 """
 
 import asyncio
-import aiohttp
 import csv
 import json
 import time
 from pathlib import Path
 
+from dil_engine import AnnotationEngine
+from dil_providers import create_backend
+from dil_transport import HTTPTransport
+
 # Prompt templates
 SYSTEM_PROMPT = """Sei un esperto linguista. Analizza il testo fornito per identificare la presenza di discorso indiretto libero."""
 
@@ -29,7 +32,7 @@ Rispondi solo: YES (se presente discorso indiretto libero) o NO (se assente).
 Risposta:"""
 
 
-async def annotate_file(api_key: str, model: str, input_file: Path, output_file: Path, max_chunks: int = None):
+async def annotate_file(config: dict, input_file: Path, output_file: Path, max_chunks: int = None):
     """Annota un file CSV e salva l'output."""
 
     print("=" * 70)
@@ -52,64 +55,23 @@ async def annotate_file(api_key: str, model: str, input_file: Path, output_file:
     print(f"Chunk da annotare: {len(rows)}")
     print()
 
-    # Setup API
-    url = "https://api.anthropic.com/v1/messages"
-    headers = {
-        "x-api-key": api_key,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
+    # Backend Anthropic e motore condiviso con lo script principale
+    backend = create_backend('anthropic', config, SYSTEM_PROMPT, USER_PROMPT_TEMPLATE)
+    engine = AnnotationEngine(backend, concurrency=1, cache=False)
 
     # Statistiche
     start_time = time.time()
-    input_tokens = 0
-    output_tokens = 0
-    annotations = []
+    annotations = ['ERROR'] * len(rows)
+
+    def mostra(i, result):
+        annotations[i] = result.label or 'ERROR'
+        print(f"[{i + 1}/{len(rows)}] {annotations[i]}", end='\r')
 
     # Annota chunk
     print("Annotazione in corso...")
-    async with aiohttp.ClientSession() as session:
-        for i, row in enumerate(rows, 1):
-            chunk_text = row['chunk']
-
-            prompt = USER_PROMPT_TEMPLATE.format(testo_blocco=chunk_text)
-            payload = {
-                "model": model,
-                "max_tokens": 10,
-                "system": SYSTEM_PROMPT,
-                "messages": [{"role": "user", "content": prompt}]
-            }
-
-            try:
-                async with session.post(url, headers=headers, json=payload) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        response = data['content'][0]['text'].strip().upper()
-
-                        usage = data.get('usage', {})
-                        input_tokens += usage.get('input_tokens', 0)
-                        output_tokens += usage.get('output_tokens', 0)
-
-                        # Normalizza risposta
-                        if 'YES' in response:
-                            annotation = 'YES'
-                        elif 'NO' in response:
-                            annotation = 'NO'
-                        else:
-                            annotation = 'UNCLEAR'
-
-                        annotations.append(annotation)
-                        print(f"[{i}/{len(rows)}] {annotation}", end='\r')
-
-                    else:
-                        error = await resp.text()
-                        print(f"\nERRORE API [{resp.status}]: {error}")
-                        # In caso di errore, marca come ERROR
-                        annotations.append('ERROR')
-
-            except Exception as e:
-                print(f"\nERRORE chunk {i}: {e}")
-                annotations.append('ERROR')
+    transport = HTTPTransport(max_connections=1)
+    async with transport:
+        await engine.run_async(transport, {i: row['chunk'] for i, row in enumerate(rows)}, on_result=mostra)
 
     elapsed = time.time() - start_time
     print()
@@ -134,9 +96,7 @@ async def annotate_file(api_key: str, model: str, input_file: Path, output_file:
     print()
 
     # Statistiche
-    input_cost = (input_tokens / 1_000_000) * 3.00
-    output_cost = (output_tokens / 1_000_000) * 15.00
-    total_cost = input_cost + output_cost
+    total_cost = engine.stats.cost
 
     yes_count = annotations.count('YES')
     no_count = annotations.count('NO')
@@ -157,6 +117,7 @@ async def annotate_file(api_key: str, model: str, input_file: Path, output_file:
     print(f"  ERROR:   {error_count:4d} ({error_count/len(rows)*100:5.1f}%)")
     print()
     print(f"Costo test: ${total_cost:.4f}")
+    print(f"Trasporto: {transport.metrics.summary()}")
     print()
     print("=" * 70)
 
@@ -194,7 +155,6 @@ async def main():
         config = json.load(f)
 
     api_key = config['anthropic_api_key']
-    model = config['model']
     input_dir = Path(config['input_dir'])
 
     if api_key == 'YOUR_API_KEY_HERE':
@@ -259,7 +219,7 @@ async def main():
     output_file = output_dir / smallest_file.name.replace('_chunk.csv', '_annotated_test.csv')
 
     print()
-    await annotate_file(api_key, model, smallest_file, output_file, max_chunks)
+    await annotate_file(config, smallest_file, output_file, max_chunks)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Test di andata e ritorno del classificatore distillato.
+Addestra un modello con `python dil_distilled.py train` su un campione di
+chunk_annotated/ e lo carica da annotate_dil.py con "backend": "distilled",
+come avviene sulla VM. Nessuna chiamata API.
+
+Uso:
+    python test_distilled.py [cartella chunk_annotated]
+"""
+
+import atexit
+import csv
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+print("=" * 70)
+print("TEST CLASSIFICATORE DISTILLATO: CLI → annotate_dil.py")
+print("=" * 70)
+print()
+
+# Step 1: Campione del corpus annotato
+print("[1/3] Preparazione campione...")
+candidates = [Path(sys.argv[1])] if len(sys.argv) > 1 else [Path("./chunk_annotated"), Path("../chunk_annotated")]
+source_dir = next((d for d in candidates if d.is_dir()), None)
+if source_dir is None:
+    print(f"✗ ERRORE: cartella chunk_annotated non trovata ({', '.join(map(str, candidates))})")
+    sys.exit(1)
+
+source_files = sorted(source_dir.glob("*_chunk.csv"))[:3]
+if not source_files:
+    print(f"✗ ERRORE: nessun file *_chunk.csv in {source_dir}")
+    sys.exit(1)
+
+work_dir = Path(tempfile.mkdtemp(prefix="test_distilled_"))
+# Campione, modello e output vengono rimossi a fine test, anche su errore
+atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+sample_dir = work_dir / "chunk_annotated"
+sample_dir.mkdir()
+texts = []
+for source in source_files:
+    with open(source, 'r', encoding='utf-8') as f:
+        rows = [row for _, row in zip(range(300), csv.DictReader(f))]
+    with open(sample_dir / source.name, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()), quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(rows)
+    texts.extend(row['chunk'] for row in rows[:5])
+print(f"✓ {len(source_files)} file, campione in {work_dir}")
+
+# Step 2: Addestramento da riga di comando (classe registrata come __main__)
+print()
+print("[2/3] Addestramento con dil_distilled.py train...")
+model_path = work_dir / "dil_distilled.joblib"
+script_dir = Path(__file__).resolve().parent
+result = subprocess.run(
+    [sys.executable, str(script_dir / "dil_distilled.py"), "train",
+     "--input-dir", str(sample_dir), "--model", str(model_path), "--holdout", "0", "--epochs", "1"],
+    capture_output=True, text=True,
+)
+if result.returncode != 0 or not model_path.exists():
+    print("✗ ERRORE: addestramento fallito")
+    print(result.stdout + result.stderr)
+    sys.exit(1)
+print(f"✓ Modello salvato in {model_path}")
+
+# Step 3: Caricamento da annotate_dil.py con backend distilled
+print()
+print("[3/3] Caricamento da annotate_dil.py...")
+config_file = script_dir / "config.json"
+config = json.loads(config_file.read_text()) if config_file.exists() else {}
+config.update({
+    "anthropic_api_key": config.get("anthropic_api_key", "test"),
+    "model": config.get("model", "test"),
+    "max_concurrent_requests": 1,
+    "max_retries": 0,
+    "retry_delay": 0,
+    "checkpoint_interval": 1000,
+    "backend": "distilled",
+    "distilled_model_path": str(model_path),
+    "input_dir": str(sample_dir),
+    "output_dir": str(work_dir / "output"),
+    "state_file": str(work_dir / "annotation_state.json"),
+    "log_file": str(work_dir / "annotation.log"),
+})
+test_config = work_dir / "config.json"
+test_config.write_text(json.dumps(config, indent=2))
+
+sys.path.insert(0, str(script_dir))
+try:
+    from annotate_dil import DILAnnotator
+    annotator = DILAnnotator(str(test_config))
+    labels = annotator.local_model.predict(texts)
+except Exception as e:
+    print(f"✗ ERRORE: {type(e).__name__}: {e}")
+    sys.exit(1)
+
+if set(labels) - {'YES', 'NO'}:
+    print(f"✗ ERRORE: etichette inattese {sorted(set(labels))}")
+    sys.exit(1)
+print(f"✓ Modello caricato, {len(labels)} chunk annotati: {labels.count('YES')} YES, {labels.count('NO')} NO")
+
+print()
+print("=" * 70)
+print("✓ TEST SUPERATO")
+print("=" * 70)